@@ -1,4 +1,5 @@
 from database.neo4j.neo4j_connection import Neo4jConnection
+from database.neo4j.category_labels import category_label
 import logging
 import time
 
@@ -7,8 +8,21 @@ logging.basicConfig(level=logging.INFO,
 logger = logging.getLogger(__name__)
 
 class CollaborativeRecommendationEngine:
-    def __init__(self, conn):
+    def __init__(self, conn, use_category_labels=False):
+        """
+        use_category_labels filters candidates by their Cat_<name> label
+        (see database/neo4j/category_labels.py) instead of walking
+        BELONGS_TO to the Category node, which for large categories is a
+        supernode. The labels must have been loaded or backfilled.
+        """
         self.conn = conn
+        self.use_category_labels = use_category_labels
+
+    def _in_category(self, variable, category):
+        """Pattern for a Business bound to variable that belongs to category."""
+        if self.use_category_labels:
+            return f"({variable}:Business:{category_label(category)})"
+        return f"({variable}:Business)-[:BELONGS_TO]->(:Category {{name: $category}})"
 
     def get_recommendations(self, user_id, category, limit=10):
         """
@@ -37,13 +51,13 @@ class CollaborativeRecommendationEngine:
         WITH u, userRatedBusinesses, COLLECT(DISTINCT other) AS similarUsers
 
         UNWIND similarUsers AS similarUser
-        MATCH (similarUser)-[r:RATED]->(b2:Business)-[:BELONGS_TO]->(c:Category {name: $category})
+        MATCH (similarUser)-[r:RATED]->{b2_in_category}
         WHERE NOT b2 IN userRatedBusinesses
         WITH b2, COUNT(DISTINCT r) AS score
         RETURN b2.name AS business_name, b2.gmap_id AS business_id, score
         ORDER BY score DESC
         LIMIT $limit
-        """
+        """.replace('{b2_in_category}', self._in_category('b2', category))
 
         with self.conn.driver.session() as session:
             recommendations = session.run(query, {
@@ -56,14 +70,26 @@ class CollaborativeRecommendationEngine:
     def _fetch_fallback_recommendations(self, category, limit):
         """
         Fetch fallback recommendations based on objective criteria within the specified category.
+        Ranks by the live rating aggregates on Business nodes (see
+        database/neo4j/rating_aggregates.py) without expanding RATED edges.
+        Businesses without aggregates yet (graphs loaded before them and not
+        backfilled) fall back to aggregating their RATED edges.
         """
         query = """
-        MATCH (b:Business)-[:BELONGS_TO]->(c:Category {name: $category})
-        MATCH (b)<-[r:RATED]-()
-        RETURN b.name AS business_name, b.gmap_id AS business_id, COUNT(r) AS total_ratings, AVG(r.rating) AS avg_rating
+        MATCH {b_in_category}
+        CALL (b) {
+            OPTIONAL MATCH (b)<-[r:RATED]-()
+            WHERE b.rating_count IS NULL
+            RETURN COUNT(r) AS edge_count, AVG(r.rating) AS edge_avg
+        }
+        WITH b, coalesce(b.rating_count, edge_count) AS total_ratings,
+             coalesce(b.rating_avg, edge_avg) AS avg_rating
+        WHERE total_ratings > 0
+        RETURN b.name AS business_name, b.gmap_id AS business_id,
+               total_ratings, avg_rating
         ORDER BY avg_rating DESC, total_ratings DESC, b.name ASC
         LIMIT $limit
-        """
+        """.replace('{b_in_category}', self._in_category('b', category))
 
         with self.conn.driver.session() as session:
             fallback_recommendations = session.run(query, {
@@ -74,15 +100,20 @@ class CollaborativeRecommendationEngine:
     
     def _fetch_recommendations_user(self, user_id, category, limit):
         """
-        Fetch recommendations based on SIMILAR_TO relationships.
+        Fetch recommendations based on USER_SIMILAR relationships.
         """
         query = """
+        // Resolve the active similarity generation
+        OPTIONAL MATCH (g:SimilarityGeneration {kind: 'user'})
+        WITH coalesce(g.active, 0) AS user_generation
+
         // Get similar users
-        MATCH (u:User {user_id: $user_id})-[s:SIMILAR_TO]-(similar:User)
+        MATCH (u:User {user_id: $user_id})-[s:USER_SIMILAR]-(similar:User)
+        WHERE coalesce(s.generation, 0) = user_generation
         WITH u, similar, s.score AS similarity_score
 
         // Get businesses rated by similar users
-        MATCH (similar)-[r:RATED]->(b:Business)-[:BELONGS_TO]->(c:Category {name: $category})
+        MATCH (similar)-[r:RATED]->{b_in_category}
         WHERE NOT EXISTS((u)-[:RATED]->(b))
 
         // Aggregate recommendations based on user similarity and ratings
@@ -91,7 +122,7 @@ class CollaborativeRecommendationEngine:
                COUNT(r) AS total_ratings, AVG(r.rating) AS avg_rating
         ORDER BY weighted_score DESC, avg_rating DESC
         LIMIT $limit
-        """
+        """.replace('{b_in_category}', self._in_category('b', category))
 
         with self.conn.driver.session() as session:
             recommendations = session.run(query, {'user_id': user_id, 'category': category, 'limit': limit})
@@ -99,19 +130,26 @@ class CollaborativeRecommendationEngine:
 
     def _fetch_recommendations_user_business(self, user_id, category, limit):
         """
-        Fetch recommendations based on user-user and business-business SIMILAR_TO relationships.
+        Fetch recommendations based on USER_SIMILAR and BUSINESS_SIMILAR relationships.
         """
         query = """
+        // Resolve the active similarity generations
+        OPTIONAL MATCH (ug:SimilarityGeneration {kind: 'user'})
+        OPTIONAL MATCH (bg:SimilarityGeneration {kind: 'business'})
+        WITH coalesce(ug.active, 0) AS user_generation,
+            coalesce(bg.active, 0) AS business_generation
+
         // Get businesses rated by the target user
         MATCH (u:User {user_id: $user_id})-[r_user:RATED]->(b_rated:Business)
-        WITH u, 
+        WITH u, user_generation, business_generation,
             COLLECT(DISTINCT b_rated) AS userRatedBusinesses, 
             COLLECT({business: b_rated, rating: r_user.rating}) AS userRatedBusinessRatings
 
         // Get similar users and their similarity scores
-        CALL (u, userRatedBusinesses) {
-            MATCH (u)-[s1:SIMILAR_TO]-(similar:User)
-            MATCH (similar)-[r:RATED]->(b:Business)-[:BELONGS_TO]->(:Category {name: $category})
+        CALL (u, userRatedBusinesses, user_generation) {
+            MATCH (u)-[s1:USER_SIMILAR]-(similar:User)
+            WHERE coalesce(s1.generation, 0) = user_generation
+            MATCH (similar)-[r:RATED]->{b_in_category}
             WHERE NOT b IN userRatedBusinesses
             RETURN b.gmap_id AS business_id, b, SUM(r.rating * s1.score) AS user_based_score
         }
@@ -124,14 +162,17 @@ class CollaborativeRecommendationEngine:
             }) AS userScores, 
             userRatedBusinesses, 
             userRatedBusinessRatings, 
+            business_generation,
             u
 
         // Compute business-based scores
-        CALL (userRatedBusinesses, userRatedBusinessRatings) {
+        CALL (userRatedBusinesses, userRatedBusinessRatings, business_generation) {
             UNWIND userRatedBusinessRatings AS urb
             WITH urb.business AS ratedBusiness, urb.rating AS rating, userRatedBusinesses
-            MATCH (ratedBusiness)-[s2:SIMILAR_TO]->(b:Business)
+            // Each pair is stored once in canonical direction, so match both ways
+            MATCH (ratedBusiness)-[s2:BUSINESS_SIMILAR]-(b:Business)
             WHERE NOT b IN userRatedBusinesses
+              AND coalesce(s2.generation, 0) = business_generation
             RETURN b.gmap_id AS business_id, b, SUM(rating * s2.score) AS business_based_score
         }
 
@@ -162,12 +203,12 @@ class CollaborativeRecommendationEngine:
             business_id,
             total_user_based_score, 
             total_business_based_score,
-            b.num_reviews AS total_ratings,
-            b.avg_rating,
+            coalesce(b.rating_count, b.num_of_reviews) AS total_ratings,
+            coalesce(b.rating_avg, b.avg_rating) AS avg_rating,
             (total_user_based_score + total_business_based_score) AS total_score
-        ORDER BY total_score DESC, b.avg_rating DESC
+        ORDER BY total_score DESC, avg_rating DESC
         LIMIT $limit
-        """
+        """.replace('{b_in_category}', self._in_category('b', category))
 
         with self.conn.driver.session() as session:
             recommendations = session.run(query, {'user_id': user_id, 'category': category, 'limit': limit})
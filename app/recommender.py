@@ -2,6 +2,7 @@ import logging
 import time
 
 from database.mysql.mysqlconnection import MySQLConnection
+from database.mysql.ratings import restrict_to_window, fetch_user_rating_count
 
 # Database details
 HOST = "localhost"
@@ -12,6 +13,64 @@ logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Similar users and businesses, read from the similarity tables (each pair
+# stored once, so both columns have to be searched) or from their adjacency
+# lists (each pair stored in both directions, clustered by descending score)
+SIMILAR_USERS_FROM_SIMILARITY = """
+            SELECT s.user_id_2 AS similar_user_id, s.similarity_score
+            FROM user_similarity s
+            WHERE s.user_id_1 = %s
+            UNION
+            SELECT s.user_id_1 AS similar_user_id, s.similarity_score
+            FROM user_similarity s
+            WHERE s.user_id_2 = %s
+"""
+
+SIMILAR_USERS_FROM_NEIGHBORS = """
+            SELECT n.neighbor_id AS similar_user_id, n.similarity_score
+            FROM user_neighbors n
+            WHERE n.user_id = %s
+            ORDER BY n.similarity_score DESC
+            {neighbor_limit}
+"""
+
+BUSINESS_BASED_RATINGS_FROM_SIMILARITY = """
+            SELECT bs.business_id_2 AS similar_business_id,
+                urb.rating, bs.similarity_score
+            FROM user_rated_businesses urb
+            JOIN business_similarity bs ON urb.business_id = bs.business_id_1
+            WHERE bs.business_id_2 IN (
+                SELECT business_id FROM user_rated_businesses
+            )
+
+            UNION
+            
+            SELECT bs.business_id_1 AS similar_business_id,
+                urb.rating, bs.similarity_score
+            FROM user_rated_businesses urb
+            JOIN business_similarity bs ON urb.business_id = bs.business_id_2
+            WHERE bs.business_id_1 IN (
+                SELECT business_id FROM user_rated_businesses
+            )
+"""
+
+# DISTINCT drops the same duplicates as the UNION above
+BUSINESS_BASED_RATINGS_FROM_NEIGHBORS = """
+            SELECT DISTINCT bn.neighbor_id AS similar_business_id,
+                urb.rating, bn.similarity_score
+            FROM user_rated_businesses urb
+            JOIN LATERAL (
+                SELECT n.neighbor_id, n.similarity_score
+                FROM business_neighbors n
+                WHERE n.business_id = urb.business_id
+                ORDER BY n.similarity_score DESC
+                {neighbor_limit}
+            ) AS bn ON TRUE
+            WHERE bn.neighbor_id IN (
+                SELECT business_id FROM user_rated_businesses
+            )
+"""
+
 def get_db_connection(num_businesses):
     return MySQLConnection(
                 host=HOST,
@@ -21,15 +80,53 @@ def get_db_connection(num_businesses):
             ).connection
 
 class MySQLRecommendationEngine:
-    def __init__(self, conn):
+    """
+    The since= option of the collaborative queries only considers ratings
+    rated at or after since (a datetime, see ratings.window_start), which
+    prunes older partitions of a partitioned ratings table. The target
+    user's own ratings are always read in full, so nothing they rated before
+    the window is recommended again.
+
+    With use_neighbor_tables, similar users and businesses are read from the
+    user_neighbors / business_neighbors adjacency lists (filled by the
+    similarity jobs with neighbors=True) instead of the similarity tables,
+    and neighbor_limit keeps only the strongest neighbors of each user or
+    business.
+    """
+    def __init__(self, conn, use_neighbor_tables=False, neighbor_limit=None):
         self.conn = conn
+        self.use_neighbor_tables = use_neighbor_tables
+        self.neighbor_limit = neighbor_limit
+
+    def _with_neighbor_limit(self, fragment):
+        limit = f"LIMIT {int(self.neighbor_limit)}" if self.neighbor_limit else ""
+        return fragment.replace('{neighbor_limit}', limit)
+
+    def _similar_users(self, user_id):
+        """
+        The similar_users CTE body and its parameters.
+        """
+        if self.use_neighbor_tables:
+            return self._with_neighbor_limit(SIMILAR_USERS_FROM_NEIGHBORS), (user_id,)
+        return SIMILAR_USERS_FROM_SIMILARITY, (user_id, user_id)
 
-    def get_recommendations(self, user_id, category, limit=10):
+    def _business_based_ratings(self):
+        """
+        The business_based_ratings CTE body (it has no parameters).
+        """
+        if self.use_neighbor_tables:
+            return self._with_neighbor_limit(BUSINESS_BASED_RATINGS_FROM_NEIGHBORS)
+        return BUSINESS_BASED_RATINGS_FROM_SIMILARITY
+
+    def get_recommendations(self, user_id, category, limit=10, since=None):
         """
         Get collaborative filtering recommendations with category filtering.
         Falls back to objective recommendations within the same category if no results are found.
+        Users without ratings (per user_stats) get the fallback without running the collaborative query.
         """
-        recommendations = self._fetch_recommendations(user_id, category, limit)
+        recommendations = []
+        if self._user_rating_count(user_id) > 0:
+            recommendations = self._fetch_recommendations(user_id, category, limit, since)
 
         # Fallback if no recommendations found
         if not recommendations:
@@ -37,8 +134,18 @@ class MySQLRecommendationEngine:
             recommendations = self._fetch_fallback_recommendations(category, limit)
 
         return recommendations
+
+    def _user_rating_count(self, user_id):
+        """
+        Number of ratings of the user, looked up in user_stats (counted in
+        ratings if user_stats has no row for the user).
+        """
+        cur = self.conn.cursor()
+        count = fetch_user_rating_count(cur, user_id)
+        cur.close()
+        return count
     
-    def _fetch_recommendations(self, user_id, category, limit):
+    def _fetch_recommendations(self, user_id, category, limit, since=None):
         """
         Fetch recommendations based on collaborative filtering with category filtering.
         """
@@ -56,13 +163,14 @@ class MySQLRecommendationEngine:
             FROM ratings r
             JOIN user_rated_businesses ur
             ON r.business_id = ur.business_id
-            WHERE r.user_id != %s
+            WHERE r.user_id != %s AND {since:r}
         ),
         business_rated_by_similar_users AS (
             SELECT DISTINCT r.business_id
             FROM ratings r
             JOIN similar_users su
             ON r.user_id = su.user_id
+            WHERE {since:r}
         ),
         category_businesses AS (
             SELECT DISTINCT brsu.business_id
@@ -84,12 +192,13 @@ class MySQLRecommendationEngine:
         AND r.user_id IN (
             SELECT user_id FROM similar_users
         )
+        AND {since:r}
         GROUP BY r.business_id
         ORDER BY score DESC
         LIMIT %s;
         """
 
-        cur.execute(query, (user_id, user_id, category, limit))
+        cur.execute(restrict_to_window(query, since), (user_id, user_id, category, limit))
         results = cur.fetchall()
         return results
     
@@ -119,7 +228,7 @@ class MySQLRecommendationEngine:
         results = cur.fetchall()
         return results
     
-    def _fetch_recommendations_user(self, user_id, category, limit):
+    def _fetch_recommendations_user(self, user_id, category, limit, since=None):
         """
         Fetch recommendations based on SIMILAR_TO relationships.
         """
@@ -134,15 +243,7 @@ class MySQLRecommendationEngine:
         ),
         
         -- Step 2: Get similar users and their similarity scores
-        similar_users AS (
-            SELECT s.user_id_2 AS similar_user_id, s.similarity_score
-            FROM user_similarity s
-            WHERE s.user_id_1 = %s
-            UNION
-            SELECT s.user_id_1 AS similar_user_id, s.similarity_score
-            FROM user_similarity s
-            WHERE s.user_id_2 = %s
-        ),
+        similar_users AS ({similar_users}        ),
 
         -- Step 3: Pre-filter businesses by category
         category_filtered_businesses AS (
@@ -160,7 +261,7 @@ class MySQLRecommendationEngine:
                 SELECT business_id FROM category_filtered_businesses
             ) AND r.business_id NOT IN (
                 SELECT business_id FROM user_rated_businesses
-            )
+            ) AND {since:r}
         )
 
         -- Step 5: Calculate weighted score (normalized), total ratings, and average rating for each business
@@ -176,12 +277,14 @@ class MySQLRecommendationEngine:
         LIMIT %s;
         """
 
-        cur.execute(query, (user_id, user_id, user_id, category, limit))
+        similar_users, similar_users_params = self._similar_users(user_id)
+        query = query.replace('{similar_users}', similar_users)
+        cur.execute(restrict_to_window(query, since), (user_id, *similar_users_params, category, limit))
         results = cur.fetchall()
         return results
 
     
-    def _fetch_recommendations_user_business(self, user_id, category, limit):
+    def _fetch_recommendations_user_business(self, user_id, category, limit, since=None):
         """
         Fetch recommendations based on user-user and business-business SIMILAR_TO relationships.
         """
@@ -198,15 +301,7 @@ class MySQLRecommendationEngine:
         -- START USER-BASED SIMILARITY SCORE CALCULATION
 
         -- Step 2: Get similar users and their similarity scores
-        similar_users AS (
-            SELECT s.user_id_2 AS similar_user_id, s.similarity_score
-            FROM user_similarity s
-            WHERE s.user_id_1 = %s
-            UNION
-            SELECT s.user_id_1 AS similar_user_id, s.similarity_score
-            FROM user_similarity s
-            WHERE s.user_id_2 = %s
-        ),
+        similar_users AS ({similar_users}        ),
 
         -- Step 3: Pre-filter businesses by category
         category_filtered_businesses AS (
@@ -224,7 +319,7 @@ class MySQLRecommendationEngine:
                 SELECT business_id FROM category_filtered_businesses
             ) AND r.business_id NOT IN (
                 SELECT business_id FROM user_rated_businesses
-            )
+            ) AND {since:r}
         ),
 
         -- Step 5: Get user-based scores for businesses obtained in Step 4
@@ -244,25 +339,7 @@ class MySQLRecommendationEngine:
         -- Note: The rating in the result corresponds to the source business 
         --       rated by the user, not the rating of the similar business 
         --       included in the tuple
-        business_based_ratings AS (
-            SELECT bs.business_id_2 AS similar_business_id,
-                urb.rating, bs.similarity_score
-            FROM user_rated_businesses urb
-            JOIN business_similarity bs ON urb.business_id = bs.business_id_1
-            WHERE bs.business_id_2 IN (
-                SELECT business_id FROM user_rated_businesses
-            )
-
-            UNION
-            
-            SELECT bs.business_id_1 AS similar_business_id,
-                urb.rating, bs.similarity_score
-            FROM user_rated_businesses urb
-            JOIN business_similarity bs ON urb.business_id = bs.business_id_2
-            WHERE bs.business_id_1 IN (
-                SELECT business_id FROM user_rated_businesses
-            )
-        ),
+        business_based_ratings AS ({business_based_ratings}        ),
 
         -- Step 7: Get business-based scores for businesses obtained in Step 6
         business_based_scores AS (
@@ -315,7 +392,10 @@ class MySQLRecommendationEngine:
         LIMIT %s;
         """
 
-        cur.execute(query, (user_id, user_id, user_id, category, limit))
+        similar_users, similar_users_params = self._similar_users(user_id)
+        query = query.replace('{similar_users}', similar_users)
+        query = query.replace('{business_based_ratings}', self._business_based_ratings())
+        cur.execute(restrict_to_window(query, since), (user_id, *similar_users_params, category, limit))
         results = cur.fetchall()
         return results
 
@@ -0,0 +1,319 @@
+"""
+Vectorized synthetic dataset generator for scaling experiments.
+
+Generates businesses with category sets and ratings by users whose
+activity, like the popularity of the businesses, follows a power law
+(Zipf): weight rank^-exponent over randomly assigned ranks. All sampling
+is done on NumPy arrays, so millions of ratings take seconds. Generation is
+seeded, so the same seed and profile give the same files.
+
+The shape of the data comes from a profile: the Zipf exponents of user
+activity and business popularity, ratings per user, the distribution of
+rating values and of timestamps, categories per business, and category
+popularity. DEFAULT_PROFILE holds rough placeholder values. Fit a profile
+from a real sample (e.g. the Georgia subsets of data/get_data.py) to match
+its statistics, and save it to reuse:
+
+    python -m benchmarks.generate_synthetic_dataset --fit-from data/samples/filtered_ratings_10k.csv \\
+        data/samples/matched_businesses_10k.csv --save-profile georgia_profile.json \\
+        --businesses 100000 --ratings 5000000 --label 100k
+
+The files have the formats the loaders read: ratings as business, user,
+rating, timestamp (epoch milliseconds), and business metadata with
+gmap_id, name, category (a list literal), avg_rating, num_of_reviews,
+latitude and longitude. They are written to data/samples as
+filtered_ratings_<label>.csv and matched_businesses_<label>.csv, with a
+stats_<label>.txt summary. Use --metadata-format json for the JSON-lines
+metadata of the raw data.
+"""
+
+import argparse
+import ast
+import json
+import logging
+import os
+import time
+import numpy as np
+import pandas as pd
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Rough values in the range of Google Local data; fit a profile from a
+# sample with --fit-from for matching statistics
+DEFAULT_PROFILE = {
+    'user_exponent': 0.7,           # Zipf exponent of ratings per user
+    'business_exponent': 0.9,       # Zipf exponent of ratings per business
+    'ratings_per_user': 5.0,
+    'rating_values': [1, 2, 3, 4, 5],
+    'rating_probs': [0.06, 0.03, 0.07, 0.17, 0.67],
+    # Timestamp percentiles 0, 1, ..., 100 (epoch ms), sampled by interpolation
+    'timestamp_percentiles': list(np.linspace(1420070400000, 1630454400000, 101).astype(np.int64).tolist()),
+    'categories_per_business': {'1': 0.35, '2': 0.3, '3': 0.2, '4': 0.1, '5': 0.05},
+    'category_exponent': 1.0,
+    'categories': ['Restaurant', 'Fast food restaurant', 'Gas station', 'Convenience store',
+                   'Auto repair shop', 'Beauty salon', 'Hair salon', 'Church', 'Mexican restaurant',
+                   'Pizza restaurant', 'Coffee shop', 'Bar', 'Grocery store', 'Hotel', 'Park',
+                   'Pharmacy', 'Bank', 'Dentist', 'Clothing store', 'Sandwich shop'],
+    'num_categories': 2000          # Vocabulary size; names beyond 'categories' are generated
+}
+
+# Latitude and longitude bounds of Georgia
+GEORGIA_BOUNDS = ((30.36, 35.0), (-85.61, -80.84))
+
+###############################################################
+# PROFILES
+###############################################################
+
+def fit_zipf_exponent(counts):
+    """Zipf exponent of counts: minus the slope of log(count) over log(rank)."""
+    counts = np.sort(np.asarray(counts, dtype=np.float64))[::-1]
+    counts = counts[counts > 0]
+    if len(counts) < 2:
+        return 0.0
+    ranks = np.arange(1, len(counts) + 1)
+    slope, _ = np.polyfit(np.log(ranks), np.log(counts), 1)
+    return float(max(0.0, -slope))
+
+def fit_profile(ratings, businesses):
+    """Profile of a ratings DataFrame and its business metadata DataFrame."""
+    user_counts = ratings.groupby('user').size().to_numpy()
+    business_counts = ratings.groupby('business').size().to_numpy()
+
+    values, value_counts = np.unique(ratings['rating'].round().astype(int), return_counts=True)
+    timestamps = ratings['timestamp'].dropna().to_numpy(dtype=np.float64)
+
+    categories = businesses['category'].map(lambda value: ast.literal_eval(value) if isinstance(value, str) else [])
+    sizes = categories.map(len)
+    size_probs = sizes.value_counts(normalize=True).sort_index()
+    category_counts = categories.explode().dropna().value_counts()
+
+    return {
+        'user_exponent': fit_zipf_exponent(user_counts),
+        'business_exponent': fit_zipf_exponent(business_counts),
+        'ratings_per_user': float(len(ratings) / len(user_counts)),
+        'rating_values': values.tolist(),
+        'rating_probs': (value_counts / value_counts.sum()).tolist(),
+        'timestamp_percentiles': np.percentile(timestamps, np.arange(101)).astype(np.int64).tolist(),
+        'categories_per_business': {str(size): float(p) for size, p in size_probs.items()},
+        'category_exponent': fit_zipf_exponent(category_counts.to_numpy()),
+        'categories': category_counts.index.tolist(),
+        'num_categories': len(category_counts)
+    }
+
+def load_profile(path=None):
+    profile = dict(DEFAULT_PROFILE)
+    if path:
+        with open(path) as file:
+            profile.update(json.load(file))
+    return profile
+
+###############################################################
+# SAMPLING
+###############################################################
+
+def zipf_weights(rng, n, exponent, max_weight=None):
+    """
+    Probabilities rank^-exponent of n items over randomly assigned ranks.
+    Weights above max_weight are capped and the rest renormalized, so no
+    single item is expected to take more than its share.
+    """
+    weights = np.arange(1, n + 1, dtype=np.float64) ** -exponent
+    weights /= weights.sum()
+    if max_weight is not None and max_weight * n > 1:
+        for _ in range(20):
+            over = weights > max_weight
+            if not over.any():
+                break
+            excess = (weights[over] - max_weight).sum()
+            weights[over] = max_weight
+            weights[~over] += excess * weights[~over] / weights[~over].sum()
+    return rng.permutation(weights)
+
+def sample_unique_pairs(rng, size, num_users, num_businesses, user_weights=None, business_weights=None,
+                        exclude=None, max_rounds=50):
+    """
+    size distinct (user, business) index pairs, drawn with the given
+    weights (uniform if None). exclude is an array of pair keys
+    (user * num_businesses + business) that must not be drawn.
+
+    Pairs are drawn in bulk; duplicates are dropped and the shortfall is
+    drawn again until size pairs are found.
+    """
+    if size > num_users * num_businesses - (0 if exclude is None else len(exclude)):
+        raise ValueError(f"Cannot draw {size} distinct pairs of {num_users} users and {num_businesses} businesses")
+
+    keys = np.empty(0, dtype=np.int64)
+    for _ in range(max_rounds):
+        missing = size - len(keys)
+        if missing <= 0:
+            break
+        draws = int(missing * 1.1) + 16
+        users = rng.choice(num_users, size=draws, p=user_weights)
+        businesses = rng.choice(num_businesses, size=draws, p=business_weights)
+        new_keys = users.astype(np.int64) * num_businesses + businesses
+        if exclude is not None:
+            new_keys = new_keys[~np.isin(new_keys, exclude)]
+        # Keep the first occurrence of every key, in draw order
+        _, first = np.unique(np.concatenate([keys, new_keys]), return_index=True)
+        keys = np.concatenate([keys, new_keys])[np.sort(first)]
+    if len(keys) < size:
+        raise ValueError(f"Found only {len(keys)} of {size} distinct pairs; the weights are too skewed")
+
+    keys = keys[:size]
+    return keys // num_businesses, keys % num_businesses
+
+def sample_from_percentiles(rng, percentiles, size):
+    """Values drawn from the distribution given by its percentiles 0, 1, ..., 100."""
+    return np.interp(rng.random(size) * 100, np.arange(len(percentiles)), percentiles)
+
+###############################################################
+# GENERATION
+###############################################################
+
+def category_names(profile):
+    names = list(profile['categories'])[:profile['num_categories']]
+    names += [f"Category {i}" for i in range(len(names) + 1, profile['num_categories'] + 1)]
+    return np.array(names, dtype=object)
+
+def generate_business_ids(rng, num_businesses):
+    """Ids shaped like gmap_ids; the index in the second half keeps them distinct."""
+    prefixes = rng.integers(0, 2 ** 62, size=num_businesses)
+    return np.array([f"0x{prefix:016x}:0x{index:016x}" for index, prefix in enumerate(prefixes)], dtype=object)
+
+def generate_user_ids(num_users):
+    """21-digit ids shaped like the Google user ids."""
+    return np.array([f"1{index:020d}" for index in range(num_users)], dtype=object)
+
+def generate_categories(rng, num_businesses, profile):
+    """
+    Category lists of num_businesses businesses: sizes from the profile,
+    names drawn by Zipf popularity without repeats within a business.
+    """
+    names = category_names(profile)
+    sizes_probs = profile['categories_per_business']
+    sizes = rng.choice(np.array([int(size) for size in sizes_probs]), size=num_businesses,
+                       p=np.array(list(sizes_probs.values())) / sum(sizes_probs.values()))
+    weights = np.arange(1, len(names) + 1, dtype=np.float64) ** -profile['category_exponent']
+    weights /= weights.sum()
+
+    # Oversample each row, drop repeats, then keep each business's size
+    width = max(1, 2 * int(sizes.max()))
+    draws = rng.choice(len(names), size=(num_businesses, width), p=weights)
+    draws.sort(axis=1)
+    repeated = np.zeros_like(draws, dtype=bool)
+    repeated[:, 1:] = draws[:, 1:] == draws[:, :-1]
+    draws = np.where(repeated, -1, draws)
+    # Move repeats (-1) to the end of each row, keeping popularity order
+    draws = np.take_along_axis(draws, np.argsort(repeated, axis=1, kind='stable'), axis=1)
+
+    return [[names[index] for index in row[:size] if index >= 0] for row, size in zip(draws, sizes)]
+
+def generate_dataset(num_businesses, num_ratings, profile, seed=12345, num_users=None):
+    """
+    Returns (businesses, ratings) DataFrames in the formats of the
+    data/samples files.
+    """
+    rng = np.random.default_rng(seed)
+    num_users = num_users or max(1, round(num_ratings / profile['ratings_per_user']))
+    logger.info(f"Generating {num_ratings} ratings of {num_users} users for {num_businesses} businesses")
+
+    business_ids = generate_business_ids(rng, num_businesses)
+    user_ids = generate_user_ids(num_users)
+
+    # No user is expected to rate more than a quarter of the businesses, and
+    # no business to be rated by more than a quarter of the users
+    user_weights = zipf_weights(rng, num_users, profile['user_exponent'],
+                                max_weight=0.25 * num_businesses / num_ratings)
+    business_weights = zipf_weights(rng, num_businesses, profile['business_exponent'],
+                                    max_weight=0.25 * num_users / num_ratings)
+    users, businesses = sample_unique_pairs(rng, num_ratings, num_users, num_businesses,
+                                            user_weights, business_weights)
+    ratings = rng.choice(np.array(profile['rating_values']), size=num_ratings,
+                         p=np.array(profile['rating_probs']) / sum(profile['rating_probs']))
+    timestamps = sample_from_percentiles(rng, profile['timestamp_percentiles'], num_ratings).astype(np.int64)
+
+    # Business aggregates, as in the metadata of the real data
+    counts = np.bincount(businesses, minlength=num_businesses)
+    sums = np.bincount(businesses, weights=ratings, minlength=num_businesses)
+    (lat_min, lat_max), (lon_min, lon_max) = GEORGIA_BOUNDS
+
+    businesses_df = pd.DataFrame({
+        'name': [f"Business {index}" for index in range(num_businesses)],
+        'gmap_id': business_ids,
+        'latitude': rng.uniform(lat_min, lat_max, num_businesses).round(6),
+        'longitude': rng.uniform(lon_min, lon_max, num_businesses).round(6),
+        'category': generate_categories(rng, num_businesses, profile),
+        'avg_rating': np.divide(sums, counts, out=np.zeros(num_businesses), where=counts > 0).round(1),
+        'num_of_reviews': counts
+    })
+    ratings_df = pd.DataFrame({
+        'business': business_ids[businesses],
+        'user': user_ids[users],
+        'rating': ratings,
+        'timestamp': timestamps
+    })
+    return businesses_df, ratings_df
+
+###############################################################
+# OUTPUT
+###############################################################
+
+def write_dataset(businesses, ratings, output_dir, label, metadata_format='csv', chunk_size=1000000):
+    os.makedirs(output_dir, exist_ok=True)
+
+    ratings_file = os.path.join(output_dir, f"filtered_ratings_{label}.csv")
+    for start in range(0, len(ratings), chunk_size):
+        ratings.iloc[start:start + chunk_size].to_csv(
+            ratings_file, mode='w' if start == 0 else 'a', header=start == 0, index=False)
+
+    if metadata_format == 'json':
+        metadata_file = os.path.join(output_dir, f"matched_businesses_{label}.json")
+        businesses.to_json(metadata_file, orient='records', lines=True)
+    else:
+        metadata_file = os.path.join(output_dir, f"matched_businesses_{label}.csv")
+        # str() of a list gives the literal the loaders parse with ast.literal_eval
+        businesses.assign(category=businesses['category'].map(str)).to_csv(
+            metadata_file, index=False, encoding='utf-8')
+
+    with open(os.path.join(output_dir, f"stats_{label}.txt"), "w") as file:
+        file.write(f"Sample contains {len(businesses)} businesses, {len(ratings)} ratings, "
+                   f"{ratings['user'].nunique()} users.")
+    logger.info(f"Wrote {ratings_file} and {metadata_file}")
+
+def main(args):
+    if args.fit_from:
+        ratings_file, metadata_file = args.fit_from
+        profile = fit_profile(pd.read_csv(ratings_file), pd.read_csv(metadata_file))
+        logger.info(f"Fitted profile: user exponent {profile['user_exponent']:.2f}, business exponent "
+                    f"{profile['business_exponent']:.2f}, {profile['ratings_per_user']:.2f} ratings per user")
+    else:
+        profile = load_profile(args.profile)
+    if args.save_profile:
+        with open(args.save_profile, 'w') as file:
+            json.dump(profile, file, indent=2)
+
+    start_time = time.time()
+    businesses, ratings = generate_dataset(args.businesses, args.ratings, profile, args.seed, args.users)
+    logger.info(f"Generated the dataset in {time.time() - start_time:.2f} seconds")
+    write_dataset(businesses, ratings, args.output_dir, args.label or f"synthetic_{args.businesses}",
+                  args.metadata_format)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Generate a synthetic ratings dataset')
+    parser.add_argument('--businesses', type=int, required=True)
+    parser.add_argument('--ratings', type=int, required=True)
+    parser.add_argument('--users', type=int,
+                      help='Number of users (default: ratings / ratings_per_user of the profile)')
+    parser.add_argument('--seed', type=int, default=12345)
+    parser.add_argument('--profile', type=str,
+                      help='JSON profile, applied on top of DEFAULT_PROFILE')
+    parser.add_argument('--fit-from', nargs=2, metavar=('RATINGS_CSV', 'METADATA_CSV'),
+                      help='Fit the profile from a ratings sample and its business metadata')
+    parser.add_argument('--save-profile', type=str,
+                      help='Path to save the profile used')
+    parser.add_argument('--output-dir', type=str, default='data/samples')
+    parser.add_argument('--label', type=str,
+                      help='File name suffix (default synthetic_<businesses>)')
+    parser.add_argument('--metadata-format', choices=('csv', 'json'), default='csv')
+    main(parser.parse_args())
@@ -1,8 +1,9 @@
+import numpy as np
 import pandas as pd
-import random
 import os
+from benchmarks.generate_synthetic_dataset import sample_unique_pairs
 
-random.seed(12345)
+rng = np.random.default_rng(12345)
 
 # Load the data
 filtered_1k_ratings = pd.read_csv("data/samples/filtered_ratings_1k.csv")
@@ -19,26 +20,25 @@ business_sets = [
 ]
 
 def generate_ratings(businesses, ratings, size):
-    valid_businesses = list(businesses)
-    valid_users = list(ratings['user'].unique())
-    
-    # Existing business-user pairs from filtered ratings
-    existing_pairs = set(zip(ratings['business'], ratings['user']))
-    
-    new_pairs = []
-    
-    while len(new_pairs) < size:
-        # Randomly select a business and a user
-        business = random.choice(valid_businesses)
-        user = random.choice(valid_users)
-        
-        if (business, user) not in existing_pairs:
-            dummy_rating = random.randint(1, 5)  # Random rating between 1 and 5
-            timestamp = 1539819804101  # Placeholder timestamp
-            new_pairs.append((business, user, dummy_rating, timestamp))
-            existing_pairs.add((business, user))
-    
-    dummy_df = pd.DataFrame(new_pairs, columns=['business', 'user', 'rating', 'timestamp'])
+    valid_businesses = pd.Index(businesses.unique())
+    valid_users = pd.Index(ratings['user'].unique())
+
+    # Existing business-user pairs from filtered ratings, as pair keys
+    business_index = valid_businesses.get_indexer(ratings['business'])
+    user_index = valid_users.get_indexer(ratings['user'])
+    known = business_index >= 0
+    existing_keys = user_index[known].astype(np.int64) * len(valid_businesses) + business_index[known]
+
+    # Uniformly drawn new pairs, all at once
+    user_indices, business_indices = sample_unique_pairs(rng, size, len(valid_users), len(valid_businesses),
+                                                         exclude=existing_keys)
+
+    dummy_df = pd.DataFrame({
+        'business': valid_businesses[business_indices],
+        'user': valid_users[user_indices],
+        'rating': rng.integers(1, 6, size=size),  # Random rating between 1 and 5
+        'timestamp': 1539819804101  # Placeholder timestamp
+    })
     
     return dummy_df
 
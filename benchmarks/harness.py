@@ -0,0 +1,526 @@
+"""
+Workload-driven read/write benchmark harness for the MySQL and Neo4j backends.
+
+A workload declares the operation mix rather than a fixed action list:
+how many operations to run and after how many warmup operations, the share
+of writes, how the users of recommendations are chosen, which categories
+they ask for and when similarities are refreshed (see DEFAULT_WORKLOAD).
+Workloads are picked by name from WORKLOADS or read from a JSON file.
+
+Both backends implement the Backend interface on top of the recommendation
+engines (MySQLRecommendationEngine, CollaborativeRecommendationEngine) and
+the rating writes of read_write_mysql.py and read_write_neo4j.py, so the
+same workload runs unchanged against either. Writes replay the ratings of a
+CSV file as produced by generate_write_data_for_benchmark.py, in order.
+
+Warmup operations run the same mix but are not measured. Measured
+operations are timed one by one. The report gives, per operation type, the
+count, throughput, mean, p50/p95/p99 and max latency and a latency
+histogram, plus the overall throughput. It is written as JSON and
+optionally appended to a CSV file (one row per operation type), tagged with
+the backend, the subset size and the git revision:
+
+    python -m benchmarks.harness --backend mysql --num-businesses 1000 --workload read_heavy \\
+        --ratings data/benchmark/1k_9000_dummy_ratings.csv --output mysql_read_heavy.json --csv results.csv
+"""
+
+import argparse
+import csv
+import json
+import logging
+import math
+import os
+import random
+import subprocess
+import time
+from collections import defaultdict
+from datetime import datetime
+import pandas as pd
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+###############################################################
+# WORKLOADS
+###############################################################
+
+DEFAULT_WORKLOAD = {
+    'operations': 10000,           # Measured operations
+    'warmup_operations': 500,      # Unmeasured operations run first, same mix
+    'write_ratio': 0.1,            # Share of operations that write a rating
+    'user_distribution': 'recent_writers',  # 'uniform', 'zipf' or 'recent_writers'
+    'zipf_exponent': 1.1,          # Skew of the 'zipf' distribution
+    'categories': 'most_rated',    # 'most_rated' or a list of category names
+    'default_category': 'Restaurant',  # For users without a most rated category
+    'refresh_policy': 'every_n_writes',  # 'every_n_writes', 'end' or 'never'
+    'refresh_every': 100,          # Writes between refreshes for 'every_n_writes'
+    'min_common_items': 3,
+    'min_similarity': 0.3,
+    'limit': 5,                    # Recommendations per request
+    'seed': 12345
+}
+
+# The mixes of the EXPERIMENTS of the read/write benchmarks, plus a skewed read-only one
+WORKLOADS = {
+    'read_heavy': {'write_ratio': 0.1},
+    'balanced': {'write_ratio': 0.5},
+    'write_heavy': {'write_ratio': 0.9},
+    'read_only_zipf': {'write_ratio': 0.0, 'user_distribution': 'zipf', 'refresh_policy': 'never'},
+}
+
+USER_DISTRIBUTIONS = ('uniform', 'zipf', 'recent_writers')
+REFRESH_POLICIES = ('every_n_writes', 'end', 'never')
+
+def resolve_workload(name=None, path=None):
+    """
+    The workload called name in WORKLOADS, or read from the JSON file at
+    path, on top of DEFAULT_WORKLOAD. A file may set 'name'; otherwise the
+    workload is named after name, the file or 'default', in that order.
+    """
+    workload = dict(DEFAULT_WORKLOAD)
+    if name:
+        if name not in WORKLOADS:
+            raise ValueError(f"Unknown workload {name}, expected one of {', '.join(WORKLOADS)}")
+        workload.update(WORKLOADS[name])
+    if path:
+        with open(path) as file:
+            overrides = json.load(file)
+        workload.update(overrides)
+    workload.setdefault('name', name or (path and os.path.splitext(os.path.basename(path))[0]) or 'default')
+
+    unknown = set(workload) - set(DEFAULT_WORKLOAD) - {'name'}
+    if unknown:
+        raise ValueError(f"Unknown workload settings: {', '.join(sorted(unknown))}")
+    if not 0 <= workload['write_ratio'] <= 1:
+        raise ValueError(f"write_ratio must be between 0 and 1, got {workload['write_ratio']}")
+    if workload['user_distribution'] not in USER_DISTRIBUTIONS:
+        raise ValueError(f"user_distribution must be one of {', '.join(USER_DISTRIBUTIONS)}")
+    if workload['refresh_policy'] not in REFRESH_POLICIES:
+        raise ValueError(f"refresh_policy must be one of {', '.join(REFRESH_POLICIES)}")
+    return workload
+
+###############################################################
+# LATENCIES
+###############################################################
+
+# Upper bounds of the histogram buckets in milliseconds; a last bucket takes the rest
+HISTOGRAM_BOUNDS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+def percentile(sorted_values, q):
+    """Nearest-rank percentile q (0-100) of a sorted, non-empty list."""
+    rank = max(1, math.ceil(q / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+def histogram(latencies_ms):
+    counts = [0] * (len(HISTOGRAM_BOUNDS_MS) + 1)
+    for latency in latencies_ms:
+        bucket = 0
+        while bucket < len(HISTOGRAM_BOUNDS_MS) and latency > HISTOGRAM_BOUNDS_MS[bucket]:
+            bucket += 1
+        counts[bucket] += 1
+    bounds = [str(bound) for bound in HISTOGRAM_BOUNDS_MS] + ['inf']
+    return [{'le_ms': bound, 'count': count} for bound, count in zip(bounds, counts)]
+
+class LatencyStats:
+    """Latencies of the measured operations, by operation type."""
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+
+    def record(self, operation, seconds):
+        self.latencies[operation].append(seconds * 1000)
+
+    def summary(self, elapsed):
+        summary = {}
+        for operation, latencies in sorted(self.latencies.items()):
+            ordered = sorted(latencies)
+            summary[operation] = {
+                'count': len(ordered),
+                'throughput': len(ordered) / elapsed if elapsed > 0 else 0,
+                'mean_ms': sum(ordered) / len(ordered),
+                'p50_ms': percentile(ordered, 50),
+                'p95_ms': percentile(ordered, 95),
+                'p99_ms': percentile(ordered, 99),
+                'max_ms': ordered[-1],
+                'histogram': histogram(ordered)
+            }
+        return summary
+
+###############################################################
+# BACKENDS
+###############################################################
+
+class Backend:
+    """
+    The operations a workload runs. Ratings are dicts with the columns of
+    the benchmark ratings files: business, user, rating, timestamp (ms).
+    """
+    name = None
+
+    def write_rating(self, rating):
+        """Writes one rating, replacing an earlier rating of the same pair."""
+        raise NotImplementedError
+
+    def most_rated_category(self, user_id):
+        """The category the user rated most, or None."""
+        raise NotImplementedError
+
+    def recommend(self, user_id, category, limit):
+        """Returns (recommendations, whether they came from the fallback)."""
+        raise NotImplementedError
+
+    def refresh_similarities(self, user_ids, min_common_items, min_similarity):
+        """Recomputes the similarities of user_ids."""
+        raise NotImplementedError
+
+    def retries(self):
+        """Transaction attempts repeated after transient failures so far."""
+        return 0
+
+    def options(self):
+        """Backend settings recorded in the report."""
+        return {}
+
+    def close(self):
+        pass
+
+class MySQLBackend(Backend):
+    name = 'mysql'
+
+    # Deadlocks and lock wait timeouts roll the transaction back; the write is retried
+    RETRYABLE_ERRORS = (1213, 1205)
+    MAX_WRITE_ATTEMPTS = 3
+
+    def __init__(self, num_businesses, use_neighbor_tables=False):
+        import mysql.connector
+        from app.recommender import get_db_connection, MySQLRecommendationEngine
+        from benchmarks import read_write_mysql
+        from database.mysql.ratings import USER_INSERT_QUERY, ratings_partitioned, write_ratings
+
+        self.error_type = mysql.connector.Error
+        self.read_write = read_write_mysql
+        self.write_ratings = write_ratings
+        self.user_insert_query = USER_INSERT_QUERY
+        self.use_neighbor_tables = use_neighbor_tables
+        self.write_retries = 0
+        self.conn = get_db_connection(num_businesses)
+        self.engine = MySQLRecommendationEngine(self.conn, use_neighbor_tables=use_neighbor_tables)
+        cur = self.conn.cursor()
+        self.partitioned = ratings_partitioned(cur)
+        cur.close()
+
+    def write_rating(self, rating):
+        timestamp = datetime.utcfromtimestamp(rating['timestamp'] / 1000.0).strftime('%Y-%m-%d %H:%M:%S')
+        row = (rating['business'], rating['user'], rating['rating'], timestamp)
+        for attempt in range(1, self.MAX_WRITE_ATTEMPTS + 1):
+            cur = self.conn.cursor()
+            try:
+                cur.execute(self.user_insert_query, (rating['user'],))
+                self.write_ratings(cur, [row], self.partitioned)
+                self.conn.commit()
+                return
+            except self.error_type as e:
+                self.conn.rollback()
+                if e.errno not in self.RETRYABLE_ERRORS or attempt == self.MAX_WRITE_ATTEMPTS:
+                    raise
+                self.write_retries += 1
+            finally:
+                cur.close()
+
+    def most_rated_category(self, user_id):
+        return self.read_write.get_most_rated_category(self.conn, user_id)
+
+    def recommend(self, user_id, category, limit):
+        results = self.engine._fetch_recommendations_user(user_id, category, limit)
+        if results:
+            return results, False
+        return self.engine._fetch_fallback_recommendations(category, limit), True
+
+    def refresh_similarities(self, user_ids, min_common_items, min_similarity):
+        self.read_write.calculate_similarity_for_affected_users(
+            list(user_ids), min_common_items, min_similarity,
+            neighbors=self.use_neighbor_tables, connection=self.conn
+        )
+
+    def retries(self):
+        return self.write_retries
+
+    def options(self):
+        return {'partitioned_ratings': self.partitioned, 'neighbor_tables': self.use_neighbor_tables}
+
+    def close(self):
+        self.conn.close()
+
+class Neo4jBackend(Backend):
+    """
+    Rating writes run as managed transactions, which the driver retries on
+    transient failures such as deadlocks; retries() counts those attempts.
+    """
+    name = 'neo4j'
+
+    def __init__(self, uri, user, password, cached=False, use_category_labels=False):
+        from app.collaborative_recommendation_engine import CollaborativeRecommendationEngine
+        from database.neo4j.neo4j_connection import Neo4jConnection
+        from database.neo4j.similarity_calculator_cached import SimilarityCalculatorCached
+        from database.neo4j.similarity_calculator_no_cache import SimilarityCalculatorNoCache
+        from benchmarks import read_write_neo4j
+
+        self.read_write = read_write_neo4j
+        self.cached = cached
+        self.use_category_labels = use_category_labels
+        self.conn = Neo4jConnection(uri=uri, user=user, password=password)
+        self.engine = CollaborativeRecommendationEngine(self.conn, use_category_labels=use_category_labels)
+        self.calculator = SimilarityCalculatorCached(self.conn) if cached else SimilarityCalculatorNoCache(self.conn)
+
+    def write_rating(self, rating):
+        self.conn.execute_write(self.read_write.RATING_WRITE_QUERY, self.read_write.rating_write_params(rating))
+        if self.cached:
+            self.calculator.record_rating(rating['user'], rating['business'], rating['rating'])
+
+    def most_rated_category(self, user_id):
+        return self.read_write.get_most_rated_category(self.conn, user_id)
+
+    def recommend(self, user_id, category, limit):
+        results = self.engine._fetch_recommendations_user(user_id, category, limit)
+        if results:
+            return results, False
+        return self.engine._fetch_fallback_recommendations(category, limit), True
+
+    def refresh_similarities(self, user_ids, min_common_items, min_similarity):
+        self.calculator.update_user_similarity(
+            affected_users=list(user_ids),
+            min_common_items=min_common_items,
+            min_similarity=min_similarity
+        )
+
+    def retries(self):
+        return self.conn.retries
+
+    def options(self):
+        return {'cached': self.cached, 'category_labels': self.use_category_labels}
+
+    def close(self):
+        self.conn.close()
+
+###############################################################
+# WORKLOAD RUNNER
+###############################################################
+
+class UserSelector:
+    """Picks the user of each recommendation according to the workload's distribution."""
+
+    def __init__(self, user_ids, workload, rng):
+        self.rng = rng
+        self.distribution = workload['user_distribution']
+        self.user_ids = sorted(user_ids)
+        rng.shuffle(self.user_ids)  # Random popularity ranks for 'zipf'
+        self.weights = None
+        if self.distribution == 'zipf':
+            exponent = workload['zipf_exponent']
+            self.weights = [1 / rank ** exponent for rank in range(1, len(self.user_ids) + 1)]
+
+    def pick(self, recent_writers):
+        if self.distribution == 'recent_writers' and recent_writers:
+            return self.rng.choice(sorted(recent_writers))
+        if self.weights:
+            return self.rng.choices(self.user_ids, weights=self.weights)[0]
+        return self.rng.choice(self.user_ids)
+
+class WorkloadRunner:
+    def __init__(self, backend, workload, ratings):
+        if not ratings:
+            raise ValueError("The ratings file is empty")
+        self.backend = backend
+        self.workload = workload
+        self.ratings = ratings
+        self.rng = random.Random(workload['seed'])
+        self.users = UserSelector({rating['user'] for rating in ratings}, workload, self.rng)
+        self.stats = None
+        self.writes = 0
+        self.fallbacks = 0
+        self.affected_users = set()
+
+    def _timed(self, operation, call):
+        start_time = time.perf_counter()
+        result = call()
+        if self.stats is not None:
+            self.stats.record(operation, time.perf_counter() - start_time)
+        return result
+
+    def _category(self, user_id):
+        categories = self.workload['categories']
+        if categories == 'most_rated':
+            category = self._timed('most_rated_category', lambda: self.backend.most_rated_category(user_id))
+            return category or self.workload['default_category']
+        return self.rng.choice(categories)
+
+    def _refresh(self):
+        if self.affected_users:
+            users = sorted(self.affected_users)
+            self._timed('refresh_similarities', lambda: self.backend.refresh_similarities(
+                users, self.workload['min_common_items'], self.workload['min_similarity']))
+            self.affected_users = set()
+
+    def _write(self):
+        if self.writes == len(self.ratings):
+            logger.warning(f"All {len(self.ratings)} ratings written, replaying them from the start")
+        rating = self.ratings[self.writes % len(self.ratings)]
+        self._timed('write_rating', lambda: self.backend.write_rating(rating))
+        self.writes += 1
+        self.affected_users.add(rating['user'])
+
+        if (self.workload['refresh_policy'] == 'every_n_writes'
+                and self.writes % self.workload['refresh_every'] == 0):
+            self._refresh()
+
+    def _recommend(self):
+        user_id = self.users.pick(self.affected_users)
+        category = self._category(user_id)
+        _, fallback = self._timed('recommend', lambda: self.backend.recommend(user_id, category, self.workload['limit']))
+        if fallback and self.stats is not None:
+            self.fallbacks += 1
+
+    def run_operation(self):
+        """Runs one operation of the mix: a write or a recommendation."""
+        if self.rng.random() < self.workload['write_ratio']:
+            self._write()
+        else:
+            self._recommend()
+
+    def _run_operations(self, count, phase):
+        progress_every = max(1, count // 10)
+        for i in range(count):
+            self.run_operation()
+            if (i + 1) % progress_every == 0:
+                logger.info(f"{phase}: {i + 1}/{count} operations")
+
+    def run(self):
+        """Runs the warmup and measured phases and returns the report."""
+        self._run_operations(self.workload['warmup_operations'], "Warmup")
+
+        self.stats = LatencyStats()
+        start_time = time.perf_counter()
+        self._run_operations(self.workload['operations'], "Measured")
+        if self.workload['refresh_policy'] == 'end':
+            self._refresh()
+        elapsed = time.perf_counter() - start_time
+
+        return {
+            'elapsed_seconds': elapsed,
+            'operations': self.workload['operations'],
+            'throughput': self.workload['operations'] / elapsed if elapsed > 0 else 0,
+            'fallbacks': self.fallbacks,
+            'latencies': self.stats.summary(elapsed)
+        }
+
+###############################################################
+# RESULTS
+###############################################################
+
+CSV_COLUMNS = ('started_at', 'backend', 'num_businesses', 'git_revision', 'workload', 'operation',
+               'count', 'throughput', 'mean_ms', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms')
+
+def git_revision():
+    """The checked out commit, suffixed with -dirty if tracked files are modified."""
+    def git(*args):
+        result = subprocess.run(['git', *args], capture_output=True, text=True, check=False)
+        return result.stdout.strip() if result.returncode == 0 else None
+
+    revision = git('rev-parse', '--short', 'HEAD')
+    if revision is None:
+        return 'unknown'
+    return revision + ('-dirty' if git('status', '--porcelain', '--untracked-files=no') else '')
+
+def write_csv(report, path):
+    """Appends one row per operation type of report to the CSV file at path."""
+    new_file = not os.path.exists(path)
+    with open(path, 'a', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=CSV_COLUMNS)
+        if new_file:
+            writer.writeheader()
+        for operation, latency in report['latencies'].items():
+            writer.writerow({
+                'started_at': report['started_at'],
+                'backend': report['backend'],
+                'num_businesses': report['num_businesses'],
+                'git_revision': report['git_revision'],
+                'workload': report['workload']['name'],
+                'operation': operation,
+                **{column: latency[column] for column in CSV_COLUMNS[6:]}
+            })
+
+def print_report(report):
+    print(f"{report['backend']} ({report['num_businesses']} businesses, {report['git_revision']}), "
+          f"workload {report['workload']['name']}: {report['operations']} operations in "
+          f"{report['elapsed_seconds']:.2f} s ({report['throughput']:.1f} ops/s), "
+          f"{report['fallbacks']} fallback recommendations")
+    print(f"{'operation':<24} {'count':>7} {'ops/s':>9} {'mean ms':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for operation, latency in report['latencies'].items():
+        print(f"{operation:<24} {latency['count']:>7} {latency['throughput']:>9.1f} {latency['mean_ms']:>9.2f} "
+              f"{latency['p50_ms']:>9.2f} {latency['p95_ms']:>9.2f} {latency['p99_ms']:>9.2f} {latency['max_ms']:>9.2f}")
+
+###############################################################
+# MAIN
+###############################################################
+
+def create_backend(args):
+    if args.backend == 'mysql':
+        return MySQLBackend(args.num_businesses, use_neighbor_tables=args.neighbor_tables)
+    return Neo4jBackend(args.uri, args.user, args.password, cached=args.cached,
+                        use_category_labels=args.category_labels)
+
+def main(args):
+    workload = resolve_workload(args.workload, args.workload_file)
+    ratings = pd.read_csv(args.ratings).to_dict(orient='records')
+    started_at = datetime.now().isoformat(timespec='seconds')
+
+    backend = create_backend(args)
+    try:
+        logger.info(f"Running workload {workload['name']} against {backend.name}")
+        results = WorkloadRunner(backend, workload, ratings).run()
+        options = backend.options()
+    finally:
+        backend.close()
+
+    report = {
+        'started_at': started_at,
+        'backend': backend.name,
+        'num_businesses': args.num_businesses,
+        'git_revision': git_revision(),
+        'workload': workload,
+        'backend_options': options,
+        'ratings_file': args.ratings,
+        **results
+    }
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=2)
+    if args.csv:
+        write_csv(report, args.csv)
+    print_report(report)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run a read/write workload against MySQL or Neo4j')
+    parser.add_argument('--backend', choices=('mysql', 'neo4j'), required=True)
+    parser.add_argument('--num-businesses', type=int, default=1000,
+                      help='Size of the loaded subset (selects the MySQL database, tags the results)')
+    parser.add_argument('--workload', choices=sorted(WORKLOADS),
+                      help='Named workload (defaults to DEFAULT_WORKLOAD)')
+    parser.add_argument('--workload-file', type=str,
+                      help='JSON file with workload settings, applied on top of --workload')
+    parser.add_argument('--ratings', type=str, required=True,
+                      help='Ratings CSV whose rows are written, in order')
+    parser.add_argument('--output', type=str, required=True,
+                      help='Path of the JSON report')
+    parser.add_argument('--csv', type=str,
+                      help='CSV file to append one row per operation type to')
+    parser.add_argument('--neighbor-tables', action='store_true',
+                      help='MySQL: read and update the user/business neighbor tables')
+    parser.add_argument('--cached', action='store_true',
+                      help='Neo4j: use the caching similarity calculator')
+    parser.add_argument('--category-labels', action='store_true',
+                      help='Neo4j: filter categories by Cat_<name> labels')
+    parser.add_argument('--uri', type=str, default='neo4j://localhost:7687')
+    parser.add_argument('--user', type=str, default='neo4j')
+    parser.add_argument('--password', type=str, default='neo4j@1234')
+
+    main(parser.parse_args())
@@ -0,0 +1,298 @@
+"""
+Concurrent multi-client load generator for the MySQL and Neo4j backends.
+
+harness.py runs a workload from a single client, so it shows how fast each
+operation is but not how the backends behave under contention. This script
+runs the same workloads from N concurrent clients, each a WorkloadRunner
+with its own Backend (its own connection) and its own disjoint slice of the
+ratings, so concurrent writes do not replay the same rows. Clients run as
+threads, or as processes with --processes when the client side itself
+should not share one interpreter.
+
+Two load models are supported:
+
+* closed loop (the default): every client issues its next operation as soon
+  as the previous one completes, after an optional --think-time. Throughput
+  is whatever the backend sustains; latency is the time of each operation.
+* open loop (--rate): operations arrive at a fixed total rate, split evenly
+  across the clients, with exponential inter-arrival times. Latency is
+  measured from the scheduled arrival, so time spent waiting behind a
+  slow operation is included and an overloaded backend shows up as growing
+  tail latency rather than as a lower request rate.
+
+Every level of --clients runs for --warmup unmeasured seconds and then for
+--duration measured seconds. Failed operations are counted by exception
+type and the run goes on; transaction retries are counted separately
+(deadlocks and lock wait timeouts for MySQL writes, transient failures
+retried by the Neo4j driver). The report gives, per concurrency level, the
+throughput, p50/p95/p99 latency, errors and retries, plus the per-operation
+latencies of harness.py. It is written as JSON and optionally appended to a
+CSV file (one row per level), tagged like the harness results:
+
+    python -m benchmarks.load_generator --backend mysql --num-businesses 1000 --workload balanced \\
+        --ratings data/benchmark/1k_9000_dummy_ratings.csv --clients 1 2 4 8 16 \\
+        --duration 60 --output mysql_balanced_load.json --csv load.csv
+"""
+
+import argparse
+import csv
+import json
+import logging
+import os
+import random
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
+import pandas as pd
+
+from benchmarks.harness import (WORKLOADS, LatencyStats, WorkloadRunner, create_backend, git_revision,
+                                percentile, resolve_workload)
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Seconds between the submission of the clients and their common start, so
+# that all of them have connected before the first operation
+START_DELAY = 2.0
+
+###############################################################
+# CLIENTS
+###############################################################
+
+def client_workload(workload, index):
+    """The workload of client index: same mix, its own random sequence."""
+    return dict(workload, seed=workload['seed'] + index)
+
+def wait_until(deadline):
+    delay = deadline - time.perf_counter()
+    if delay > 0:
+        time.sleep(delay)
+
+def run_client(index, args, workload, ratings, start_at):
+    """
+    Runs one client from the wall-clock time start_at until the end of the
+    measured phase and returns its raw results. Module-level (and returning
+    plain data) so that it can run in a worker process.
+    """
+    backend = create_backend(args)
+    try:
+        runner = WorkloadRunner(backend, client_workload(workload, index), ratings)
+        rng = random.Random(workload['seed'] + index)
+        rate = args.rate / args.clients if args.rate else None
+
+        # Wall-clock start shared across processes, tracked with perf_counter
+        start = time.perf_counter() + (start_at - time.time())
+        measure_from = start + args.warmup
+        end = measure_from + args.duration
+
+        wait_until(start)
+        scheduled = start
+        response_ms = []
+        errors = Counter()
+        operations = 0
+        retries_before = None
+        while True:
+            if rate:
+                scheduled += rng.expovariate(rate)
+                wait_until(scheduled)
+                arrival = scheduled
+            else:
+                arrival = time.perf_counter()
+            if arrival >= end:
+                break
+
+            measured = arrival >= measure_from
+            if measured and runner.stats is None:
+                runner.stats = LatencyStats()
+                retries_before = backend.retries()
+            try:
+                runner.run_operation()
+            except Exception as e:
+                if measured:
+                    errors[type(e).__name__] += 1
+                logger.debug(f"Client {index}: {type(e).__name__}: {e}")
+                continue
+            if measured:
+                response_ms.append((time.perf_counter() - arrival) * 1000)
+                operations += 1
+            if args.think_time and not rate:
+                time.sleep(args.think_time)
+
+        return {
+            'operations': operations,
+            'response_ms': response_ms,
+            'latencies': dict(runner.stats.latencies) if runner.stats else {},
+            'errors': dict(errors),
+            'retries': backend.retries() - retries_before if retries_before is not None else 0,
+            'fallbacks': runner.fallbacks,
+            'options': backend.options()
+        }
+    finally:
+        backend.close()
+
+###############################################################
+# CONCURRENCY LEVELS
+###############################################################
+
+def run_level(args, workload, ratings):
+    """Runs args.clients clients at once and merges their results."""
+    slices = [ratings[i::args.clients] for i in range(args.clients)]
+    if not all(slices):
+        raise ValueError(f"{len(ratings)} ratings cannot be split across {args.clients} clients")
+
+    start_at = time.time() + START_DELAY
+    executor_type = ProcessPoolExecutor if args.processes else ThreadPoolExecutor
+    with executor_type(max_workers=args.clients) as executor:
+        futures = [executor.submit(run_client, i, args, workload, slices[i], start_at)
+                   for i in range(args.clients)]
+        clients = [future.result() for future in futures]
+
+    stats = LatencyStats()
+    for client in clients:
+        for operation, latencies in client['latencies'].items():
+            stats.latencies[operation].extend(latencies)
+    response_ms = sorted(latency for client in clients for latency in client['response_ms'])
+    operations = sum(client['operations'] for client in clients)
+    errors = sum((Counter(client['errors']) for client in clients), Counter())
+
+    level = {
+        'clients': args.clients,
+        'offered_rate': args.rate,
+        'operations': operations,
+        'throughput': operations / args.duration,
+        'errors': sum(errors.values()),
+        'errors_by_type': dict(errors),
+        'retries': sum(client['retries'] for client in clients),
+        'fallbacks': sum(client['fallbacks'] for client in clients),
+        'backend_options': clients[0]['options'],
+        'latencies': stats.summary(args.duration)
+    }
+    if response_ms:
+        level.update({
+            'mean_ms': sum(response_ms) / len(response_ms),
+            'p50_ms': percentile(response_ms, 50),
+            'p95_ms': percentile(response_ms, 95),
+            'p99_ms': percentile(response_ms, 99),
+            'max_ms': response_ms[-1]
+        })
+    return level
+
+###############################################################
+# RESULTS
+###############################################################
+
+CSV_COLUMNS = ('started_at', 'backend', 'num_businesses', 'git_revision', 'workload', 'mode', 'clients',
+               'offered_rate', 'operations', 'throughput', 'errors', 'retries',
+               'mean_ms', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms')
+
+def write_csv(report, path):
+    new_file = not os.path.exists(path)
+    with open(path, 'a', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=CSV_COLUMNS)
+        if new_file:
+            writer.writeheader()
+        for level in report['levels']:
+            writer.writerow({
+                'started_at': report['started_at'],
+                'backend': report['backend'],
+                'num_businesses': report['num_businesses'],
+                'git_revision': report['git_revision'],
+                'workload': report['workload']['name'],
+                'mode': report['mode'],
+                **{column: level.get(column) for column in CSV_COLUMNS[7:]}
+            })
+
+def print_report(report):
+    print(f"{report['backend']} ({report['num_businesses']} businesses, {report['git_revision']}), "
+          f"workload {report['workload']['name']}, {report['mode']} loop, "
+          f"{report['duration_seconds']:.0f} s per level")
+    print(f"{'clients':>7} {'ops':>8} {'ops/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'errors':>7} {'retries':>8}")
+    for level in report['levels']:
+        if 'p50_ms' not in level:
+            print(f"{level['clients']:>7} {0:>8} {0:>9.1f} {'-':>9} {'-':>9} {'-':>9} "
+                  f"{level['errors']:>7} {level['retries']:>8}")
+            continue
+        print(f"{level['clients']:>7} {level['operations']:>8} {level['throughput']:>9.1f} {level['p50_ms']:>9.2f} "
+              f"{level['p95_ms']:>9.2f} {level['p99_ms']:>9.2f} {level['errors']:>7} {level['retries']:>8}")
+
+###############################################################
+# MAIN
+###############################################################
+
+def main(args):
+    workload = resolve_workload(args.workload, args.workload_file)
+    ratings = pd.read_csv(args.ratings).to_dict(orient='records')
+    started_at = datetime.now().isoformat(timespec='seconds')
+
+    levels = []
+    for clients in args.clients:
+        logger.info(f"Running {clients} {'processes' if args.processes else 'threads'} against {args.backend}")
+        levels.append(run_level(argparse.Namespace(**dict(vars(args), clients=clients)), workload, ratings))
+
+    report = {
+        'started_at': started_at,
+        'backend': args.backend,
+        'num_businesses': args.num_businesses,
+        'git_revision': git_revision(),
+        'workload': workload,
+        'mode': 'open' if args.rate else 'closed',
+        'offered_rate': args.rate,
+        'think_time': args.think_time,
+        'client_type': 'process' if args.processes else 'thread',
+        'warmup_seconds': args.warmup,
+        'duration_seconds': args.duration,
+        'ratings_file': args.ratings,
+        'levels': levels
+    }
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=2)
+    if args.csv:
+        write_csv(report, args.csv)
+    print_report(report)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run a workload from concurrent clients against MySQL or Neo4j')
+    parser.add_argument('--backend', choices=('mysql', 'neo4j'), required=True)
+    parser.add_argument('--num-businesses', type=int, default=1000,
+                      help='Size of the loaded subset (selects the MySQL database, tags the results)')
+    parser.add_argument('--workload', choices=sorted(WORKLOADS),
+                      help='Named workload of harness.py (defaults to DEFAULT_WORKLOAD)')
+    parser.add_argument('--workload-file', type=str,
+                      help='JSON file with workload settings, applied on top of --workload')
+    parser.add_argument('--ratings', type=str, required=True,
+                      help='Ratings CSV whose rows are split across the clients and written')
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 2, 4, 8],
+                      help='Concurrency levels to run, one after the other')
+    parser.add_argument('--processes', action='store_true',
+                      help='Run the clients as processes instead of threads')
+    parser.add_argument('--rate', type=float,
+                      help='Open loop: total operations per second across all clients')
+    parser.add_argument('--think-time', type=float, default=0.0,
+                      help='Closed loop: seconds each client waits between operations')
+    parser.add_argument('--warmup', type=float, default=10.0,
+                      help='Unmeasured seconds at the start of each level')
+    parser.add_argument('--duration', type=float, default=60.0,
+                      help='Measured seconds of each level')
+    parser.add_argument('--output', type=str, required=True,
+                      help='Path of the JSON report')
+    parser.add_argument('--csv', type=str,
+                      help='CSV file to append one row per concurrency level to')
+    parser.add_argument('--neighbor-tables', action='store_true',
+                      help='MySQL: read and update the user/business neighbor tables')
+    parser.add_argument('--cached', action='store_true',
+                      help='Neo4j: use the caching similarity calculator (single client only)')
+    parser.add_argument('--category-labels', action='store_true',
+                      help='Neo4j: filter categories by Cat_<name> labels')
+    parser.add_argument('--uri', type=str, default='bolt://localhost:7687')
+    parser.add_argument('--user', type=str, default='neo4j')
+    parser.add_argument('--password', type=str, default='neo4j@1234')
+    args = parser.parse_args()
+    if args.rate is not None and args.rate <= 0:
+        parser.error('--rate must be positive')
+    if min(args.clients) < 1:
+        parser.error('--clients must be at least 1')
+    if args.cached and max(args.clients) > 1:
+        # Each client's caches would miss the ratings written by the others
+        parser.error('--cached only supports --clients 1')
+    main(args)
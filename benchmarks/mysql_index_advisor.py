@@ -0,0 +1,522 @@
+"""
+Index advisor for the MySQL schema, driven by EXPLAIN ANALYZE.
+
+Runs every SQL statement of app/recommender.py, database/mysql/similarity.py
+and benchmarks/read_write_mysql.py against a scratch copy of a loaded
+subset (cs6400_<num_businesses>). Real users are sampled, each with the
+category they rated most. The advisor then:
+
+1. runs every read statement under EXPLAIN ANALYZE and flags full table
+   scans, full index scans, non-covering index lookups, filesorts and
+   temporary tables;
+2. proposes a covering index for every base table that is scanned or looked
+   up without a covering index. Its columns are the table's columns
+   compared to constants, then its join columns, then range columns, then
+   the other columns the statement reads. Proposals that an existing index
+   already covers are dropped;
+3. applies the proposals to the scratch copy and measures every statement
+   again, reads and writes, so the report shows both what the indexes save
+   and what they cost the writes.
+
+Statements built inside functions are captured by calling those functions
+with a StatementRecorder in place of the connection. Writes are rolled
+back. The source database is only read. The scratch copy is dropped
+afterwards unless --keep-scratch is given.
+
+    python -m benchmarks.mysql_index_advisor --num-businesses 1000 --output advisor.json
+"""
+
+import argparse
+import json
+import logging
+import random
+import re
+import statistics
+import time
+from datetime import datetime
+import mysql.connector
+from app.recommender import MySQLRecommendationEngine
+from database.mysql import similarity
+from database.mysql.ratings import (USER_INSERT_QUERY, RATING_UPSERT_QUERY, USER_STATS_QUERY,
+                                    restrict_to_window, refresh_user_stats)
+from benchmarks import read_write_mysql
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+BASE_TABLES = ('businesses', 'users', 'ratings', 'user_stats', 'business_categories', 'user_similarity',
+               'business_similarity', 'user_neighbors', 'business_neighbors')
+MAX_INDEX_COLUMNS = 5
+
+SAMPLE_USERS_QUERY = """
+SELECT user_id
+FROM ratings
+GROUP BY user_id
+HAVING COUNT(*) >= %s
+ORDER BY user_id
+LIMIT %s;
+"""
+
+USER_RATING_QUERY = """
+SELECT business_id, user_id, rating, timestamp
+FROM ratings
+WHERE user_id = %s
+ORDER BY business_id
+LIMIT 1;
+"""
+
+EXISTING_INDEXES_QUERY = """
+SELECT TABLE_NAME, INDEX_NAME, COLUMN_NAME
+FROM information_schema.STATISTICS
+WHERE TABLE_SCHEMA = %s
+ORDER BY TABLE_NAME, INDEX_NAME, SEQ_IN_INDEX;
+"""
+
+# Plan lines of EXPLAIN ANALYZE (FORMAT=TREE) worth flagging
+PLAN_FLAGS = [
+    ('full_scan', re.compile(r"Table scan on (?P<alias>\w+)")),
+    ('full_index_scan', re.compile(r"Index scan on (?P<alias>\w+) using (?P<index>\w+)")),
+    # "Covering index lookup" and "Single-row index lookup" are fine
+    ('non_covering_lookup', re.compile(r"-> Index lookup on (?P<alias>\w+) using (?P<index>\w+)")),
+    ('filesort', re.compile(r"-> Sort")),
+    ('temporary_table', re.compile(r"Temporary table"))
+]
+ACTUAL_ROWS = re.compile(r"actual time=[\d.]+\.\.[\d.]+ rows=(?P<rows>[\d.e+]+)")
+
+SQL_KEYWORDS = {'ON', 'WHERE', 'JOIN', 'LEFT', 'RIGHT', 'INNER', 'GROUP', 'ORDER', 'HAVING', 'LIMIT', 'UNION', 'USING'}
+TABLE_REFERENCE = re.compile(r"\b(?:FROM|JOIN)\s+(\w+)(?:\s+(?:AS\s+)?(\w+))?", re.IGNORECASE)
+CONSTANT_PREDICATE = re.compile(r"\b(\w+)\.(\w+)\s*(=|!=|<>|<=|>=|<|>)\s*%s")
+JOIN_PREDICATE = re.compile(r"\b(\w+)\.(\w+)\s*(=|!=|<>|<=|>=|<|>)\s*(\w+)\.(\w+)")
+SUBQUERY_PREDICATE = re.compile(r"\b(\w+)\.(\w+)\s+(?:NOT\s+)?IN\s*\(", re.IGNORECASE)
+COLUMN_REFERENCE = re.compile(r"\b(\w+)\.(\w+)\b")
+
+class StatementRecorder:
+    """
+    Stands in for a mysql.connector connection (and its cursors) and
+    records the statements it is given instead of running them. Every
+    statement returns no rows.
+    """
+
+    def __init__(self):
+        self.statements = []
+
+    def cursor(self, *args, **kwargs):
+        return self
+
+    def execute(self, query, params=None):
+        self.statements.append((query, tuple(params or ())))
+
+    def executemany(self, query, seq_params):
+        for params in seq_params:
+            self.execute(query, params)
+
+    def fetchall(self):
+        return []
+
+    def fetchone(self):
+        return None
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+def recorded(call):
+    """The (query, params) pairs call(recorder) sends to the connection."""
+    recorder = StatementRecorder()
+    call(recorder)
+    return recorder.statements
+
+def _strip_comments(query):
+    return "\n".join(line.split("--")[0] for line in query.splitlines())
+
+def is_read(query):
+    words = _strip_comments(query).split()
+    return bool(words) and words[0].upper() in ('SELECT', 'WITH')
+
+###############################################################
+# SAMPLE AND STATEMENTS
+###############################################################
+
+def sample_data(conn, num_users=20, min_ratings=3, seed=12345, candidates=10000):
+    """Samples users, the category each of them rated most, and one rating per user."""
+    cur = conn.cursor()
+    cur.execute(SAMPLE_USERS_QUERY, (min_ratings, candidates))
+    user_ids = [row[0] for row in cur.fetchall()]
+    user_ids = sorted(random.Random(seed).sample(user_ids, min(num_users, len(user_ids))))
+
+    users = []
+    ratings = []
+    for user_id in user_ids:
+        category = read_write_mysql.get_most_rated_category(conn, user_id)
+        if category:
+            users.append([user_id, category])
+        cur.execute(USER_RATING_QUERY, (user_id,))
+        ratings.extend([business_id, user, rating, str(timestamp)]
+                       for business_id, user, rating, timestamp in cur.fetchall())
+    cur.close()
+    logger.info(f"Sampled {len(users)} users and {len(ratings)} ratings")
+    return {'users': users, 'ratings': ratings}
+
+def statement_cases(sample, min_common_items=3):
+    """
+    Returns {name: [(query, params), ...]}: every analyzed statement with
+    one parameter set per sampled item.
+    """
+    cases = {}
+    def add(name, query, params):
+        cases.setdefault(name, []).append((query, tuple(params)))
+    def add_recorded(name, call, merge=False):
+        # merge keeps statements repeated per row (executemany) as one case
+        statements = recorded(call)
+        for i, (query, params) in enumerate(statements):
+            add(name if merge or len(statements) == 1 else f"{name}[{i}]", query, params)
+
+    for user_id, category in sample['users']:
+        add_recorded("recommender.recommendations",
+                     lambda r: MySQLRecommendationEngine(r)._fetch_recommendations(user_id, category, 10))
+        add_recorded("recommender.fallback",
+                     lambda r: MySQLRecommendationEngine(r)._fetch_fallback_recommendations(category, 10))
+        add_recorded("recommender.user_similarity",
+                     lambda r: MySQLRecommendationEngine(r)._fetch_recommendations_user(user_id, category, 10))
+        add_recorded("recommender.user_business_similarity",
+                     lambda r: MySQLRecommendationEngine(r)._fetch_recommendations_user_business(user_id, category, 10))
+        add_recorded("recommender.user_neighbors",
+                     lambda r: MySQLRecommendationEngine(r, use_neighbor_tables=True)
+                     ._fetch_recommendations_user(user_id, category, 10))
+        add_recorded("recommender.user_business_neighbors",
+                     lambda r: MySQLRecommendationEngine(r, use_neighbor_tables=True)
+                     ._fetch_recommendations_user_business(user_id, category, 10))
+
+        add("similarity.user_pairs", restrict_to_window(similarity.USER_PAIRS_QUERY), (user_id, min_common_items))
+        add("ratings.user_stats", USER_STATS_QUERY, (user_id,))
+
+        add_recorded("benchmark.most_rated_category",
+                     lambda r: read_write_mysql.get_most_rated_category(r, user_id))
+        add_recorded("benchmark.fallback",
+                     lambda r: read_write_mysql._fetch_fallback_recommendations(r, category, 5))
+        add_recorded("benchmark.user_similarity",
+                     lambda r: read_write_mysql._fetch_recommendations_user(r, user_id, category, 5))
+        add_recorded("benchmark.user_pairs",
+                     lambda r: read_write_mysql.fetch_user_pairs(r, user_id, min_common_items))
+
+    add("similarity.active_users", similarity.ACTIVE_USERS_QUERY, (min_common_items,))
+    add("similarity.windowed_active_users", restrict_to_window(similarity.WINDOWED_ACTIVE_USERS_QUERY),
+        (min_common_items, min_common_items))
+    add("similarity.businesses_with_categories", similarity.BUSINESSES_WITH_CATEGORIES_QUERY, ())
+
+    # Writes of the benchmark: re-written ratings and similarities between
+    # neighboring sampled users
+    user_ids = sorted(user_id for user_id, _ in sample['users'])
+    now = int(datetime.now().timestamp() * 1000)
+    add_recorded("benchmark.insert_similarities", lambda r: read_write_mysql.insert_similarities(r, [{
+        'user1_id': user1_id,
+        'user2_id': user2_id,
+        'similarity': 0.5,
+        'common_items': min_common_items,
+        'last_updated': now
+    } for user1_id, user2_id in zip(user_ids, user_ids[1:])]), merge=True)
+    for business_id, user_id, rating, timestamp in sample['ratings']:
+        add("benchmark.insert_user", USER_INSERT_QUERY, (user_id,))
+        add("benchmark.upsert_rating", RATING_UPSERT_QUERY, (business_id, user_id, rating, timestamp))
+        add_recorded("benchmark.refresh_user_stats", lambda r: refresh_user_stats(r, [user_id]))
+    return cases
+
+###############################################################
+# SCRATCH COPY
+###############################################################
+
+def create_scratch_copy(conn, source, scratch):
+    """Copies the tables of source into a fresh scratch database and switches conn to it."""
+    cur = conn.cursor()
+    cur.execute("SELECT TABLE_NAME FROM information_schema.TABLES WHERE TABLE_SCHEMA = %s", (source,))
+    existing = {row[0] for row in cur.fetchall()}
+
+    cur.execute(f"DROP DATABASE IF EXISTS {scratch}")
+    cur.execute(f"CREATE DATABASE {scratch}")
+    for table in BASE_TABLES:
+        if table not in existing:
+            continue
+        start_time = time.time()
+        cur.execute(f"CREATE TABLE {scratch}.{table} LIKE {source}.{table}")
+        cur.execute(f"INSERT INTO {scratch}.{table} SELECT * FROM {source}.{table}")
+        conn.commit()
+        logger.info(f"Copied {cur.rowcount} rows of {table} in {time.time() - start_time:.2f} seconds")
+
+    conn.database = scratch
+    analyze_tables(conn)
+    cur.close()
+
+def analyze_tables(conn):
+    """Refreshes the optimizer statistics of the base tables."""
+    cur = conn.cursor()
+    for table in BASE_TABLES:
+        try:
+            cur.execute(f"ANALYZE TABLE {table}")
+            cur.fetchall()
+        except mysql.connector.Error:
+            pass
+    cur.close()
+
+def existing_indexes(conn, database):
+    """{table: [column tuple of every index]}"""
+    cur = conn.cursor()
+    cur.execute(EXISTING_INDEXES_QUERY, (database,))
+    indexes = {}
+    for table, index, column in cur.fetchall():
+        indexes.setdefault(table, {}).setdefault(index, []).append(column)
+    cur.close()
+    return {table: [tuple(columns) for columns in by_name.values()] for table, by_name in indexes.items()}
+
+###############################################################
+# ANALYSIS
+###############################################################
+
+def explain_analyze(conn, query, params):
+    cur = conn.cursor()
+    cur.execute("EXPLAIN ANALYZE " + query, params)
+    plan = "\n".join(row[0] for row in cur.fetchall())
+    cur.close()
+    return plan
+
+def plan_flags(plan, aliases):
+    """Flagged plan lines. Scans of CTEs and derived tables are not flagged."""
+    flags = []
+    for line in plan.splitlines():
+        for kind, pattern in PLAN_FLAGS:
+            match = pattern.search(line)
+            if match is None:
+                continue
+            alias = match.groupdict().get('alias')
+            if alias is not None and alias not in aliases:
+                continue
+            rows = ACTUAL_ROWS.search(line)
+            flags.append({
+                'kind': kind,
+                'alias': alias,
+                'table': aliases.get(alias),
+                'index': match.groupdict().get('index'),
+                'rows': float(rows.group('rows')) if rows else None,
+                'line': line.strip()
+            })
+    return flags
+
+def table_aliases(query):
+    """{alias: base table} of every base table the statement reads."""
+    aliases = {}
+    for table, alias in TABLE_REFERENCE.findall(_strip_comments(query)):
+        if table not in BASE_TABLES:
+            continue
+        if not alias or alias.upper() in SQL_KEYWORDS:
+            alias = table
+        aliases[alias] = table
+    return aliases
+
+def column_usage(query, aliases):
+    """
+    {alias: (constant equalities, join equalities, ranges, other columns)}
+    as lists of column names in order of appearance.
+    """
+    query = _strip_comments(query)
+    usage = {alias: ([], [], [], []) for alias in aliases}
+    def note(alias, column, position):
+        if alias in usage and column not in usage[alias][position]:
+            usage[alias][position].append(column)
+
+    for alias, column, operator in CONSTANT_PREDICATE.findall(query):
+        note(alias, column, 0 if operator == '=' else 2)
+    for alias1, column1, operator, alias2, column2 in JOIN_PREDICATE.findall(query):
+        note(alias1, column1, 1 if operator == '=' else 2)
+        note(alias2, column2, 1 if operator == '=' else 2)
+    for alias, column in SUBQUERY_PREDICATE.findall(query):
+        note(alias, column, 1)
+    for alias, column in COLUMN_REFERENCE.findall(query):
+        note(alias, column, 3)
+    return usage
+
+def propose_indexes(analyses, indexes):
+    """
+    Covering indexes for the tables flagged in analyses, minus those that
+    an existing index or a longer proposal already covers.
+
+    Returns a list of {'table', 'columns', 'statements'}.
+    """
+    proposals = {}
+    for name, analysis in analyses.items():
+        flagged = {flag['alias'] for flag in analysis['flags']
+                   if flag['kind'] in ('full_scan', 'full_index_scan', 'non_covering_lookup')}
+        aliases = table_aliases(analysis['query'])
+        usage = column_usage(analysis['query'], aliases)
+        for alias in flagged:
+            columns = []
+            for column in (column for group in usage.get(alias, ()) for column in group):
+                if column not in columns:
+                    columns.append(column)
+            columns = tuple(columns[:MAX_INDEX_COLUMNS])
+            if not columns:
+                continue
+            proposal = proposals.setdefault((aliases[alias], columns), set())
+            proposal.add(name)
+
+    def covered(table, columns):
+        if any(existing[:len(columns)] == columns for existing in indexes.get(table, [])):
+            return True
+        return any(other_table == table and other != columns and other[:len(columns)] == columns
+                   for other_table, other in proposals)
+
+    return [{'table': table, 'columns': list(columns), 'statements': sorted(statements)}
+            for (table, columns), statements in sorted(proposals.items())
+            if not covered(table, columns)]
+
+def index_name(table, columns):
+    return f"idx_advisor_{table}_{'_'.join(columns)}"[:64]
+
+def index_ddl(proposal):
+    return (f"CREATE INDEX {index_name(proposal['table'], proposal['columns'])} "
+            f"ON {proposal['table']} ({', '.join(proposal['columns'])});")
+
+###############################################################
+# MEASUREMENT
+###############################################################
+
+def time_statement(conn, query, params, repeat):
+    """Wall time in ms of each of repeat runs. Writes are rolled back after each run."""
+    cur = conn.cursor()
+    timings = []
+    for _ in range(repeat):
+        start_time = time.time()
+        cur.execute(query, params)
+        if cur.with_rows:
+            cur.fetchall()
+        timings.append((time.time() - start_time) * 1000)
+        conn.rollback()
+    cur.close()
+    return timings
+
+def analyze_cases(conn, cases, repeat):
+    """
+    Plans (of the first parameter set) and flags of every read statement,
+    and the median latency of every statement over all parameter sets.
+    """
+    analyses = {}
+    for name, runs in cases.items():
+        query = runs[0][0]
+        analysis = {'query': query, 'runs': len(runs), 'plan': None, 'flags': []}
+        try:
+            if is_read(query):
+                analysis['plan'] = explain_analyze(conn, query, runs[0][1])
+                analysis['flags'] = plan_flags(analysis['plan'], table_aliases(query))
+            # One untimed run per parameter set warms the buffer pool
+            timings = []
+            for _, params in runs:
+                time_statement(conn, query, params, 1)
+                timings.extend(time_statement(conn, query, params, repeat))
+            analysis['median_ms'] = statistics.median(timings)
+        except mysql.connector.Error as e:
+            logger.error(f"{name} failed: {e}")
+            analysis['error'] = str(e)
+        analyses[name] = analysis
+        kinds = sorted({flag['kind'] for flag in analysis['flags']})
+        logger.info(f"{name}: {analysis.get('median_ms', float('nan')):.2f} ms"
+                    f"{' [' + ', '.join(kinds) + ']' if kinds else ''}")
+    return analyses
+
+def run_advisor(conn, database, output, sample=None, num_users=20, seed=12345, repeat=5,
+                keep_scratch=False):
+    """Analyzes, proposes and applies indexes on a scratch copy of database, and writes the report."""
+    sample = sample or sample_data(conn, num_users, seed=seed)
+    cases = statement_cases(sample)
+
+    scratch = f"{database}_advisor"
+    create_scratch_copy(conn, database, scratch)
+    try:
+        logger.info("Analyzing statements on the current schema...")
+        before = analyze_cases(conn, cases, repeat)
+        proposals = propose_indexes(before, existing_indexes(conn, scratch))
+
+        cur = conn.cursor()
+        for proposal in proposals:
+            start_time = time.time()
+            cur.execute(index_ddl(proposal))
+            proposal['build_seconds'] = time.time() - start_time
+            logger.info(f"Applied {index_ddl(proposal)} in {proposal['build_seconds']:.2f} seconds")
+        cur.close()
+        analyze_tables(conn)
+
+        logger.info("Analyzing statements with the proposed indexes...")
+        after = analyze_cases(conn, cases, repeat) if proposals else before
+    finally:
+        if not keep_scratch:
+            cur = conn.cursor()
+            cur.execute(f"DROP DATABASE IF EXISTS {scratch}")
+            cur.close()
+
+    report = {
+        'created': datetime.now().isoformat(),
+        'database': database,
+        'sample': sample,
+        'proposed_indexes': proposals,
+        'statements': {
+            name: {
+                'query': before[name]['query'],
+                'runs': before[name]['runs'],
+                'before': {key: before[name].get(key) for key in ('plan', 'flags', 'median_ms', 'error')},
+                'after': {key: after[name].get(key) for key in ('plan', 'flags', 'median_ms', 'error')}
+            } for name in cases
+        }
+    }
+    with open(output, 'w') as file:
+        json.dump(report, file, indent=2, default=str)
+    print_report(report)
+    return report
+
+def print_report(report):
+    print("Proposed indexes:")
+    for proposal in report['proposed_indexes']:
+        print(f"  {index_ddl(proposal)}  -- for {', '.join(proposal['statements'])}")
+    if not report['proposed_indexes']:
+        print("  none")
+
+    print("Median latency per statement (ms):")
+    for name, statement in sorted(report['statements'].items()):
+        before = statement['before'].get('median_ms')
+        after = statement['after'].get('median_ms')
+        if before is None or after is None:
+            print(f"  {name}: failed")
+            continue
+        flags = sorted({flag['kind'] for flag in statement['before']['flags']})
+        change = f"{(after - before) / before:+.0%}" if before else "="
+        print(f"  {name}: {before:.2f} -> {after:.2f} ({change})"
+              f"{'  [' + ', '.join(flags) + ']' if flags else ''}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Propose covering indexes for the MySQL schema from EXPLAIN ANALYZE')
+    parser.add_argument('--num-businesses', type=int, default=1000,
+                      help='Subset to analyze (database cs6400_<num_businesses>)')
+    parser.add_argument('--output', type=str, required=True,
+                      help='Path of the JSON report')
+    parser.add_argument('--users', type=int, default=20,
+                      help='Number of sampled users')
+    parser.add_argument('--seed', type=int, default=12345,
+                      help='Seed for sampling users')
+    parser.add_argument('--sample-from', type=str,
+                      help='Reuse the sample of an earlier report')
+    parser.add_argument('--repeat', type=int, default=5,
+                      help='Timed runs per statement and parameter set')
+    parser.add_argument('--keep-scratch', action='store_true',
+                      help='Keep the scratch database with the proposed indexes applied')
+    args = parser.parse_args()
+
+    sample = None
+    if args.sample_from:
+        with open(args.sample_from) as file:
+            sample = json.load(file)['sample']
+
+    database = f"cs6400_{args.num_businesses}"
+    conn = mysql.connector.connect(host=similarity.HOST, user=similarity.USER,
+                                   password=similarity.PASSWORD, database=database)
+    try:
+        run_advisor(conn, database, args.output, sample, args.users, args.seed, args.repeat, args.keep_scratch)
+    finally:
+        conn.close()
@@ -0,0 +1,447 @@
+"""
+Profiles the Cypher queries of the recommender with PROFILE.
+
+The queries come from CollaborativeRecommendationEngine, the similarity
+calculator, load_data.py and benchmarks/read_write_neo4j.py. They are run
+against a sample of real users, the category each user rated most, and
+ratings and businesses of those users. For every query, the report records
+the db hits, rows, page cache hits and misses, and time of each operator
+in the plan, plus the wall time of the query. The report is written as JSON.
+
+Every query runs in an explicit transaction that is rolled back, so write
+queries can be profiled against a live database without changing it.
+The batched maintenance queries (CALL ... IN TRANSACTIONS) cannot run in
+an explicit transaction and are not profiled.
+
+Queries that are built inside methods are captured by calling those
+methods with a QueryRecorder in place of the connection. That way the
+report profiles exactly the text the application sends.
+
+Diffing two reports shows the plan-level effect of a schema or query
+change. Reuse the sample of the first report (--sample-from) so both
+reports profile the same users, categories and rows:
+
+    python -m benchmarks.profile_neo4j_queries run --output before.json
+    # change the schema or the queries
+    python -m benchmarks.profile_neo4j_queries run --output after.json --sample-from before.json
+    python -m benchmarks.profile_neo4j_queries diff before.json after.json
+"""
+
+import argparse
+import fnmatch
+import json
+import logging
+import random
+import time
+from collections import Counter
+from datetime import datetime
+from database.neo4j.neo4j_connection import Neo4jConnection
+from database.neo4j.node_cache import NodeCache
+from database.neo4j import similarity_calculator_no_cache as similarity
+from database.neo4j.load_data import BUSINESSES_JSON_QUERY, BUSINESSES_CSV_QUERY, RATINGS_QUERY
+from app.collaborative_recommendation_engine import CollaborativeRecommendationEngine
+from benchmarks import read_write_neo4j
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+CANDIDATE_USERS_QUERY = """
+MATCH (u:User)
+WHERE COUNT { (u)-[:RATED]->() } >= $min_ratings
+WITH u LIMIT $candidates
+RETURN u.user_id AS user_id
+ORDER BY user_id
+"""
+
+MOST_RATED_CATEGORY_QUERY = """
+UNWIND $user_ids AS user_id
+CALL (user_id) {
+    MATCH (:User {user_id: user_id})-[:RATED]->(:Business)-[:BELONGS_TO]->(c:Category)
+    RETURN c.name AS category, COUNT(*) AS ratings
+    ORDER BY ratings DESC, category
+    LIMIT 1
+}
+RETURN user_id, category
+"""
+
+# One existing rating per user
+USER_RATING_QUERY = """
+UNWIND $user_ids AS user_id
+CALL (user_id) {
+    MATCH (:User {user_id: user_id})-[r:RATED]->(b:Business)
+    RETURN b.gmap_id AS business, r.rating AS rating, r.timestamp AS timestamp
+    ORDER BY business
+    LIMIT 1
+}
+RETURN user_id AS user, business, rating, timestamp
+"""
+
+BUSINESS_ROWS_QUERY = """
+UNWIND $business_ids AS business_id
+MATCH (b:Business {gmap_id: business_id})
+OPTIONAL MATCH (b)-[:BELONGS_TO]->(c:Category)
+RETURN b.gmap_id AS gmap_id, b.name AS name, b.avg_rating AS avg_rating,
+       b.num_of_reviews AS num_of_reviews, b.price AS price,
+       b.latitude AS latitude, b.longitude AS longitude,
+       COLLECT(c.name) AS categories
+"""
+
+class QueryRecorder:
+    """
+    Stands in for a Neo4jConnection (and its driver and sessions) and
+    records the queries it is given instead of running them. Every query
+    returns no records.
+    """
+
+    def __init__(self):
+        self.queries = []
+        self.driver = self
+
+    def session(self, **kwargs):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def run(self, query, parameters=None, **kwargs):
+        self.queries.append((query, dict(parameters or {}, **kwargs)))
+        return []
+
+    def query(self, query, parameters=None, session=None):
+        self.queries.append((query, dict(parameters or {})))
+        return []
+
+def recorded(call):
+    """The (query, parameters) pairs call(recorder) sends to the connection."""
+    recorder = QueryRecorder()
+    call(recorder)
+    return recorder.queries
+
+###############################################################
+# SAMPLE
+###############################################################
+
+def sample_data(conn, num_users=20, min_ratings=3, seed=12345, candidates=10000):
+    """
+    Picks num_users users with at least min_ratings ratings, the category
+    each of them rated most, and one existing rating per user.
+    """
+    user_ids = [record['user_id'] for record in conn.query(CANDIDATE_USERS_QUERY, {
+        'min_ratings': min_ratings,
+        'candidates': candidates
+    })]
+    user_ids = sorted(random.Random(seed).sample(user_ids, min(num_users, len(user_ids))))
+
+    categories = {record['user_id']: record['category']
+                  for record in conn.query(MOST_RATED_CATEGORY_QUERY, {'user_ids': user_ids})}
+    ratings = conn.query(USER_RATING_QUERY, {'user_ids': user_ids})
+    logger.info(f"Sampled {len(user_ids)} users, {len(set(categories.values()))} categories "
+                f"and {len(ratings)} ratings")
+    return {
+        'users': [[user_id, categories.get(user_id)] for user_id in user_ids if categories.get(user_id)],
+        'ratings': ratings
+    }
+
+###############################################################
+# QUERIES
+###############################################################
+
+def query_cases(conn, sample, min_common_items=3):
+    """
+    Returns {name: [(query, parameters), ...]}: every profiled query with
+    one parameter set per sampled item.
+    """
+    users = sample['users']
+    ratings = sample['ratings']
+    business_ids = sorted({rating['business'] for rating in ratings})
+
+    cases = {}
+    def add(name, query, parameters):
+        cases.setdefault(name, []).append((query, parameters))
+    def add_recorded(name, call):
+        queries = recorded(call)
+        for i, (query, parameters) in enumerate(queries):
+            add(name if len(queries) == 1 else f"{name}[{i}]", query, parameters)
+
+    # Recommendation engine, with both ways of filtering by category
+    for variant, use_category_labels in [('engine', False), ('engine_labels', True)]:
+        for user_id, category in users:
+            engine = lambda recorder: CollaborativeRecommendationEngine(recorder, use_category_labels)
+            add_recorded(f"{variant}.recommendations",
+                         lambda r: engine(r)._fetch_recommendations(user_id, category, 10))
+            add_recorded(f"{variant}.fallback",
+                         lambda r: engine(r)._fetch_fallback_recommendations(category, 10))
+            add_recorded(f"{variant}.user_similarity",
+                         lambda r: engine(r)._fetch_recommendations_user(user_id, category, 10))
+            add_recorded(f"{variant}.user_business_similarity",
+                         lambda r: engine(r)._fetch_recommendations_user_business(user_id, category, 10))
+
+    # Benchmark reads and writes
+    for user_id, category in users:
+        add_recorded("benchmark.most_rated_category",
+                     lambda r: read_write_neo4j.get_most_rated_category(r, user_id))
+        add_recorded("benchmark.fallback",
+                     lambda r: read_write_neo4j._fetch_fallback_recommendations(r, category, 5))
+        add_recorded("benchmark.user_similarity",
+                     lambda r: read_write_neo4j._fetch_recommendations_user(r, user_id, category, 5))
+    for rating in ratings:
+        add_recorded("benchmark.write_rating",
+                     lambda r: read_write_neo4j.load_additional_ratings_and_extract_affected_users(r, rating))
+
+    # Similarity calculator
+    add("similarity.active_users", similarity.ACTIVE_USERS_QUERY, {'min_common_items': min_common_items})
+    add("similarity.business_categories", similarity.BUSINESS_CATEGORIES_QUERY, {})
+    for user_id, _ in users:
+        add("similarity.user_pairs", similarity.USER_PAIRS_QUERY,
+            {'user1_id': user_id, 'min_common_items': min_common_items})
+        add("similarity.affected_user_pairs", similarity.AFFECTED_USER_PAIRS_QUERY,
+            {'user1_id': user_id, 'min_common_items': min_common_items})
+    for kind in similarity.SIMILARITY_TYPES:
+        add(f"similarity.active_generation.{kind}", similarity.ACTIVE_GENERATION_QUERY, {'kind': kind})
+        add(f"similarity.begin_generation.{kind}", similarity.BEGIN_GENERATION_QUERY, {'kind': kind})
+        add(f"similarity.activate_generation.{kind}", similarity.ACTIVATE_GENERATION_QUERY,
+            {'kind': kind, 'generation': 1})
+
+    # Similarity writes between neighboring sampled users and businesses
+    now = int(datetime.now().timestamp() * 1000)
+    user_refs = NodeCache(conn, 'User', 'user_id').resolve(user_id for user_id, _ in users)
+    user_ids = sorted(user_refs)
+    user_rows = [{
+        'start_ref': user_refs[user1_id],
+        'end_ref': user_refs[user2_id],
+        'similarity': 0.5,
+        'common_items': min_common_items,
+        'last_updated': now
+    } for user1_id, user2_id in zip(user_ids, user_ids[1:])]
+    business_refs = NodeCache(conn, 'Business', 'gmap_id').resolve(business_ids)
+    ordered_businesses = sorted(business_refs)
+    business_rows = [{
+        'start_ref': business_refs[business1_id],
+        'end_ref': business_refs[business2_id],
+        'similarity': 0.5,
+        'common_categories': 1,
+        'last_updated': now
+    } for business1_id, business2_id in zip(ordered_businesses, ordered_businesses[1:])]
+    for name, query, rows in [
+        ("similarity.user_upsert", similarity.USER_SIMILARITY_UPSERT_QUERY, user_rows),
+        ("similarity.user_create", similarity.USER_SIMILARITY_CREATE_QUERY, user_rows),
+        ("similarity.business_upsert", similarity.BUSINESS_SIMILARITY_UPSERT_QUERY, business_rows),
+        ("similarity.business_create", similarity.BUSINESS_SIMILARITY_CREATE_QUERY, business_rows)
+    ]:
+        add(name, query, {'similarities': rows, 'generation': 1})
+
+    # Loaders, re-writing the sampled businesses and ratings
+    businesses = conn.query(BUSINESS_ROWS_QUERY, {'business_ids': business_ids})
+    add("load_data.businesses_json", BUSINESSES_JSON_QUERY,
+        {'batch': [dict(business, category=business['categories']) for business in businesses]})
+    add("load_data.businesses_csv", BUSINESSES_CSV_QUERY, {'batch': businesses})
+    add("load_data.ratings", RATINGS_QUERY, {'batch': [
+        dict(rating, business_ref=business_refs.get(rating['business'])) for rating in ratings
+    ]})
+    return cases
+
+###############################################################
+# PROFILING
+###############################################################
+
+def flatten_plan(plan, path="0"):
+    """Operators of a profiled plan in pre-order, each with its position in the tree."""
+    arguments = plan.get('args', {})
+    operators = [{
+        'path': path,
+        'operator': plan.get('operatorType'),
+        'details': arguments.get('Details'),
+        'db_hits': plan.get('dbHits', 0),
+        'rows': plan.get('rows', 0),
+        'page_cache_hits': plan.get('pageCacheHits', 0),
+        'page_cache_misses': plan.get('pageCacheMisses', 0),
+        # Nanoseconds; 0 where the runtime does not measure operator time
+        'time': plan.get('time', 0)
+    }]
+    for i, child in enumerate(plan.get('children', [])):
+        operators.extend(flatten_plan(child, f"{path}.{i}"))
+    return operators
+
+def profile_query(session, query, parameters):
+    """Runs query under PROFILE in a transaction that is rolled back."""
+    tx = session.begin_transaction()
+    try:
+        start_time = time.time()
+        summary = tx.run("PROFILE " + query, parameters).consume()
+        elapsed = time.time() - start_time
+    finally:
+        tx.rollback()
+    return flatten_plan(summary.profile), elapsed
+
+def profile_case(session, runs):
+    """
+    Profiles every (query, parameters) run of a case and sums the operator
+    statistics over the runs. The per-run numbers are the sums divided by
+    runs.
+    """
+    operators = {}
+    total_time = 0.0
+    for query, parameters in runs:
+        plan, elapsed = profile_query(session, query, parameters)
+        total_time += elapsed
+        for operator in plan:
+            # Plans of one query text are the same for every parameter set,
+            # unless the planner replans between runs
+            key = (operator['path'], operator['operator'])
+            if key not in operators:
+                operators[key] = dict(operator)
+                continue
+            for stat in ['db_hits', 'rows', 'page_cache_hits', 'page_cache_misses', 'time']:
+                operators[key][stat] += operator[stat]
+
+    operators = list(operators.values())
+    return {
+        'query': runs[0][0],
+        'runs': len(runs),
+        'db_hits': sum(operator['db_hits'] for operator in operators),
+        'rows': operators[0]['rows'] if operators else 0,
+        'time_ms': total_time * 1000,
+        'operators': operators
+    }
+
+def run_profile(conn, output, sample=None, num_users=20, seed=12345, only=None):
+    """Profiles every query case matching the only patterns and writes the report to output."""
+    sample = sample or sample_data(conn, num_users, seed=seed)
+    cases = query_cases(conn, sample)
+    if only:
+        cases = {name: runs for name, runs in cases.items()
+                 if any(fnmatch.fnmatch(name, pattern) for pattern in only)}
+
+    report = {
+        'created': datetime.now().isoformat(),
+        'sample': sample,
+        'queries': {},
+        'errors': {}
+    }
+    with conn.driver.session() as session:
+        for name, runs in cases.items():
+            try:
+                report['queries'][name] = result = profile_case(session, runs)
+                logger.info(f"{name}: {result['db_hits'] / result['runs']:.0f} db hits, "
+                            f"{result['time_ms'] / result['runs']:.1f} ms per run ({result['runs']} runs)")
+            except Exception as e:
+                logger.error(f"{name} failed: {e}")
+                report['errors'][name] = str(e)
+
+    with open(output, 'w') as file:
+        json.dump(report, file, indent=2)
+    logger.info(f"Profiled {len(report['queries'])} queries into {output} ({len(report['errors'])} failed)")
+    return report
+
+###############################################################
+# DIFF
+###############################################################
+
+def _per_run(result, stat):
+    return result[stat] / result['runs'] if result['runs'] else 0
+
+def diff_reports(old, new):
+    """
+    Compares two reports query by query.
+
+    Returns a list of per-query dicts with the per-run db hits, rows and
+    time of both reports, the operators that appear in only one of the plans,
+    and the db hits of operators whose position in the plan is unchanged.
+    """
+    diffs = []
+    for name in sorted(old['queries'].keys() | new['queries'].keys()):
+        before = old['queries'].get(name)
+        after = new['queries'].get(name)
+        if before is None or after is None:
+            diffs.append({'query': name, 'only_in': 'new' if before is None else 'old'})
+            continue
+
+        old_operators = {(op['path'], op['operator']): op for op in before['operators']}
+        new_operators = {(op['path'], op['operator']): op for op in after['operators']}
+        old_types = Counter(op['operator'] for op in before['operators'])
+        new_types = Counter(op['operator'] for op in after['operators'])
+        diffs.append({
+            'query': name,
+            'text_changed': before['query'] != after['query'],
+            'db_hits': (_per_run(before, 'db_hits'), _per_run(after, 'db_hits')),
+            'rows': (_per_run(before, 'rows'), _per_run(after, 'rows')),
+            'time_ms': (_per_run(before, 'time_ms'), _per_run(after, 'time_ms')),
+            'removed_operators': sorted((old_types - new_types).elements()),
+            'added_operators': sorted((new_types - old_types).elements()),
+            'operator_db_hits': [
+                (path, operator,
+                 old_operators[(path, operator)]['db_hits'] / before['runs'],
+                 new_operators[(path, operator)]['db_hits'] / after['runs'])
+                for path, operator in sorted(old_operators.keys() & new_operators.keys())
+                if old_operators[(path, operator)]['db_hits'] / before['runs']
+                != new_operators[(path, operator)]['db_hits'] / after['runs']
+            ]
+        })
+    return diffs
+
+def _change(before, after):
+    if before == 0:
+        return "new" if after else "="
+    return f"{(after - before) / before:+.0%}"
+
+def print_diff(diffs):
+    # Largest absolute db hit changes first
+    diffs = sorted(diffs, key=lambda diff: -abs(diff['db_hits'][1] - diff['db_hits'][0]) if 'db_hits' in diff else 0)
+    for diff in diffs:
+        if 'only_in' in diff:
+            print(f"{diff['query']}: only in the {diff['only_in']} report")
+            continue
+        (hits_before, hits_after), (ms_before, ms_after) = diff['db_hits'], diff['time_ms']
+        print(f"{diff['query']}{' (query text changed)' if diff['text_changed'] else ''}: "
+              f"db hits {hits_before:.0f} -> {hits_after:.0f} ({_change(hits_before, hits_after)}), "
+              f"time {ms_before:.1f} -> {ms_after:.1f} ms ({_change(ms_before, ms_after)}), "
+              f"rows {diff['rows'][0]:.0f} -> {diff['rows'][1]:.0f}")
+        if diff['removed_operators']:
+            print(f"    removed: {', '.join(diff['removed_operators'])}")
+        if diff['added_operators']:
+            print(f"    added:   {', '.join(diff['added_operators'])}")
+        for path, operator, before, after in diff['operator_db_hits']:
+            print(f"    {path} {operator}: {before:.0f} -> {after:.0f} db hits")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Profile the Neo4j queries of the recommender')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='Profile every query into a JSON report')
+    run_parser.add_argument('--output', type=str, required=True,
+                      help='Path of the JSON report')
+    run_parser.add_argument('--users', type=int, default=20,
+                      help='Number of sampled users')
+    run_parser.add_argument('--seed', type=int, default=12345,
+                      help='Seed for sampling users')
+    run_parser.add_argument('--sample-from', type=str,
+                      help='Reuse the sample of an earlier report, so the two reports can be diffed')
+    run_parser.add_argument('--only', type=str, nargs='+',
+                      help='Only profile queries whose names match these patterns (e.g. "engine*")')
+    run_parser.add_argument('--uri', type=str, default='neo4j://localhost:7687')
+    run_parser.add_argument('--user', type=str, default='neo4j')
+    run_parser.add_argument('--password', type=str, default='neo4j@1234')
+
+    diff_parser = commands.add_parser('diff', help='Compare two reports')
+    diff_parser.add_argument('old', type=str, help='Report before the change')
+    diff_parser.add_argument('new', type=str, help='Report after the change')
+
+    args = parser.parse_args()
+
+    if args.command == 'diff':
+        with open(args.old) as old_file, open(args.new) as new_file:
+            print_diff(diff_reports(json.load(old_file), json.load(new_file)))
+    else:
+        sample = None
+        if args.sample_from:
+            with open(args.sample_from) as file:
+                sample = json.load(file)['sample']
+
+        conn = Neo4jConnection(uri=args.uri, user=args.user, password=args.password)
+        try:
+            run_profile(conn, args.output, sample, args.users, args.seed, args.only)
+        finally:
+            conn.close()
@@ -5,6 +5,9 @@ from datetime import datetime
 import math
 import time
 import logging
+from database.mysql.ratings import fetch_user_rating_count
+from database.mysql.similarity import record_pending_users
+from database.mysql.ingestion import MySQLRatingIngestor
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -23,6 +26,13 @@ EXPERIMENTS = [
     {'writes': 1000, 'recs': 9000}
 ]
 
+# Also keep the user_neighbors adjacency list in sync with user_similarity
+UPDATE_NEIGHBOR_TABLES = False
+
+# Ratings per write transaction (flushed earlier after INGEST_MAX_DELAY seconds)
+INGEST_BATCH_SIZE = 100
+INGEST_MAX_DELAY = 0.05
+
 def convert_ratings_file_to_list(ratings_file):
     
     df = pd.read_csv(ratings_file)
@@ -155,8 +165,10 @@ def fetch_user_pairs(conn, user_id, min_common_items):
     query = """
     SELECT r1.user_id AS user1_id, 
         r2.user_id AS user2_id,
-        GROUP_CONCAT(r1.rating) AS ratings1, 
-        GROUP_CONCAT(r2.rating) AS ratings2
+        SUM(r1.rating * r2.rating) AS dot_product,
+        SUM(r1.rating * r1.rating) AS sum_squares1,
+        SUM(r2.rating * r2.rating) AS sum_squares2,
+        COUNT(DISTINCT r1.business_id) AS common_items
     FROM ratings r1
     JOIN ratings r2 
     ON r1.business_id = r2.business_id AND r1.user_id < r2.user_id
@@ -171,17 +183,16 @@ def fetch_user_pairs(conn, user_id, min_common_items):
     return pairs
 
 
-def calculate_cosine_similarity(ratings1, ratings2):
-    dot_product = sum(r1 * r2 for r1, r2 in zip(ratings1, ratings2))
-    magnitude1 = math.sqrt(sum(r1 ** 2 for r1 in ratings1))
-    magnitude2 = math.sqrt(sum(r2 ** 2 for r2 in ratings2))
+def calculate_cosine_similarity(dot_product, sum_squares1, sum_squares2):
+    magnitude1 = math.sqrt(sum_squares1)
+    magnitude2 = math.sqrt(sum_squares2)
 
     if magnitude1 == 0 or magnitude2 == 0:
         return 0 
 
     return dot_product / (magnitude1 * magnitude2)
 
-def insert_similarities(conn, similarities):
+def insert_similarities(conn, similarities, neighbors=False):
     if not similarities:
         return 
 
@@ -200,92 +211,77 @@ def insert_similarities(conn, similarities):
             for sim in similarities]
 
     cur.executemany(query, data)
+
+    if neighbors:
+        # Both directions of every pair, in the same transaction
+        query = """
+        INSERT INTO user_neighbors (user_id, neighbor_id, similarity_score, common_rated_items, last_updated)
+        VALUES (%s, %s, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE 
+            similarity_score = VALUES(similarity_score),
+            common_rated_items = VALUES(common_rated_items),
+            last_updated = VALUES(last_updated);
+        """
+        cur.executemany(query, data + [(user2_id, user1_id, *rest) for user1_id, user2_id, *rest in data])
+
     conn.commit()
 
-    logger.info(f"Processed batch with {len(similarities)} similarities")
+    logger.debug(f"Processed batch with {len(similarities)} similarities")
 
     cur.close()
     
-def calculate_similarity_for_affected_users(affected_users, min_common_items, min_similarity):
-    connection = mysql.connector.connect(**DB_CONFIG)
+def calculate_similarity_for_affected_users(affected_users, min_common_items, min_similarity, neighbors=False,
+                                            connection=None):
+    own_connection = connection is None
+    if own_connection:
+        connection = mysql.connector.connect(**DB_CONFIG)
+
+    # A running rebuild recomputes these users after its swap
+    record_pending_users(connection, affected_users)
 
     for user_id in affected_users:
+
+        # Users with fewer ratings than min_common_items cannot have pairs
+        cur = connection.cursor()
+        rating_count = fetch_user_rating_count(cur, user_id)
+        cur.close()
+        if rating_count < min_common_items:
+            continue
         
         pairs = fetch_user_pairs(connection, user_id, min_common_items)
 
         similarities = []
         for pair in pairs:
             user2_id = pair['user2_id']
-            ratings1 = list(map(float, pair['ratings1'].split(',')))
-            ratings2 = list(map(float, pair['ratings2'].split(',')))
 
             
-            similarity = calculate_cosine_similarity(ratings1, ratings2)
+            similarity = calculate_cosine_similarity(
+                float(pair['dot_product']), float(pair['sum_squares1']), float(pair['sum_squares2'])
+            )
 
             if similarity >= min_similarity:
                 similarities.append({
                     'user1_id': user_id,
                     'user2_id': user2_id,
                     'similarity': similarity,
-                    'common_items': len(ratings1),
+                    'common_items': pair['common_items'],
                     'last_updated': int(datetime.now().timestamp() * 1000)
                 })
 
         
-        insert_similarities(connection, similarities)
-
-    connection.close()
-    
-
-
-
-
-def load_additional_ratings(ratings_entry):
-    # print(ratings_entry)
-    connection = mysql.connector.connect(**DB_CONFIG)
-    cursor = connection.cursor()
-
-    
-
-    
-    # affected_users = set()
-
-    
-    user_data = []
-    rating_data = []
+        insert_similarities(connection, similarities, neighbors)
 
+    if own_connection:
+        connection.close()
     
-    user_id = ratings_entry['user']
-    print("user_id", user_id)
-    
-    business_id = ratings_entry['business']
-    rating = ratings_entry['rating']
-    timestamp = datetime.utcfromtimestamp(ratings_entry['timestamp'] / 1000.0).strftime('%Y-%m-%d %H:%M:%S')
-
-    user_data.append((user_id,))
-    rating_data.append((business_id, user_id, rating, timestamp))
-
-    user_query = "INSERT IGNORE INTO users (user_id) VALUES (%s)"
-    cursor.executemany(user_query, user_data)
-
-    rating_query = """
-        INSERT INTO ratings (business_id, user_id, rating, timestamp)
-        VALUES (%s, %s, %s, %s)
-        ON DUPLICATE KEY UPDATE rating = VALUES(rating), timestamp = VALUES(timestamp)
-    """
-    cursor.executemany(rating_query, rating_data)
-
-    connection.commit()
 
 
-    cursor.close()
-    connection.close()
-
-    return user_id
 
 
 def run_experiment(ratings_file, experiment_config):
     connection = mysql.connector.connect(**DB_CONFIG)
+    ingestor = MySQLRatingIngestor(lambda: mysql.connector.connect(**DB_CONFIG),
+                                   max_batch_size=INGEST_BATCH_SIZE, max_delay=INGEST_MAX_DELAY)
 
     affected_users = set()
 
@@ -305,14 +301,20 @@ def run_experiment(ratings_file, experiment_config):
     for action in actions:
         if action == 'write':
             
-            affected_users.add(load_additional_ratings(ratings_list[write_count]))
+            rating = ratings_list[write_count]
+            ingestor.add_rating(rating['user'], rating['business'], rating['rating'], rating['timestamp'])
+            affected_users.add(rating['user'])
             write_count += 1
-            logger.info(f"Processed write #{write_count}")
+            logger.debug(f"Processed write #{write_count}")
 
-        if write_count % 100 == 0:
+        if action == 'write' and write_count % 100 == 0:
             
             logger.info(f"Recalculating similarities after {write_count} writes")
-            calculate_similarity_for_affected_users(list(affected_users), min_common_items=3, min_similarity=0.3)
+            # Similarities are computed from committed ratings only
+            ingestor.flush()
+            calculate_similarity_for_affected_users(list(ingestor.drain_affected().users),
+                                                    min_common_items=3, min_similarity=0.3,
+                                                    neighbors=UPDATE_NEIGHBOR_TABLES)
             affected_users = set()  
 
         if action == 'rec':
@@ -327,13 +329,14 @@ def run_experiment(ratings_file, experiment_config):
             else:  
                 results = _fetch_recommendations_user(connection, '108416619844777498346', 'Restaurant', 5)
             for idx, rec in enumerate(results):
-                logger.info(f"{idx + 1}. {rec['business_name']} ({rec['business_id']})")
-            logger.info(f"Processed recommendation #{rec_count}")
+                logger.debug(f"{idx + 1}. {rec['business_name']} ({rec['business_id']})")
+            logger.debug(f"Processed recommendation #{rec_count}")
 
         
 
     logger.info(f"Completed {experiment_config['writes']} writes and {experiment_config['recs']} recs")
 
+    ingestor.close()
     connection.close()
 
 
@@ -1,4 +1,3 @@
-from neo4j import GraphDatabase
 import random
 import pandas as pd
 import argparse
@@ -6,6 +5,9 @@ import ast
 import logging
 import time
 from database.neo4j.similarity_calculator_no_cache import SimilarityCalculatorNoCache
+from database.neo4j.neo4j_connection import Neo4jConnection
+from database.neo4j.similarity_calculator_cached import SimilarityCalculatorCached
+from database.neo4j.ingestion import Neo4jRatingIngestor, RATINGS_WRITE_QUERY
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -17,6 +19,10 @@ EXPERIMENTS = [
     {'writes': 1000, 'recs': 9000}
 ]
 
+# Ratings per write transaction (flushed earlier after INGEST_MAX_DELAY seconds)
+INGEST_BATCH_SIZE = 100
+INGEST_MAX_DELAY = 0.05
+
 def convert_ratings_file_to_list(ratings_file):
     
     df = pd.read_csv(ratings_file)
@@ -25,7 +31,7 @@ def convert_ratings_file_to_list(ratings_file):
 
 def get_most_rated_category(conn, user_id):
 
-    print(user_id)
+    logger.debug(f"Fetching the most rated category of user {user_id}")
 
     query = """
     MATCH (u:User {user_id: $user_id})-[:RATED]->(b:Business)-[:BELONGS_TO]->(c:Category)
@@ -38,7 +44,7 @@ def get_most_rated_category(conn, user_id):
     
     result = conn.query(query, parameters={'user_id': user_id})
 
-    print(result)
+    logger.debug(result)
     if result:
         return result[0].get('category_name', None)
     else:
@@ -50,8 +56,16 @@ def _fetch_fallback_recommendations(conn, category, limit):
         """
         query = """
         MATCH (b:Business)-[:BELONGS_TO]->(c:Category {name: $category})
-        MATCH (b)<-[r:RATED]-()
-        RETURN b.name AS business_name, b.gmap_id AS business_id, COUNT(r) AS total_ratings, AVG(r.rating) AS avg_rating
+        CALL (b) {
+            OPTIONAL MATCH (b)<-[r:RATED]-()
+            WHERE b.rating_count IS NULL
+            RETURN COUNT(r) AS edge_count, AVG(r.rating) AS edge_avg
+        }
+        WITH b, coalesce(b.rating_count, edge_count) AS total_ratings,
+             coalesce(b.rating_avg, edge_avg) AS avg_rating
+        WHERE total_ratings > 0
+        RETURN b.name AS business_name, b.gmap_id AS business_id,
+               total_ratings, avg_rating
         ORDER BY avg_rating DESC, total_ratings DESC, b.name ASC
         LIMIT $limit
         """
@@ -65,11 +79,16 @@ def _fetch_fallback_recommendations(conn, category, limit):
 
 def _fetch_recommendations_user(conn, user_id, category, limit):
         """
-        Fetch recommendations based on SIMILAR_TO relationships.
+        Fetch recommendations based on USER_SIMILAR relationships.
         """
         query = """
+        // Resolve the active similarity generation
+        OPTIONAL MATCH (g:SimilarityGeneration {kind: 'user'})
+        WITH coalesce(g.active, 0) AS user_generation
+
         // Get similar users
-        MATCH (u:User {user_id: $user_id})-[s:SIMILAR_TO]-(similar:User)
+        MATCH (u:User {user_id: $user_id})-[s:USER_SIMILAR]-(similar:User)
+        WHERE coalesce(s.generation, 0) = user_generation
         WITH u, similar, s.score AS similarity_score
 
         // Get businesses rated by similar users
@@ -88,58 +107,33 @@ def _fetch_recommendations_user(conn, user_id, category, limit):
         recommendations = conn.query(query, {'user_id': user_id, 'category': category, 'limit': limit})
         return recommendations
         
-def load_additional_ratings_and_extract_affected_users(conn, ratings_entry):
-    
-    query = """
-    MERGE (u:User {user_id: $user_id})
-    WITH u
-    MATCH (b:Business {gmap_id: $business_id})
-    MERGE (u)-[r:RATED]->(b)
-    SET r.rating = $rating,
-        r.timestamp = $timestamp,
-        r.last_updated = timestamp(),
-        r.normalized_rating = CASE 
-            WHEN $rating >= 4.5 THEN 5
-            WHEN $rating >= 3.5 THEN 4
-            WHEN $rating >= 2.5 THEN 3
-            WHEN $rating >= 1.5 THEN 2
-            ELSE 1
-        END
-    """
-    params = {
+# Single ratings go through the batch statement of the ingestor
+RATING_WRITE_QUERY = RATINGS_WRITE_QUERY
+
+def rating_write_params(ratings_entry):
+    return {'ratings': [{
         'user_id': ratings_entry['user'],
         'business_id': ratings_entry['business'],
         'rating': ratings_entry['rating'],
         'timestamp': ratings_entry['timestamp']
-    }
-    conn.query(query, params)
-
+    }]}
 
+def load_additional_ratings_and_extract_affected_users(conn, ratings_entry):
+    conn.query(RATING_WRITE_QUERY, rating_write_params(ratings_entry))
     return ratings_entry['user']
 
-class Neo4jConnection:
-    def __init__(self, uri, user, password):
-        self.driver = GraphDatabase.driver(uri, auth=(user, password))
-        
-    def close(self):
-        self.driver.close()
-        
-    def query(self, query, parameters=None):
-        with self.driver.session() as session:
-            result = session.run(query, parameters or {})
-            return [record.data() for record in result]
 
 
 
 
-
-def run_experiment(ratings_file, experiment_config):
+def run_experiment(ratings_file, experiment_config, cached=False):
     conn = Neo4jConnection(
         uri="neo4j://localhost:7687",
         user="neo4j",
         password="neo4j@1234"
     )
-    simCalc = SimilarityCalculatorNoCache(conn)
+    simCalc = SimilarityCalculatorCached(conn) if cached else SimilarityCalculatorNoCache(conn)
+    ingestor = Neo4jRatingIngestor(conn, max_batch_size=INGEST_BATCH_SIZE, max_delay=INGEST_MAX_DELAY)
     affected_users = []
 
 
@@ -158,13 +152,19 @@ def run_experiment(ratings_file, experiment_config):
     for action in actions:
         if action == 'write':
 
-            affected_users.append(load_additional_ratings_and_extract_affected_users(conn, ratings_list[write_count]))
+            rating = ratings_list[write_count]
+            ingestor.add_rating(rating['user'], rating['business'], rating['rating'], rating['timestamp'])
+            affected_users.append(rating['user'])
+            if cached:
+                simCalc.record_rating(rating['user'], rating['business'], rating['rating'])
             write_count += 1
-            logger.info(f"Processed write #{write_count}")
+            logger.debug(f"Processed write #{write_count}")
         
-        if write_count % 100 == 0:
+        if action == 'write' and write_count % 100 == 0:
+            # Similarities are computed from committed ratings only
+            ingestor.flush()
             simCalc.update_user_similarity(
-                        affected_users=affected_users,
+                        affected_users=list(ingestor.drain_affected().users),
                         min_common_items=3,
                         min_similarity=0.3
                     )
@@ -183,19 +183,24 @@ def run_experiment(ratings_file, experiment_config):
                 results = _fetch_recommendations_user(conn, '108416619844777498346', 'Restaurant', 5)
             
             for idx, rec in enumerate(results):
-                logger.info(f"{idx + 1}. {rec['business_name']} ({rec['business_id']})")
-            logger.info(f"Processed recommendation #{rec_count}")
+                logger.debug(f"{idx + 1}. {rec['business_name']} ({rec['business_id']})")
+            logger.debug(f"Processed recommendation #{rec_count}")
             
+    ingestor.close()
     conn.close()
 
 if __name__ == "__main__":
-    
+    parser = argparse.ArgumentParser(description='Neo4j read/write benchmark')
+    parser.add_argument('--cached', action='store_true',
+                      help='Use the caching similarity calculator for incremental updates')
+    args = parser.parse_args()
+
     results_time = []
     for experiment_config in EXPERIMENTS:
         
         logger.info(f"Running experiment with {experiment_config['writes']} writes and {experiment_config['recs']} recs")
         start_time = time.time()
-        run_experiment("data/benchmark/10k_9000_dummy_ratings.csv", experiment_config)
+        run_experiment("data/benchmark/10k_9000_dummy_ratings.csv", experiment_config, cached=args.cached)
         end_time = time.time()
         results_time.append(f"Time taken for {experiment_config['writes']} writes and {experiment_config['recs']} recs: " + str(end_time - start_time) + " seconds")
     for result in results_time:
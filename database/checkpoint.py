@@ -0,0 +1,157 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_DIR = "checkpoints"
+
+class BatchJobError(Exception):
+    """Raised when some batches of a job still fail after all retries."""
+
+    def __init__(self, job, failed_keys):
+        self.job = job
+        self.failed_keys = failed_keys
+        super().__init__(f"{len(failed_keys)} batches of {job} failed: {', '.join(failed_keys[:10])}")
+
+class JobCheckpoint:
+    """
+    Append-only JSON-lines log of the batches a long-running job has
+    completed, used to resume the job after a crash.
+
+    The first line records the job parameters. A later run with the same
+    parameters resumes from the file and skips every batch already marked
+    done; a run with different parameters starts over. The file is removed
+    once the job completes.
+    """
+
+    def __init__(self, job, checkpoint_dir=CHECKPOINT_DIR):
+        self.job = job
+        self.path = os.path.join(checkpoint_dir, f"{job}.jsonl")
+        self.meta = {}
+        self._done = set()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def batch_key(ids):
+        """Stable key for a batch identified by the ids it contains."""
+        digest = hashlib.sha1("\n".join(sorted(map(str, ids))).encode()).hexdigest()
+        return digest[:16]
+
+    def start(self, params):
+        """
+        Opens the checkpoint for a run with the given parameters.
+
+        Returns True if a previous run with the same parameters is resumed.
+        """
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+
+        if os.path.exists(self.path):
+            with open(self.path) as file:
+                entries = [json.loads(line) for line in file if line.strip()]
+            if entries and entries[0].get('params') == params:
+                for entry in entries[1:]:
+                    if entry['event'] == 'done':
+                        self._done.add(entry['key'])
+                    elif entry['event'] == 'meta':
+                        self.meta[entry['name']] = entry['value']
+                logger.info(f"Resuming {self.job}: {len(self._done)} batches already completed")
+                return True
+            logger.info(f"Checkpoint for {self.job} was written with different parameters, starting over")
+
+        self.reset(params)
+        return False
+
+    def reset(self, params):
+        """Discards any recorded progress and starts a fresh checkpoint."""
+        self.meta = {}
+        self._done = set()
+        with open(self.path, "w") as file:
+            file.write(json.dumps({'event': 'start', 'params': params, 'time': time.time()}) + "\n")
+
+    def _append(self, entry):
+        entry['time'] = time.time()
+        with self._lock:
+            with open(self.path, "a") as file:
+                file.write(json.dumps(entry) + "\n")
+
+    def set_meta(self, name, value):
+        self.meta[name] = value
+        self._append({'event': 'meta', 'name': name, 'value': value})
+
+    def is_done(self, key):
+        return key in self._done
+
+    def mark_done(self, key):
+        with self._lock:
+            self._done.add(key)
+        self._append({'event': 'done', 'key': key})
+
+    def mark_failed(self, key, error):
+        self._append({'event': 'failed', 'key': key, 'error': str(error)})
+
+    def complete(self):
+        """Removes the checkpoint once the whole job has succeeded."""
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        logger.info(f"Job {self.job} completed")
+
+def run_batches(keyed_batches, process, checkpoint=None, job="batch job", max_workers=4,
+                max_attempts=3, mark_done=True):
+    """
+    Runs process(key, batch) for every (key, batch) pair on a pool of
+    max_workers threads, skipping batches already done in checkpoint.
+
+    Batches are submitted lazily with at most max_workers * 2 in flight.
+    Every failure is logged (and recorded in the checkpoint, if any), and
+    only the failed batches are retried, up to max_attempts runs in total.
+    If mark_done is True a batch is marked done as soon as process returns;
+    otherwise process is responsible for calling checkpoint.mark_done once
+    the batch is durably written.
+
+    Raises BatchJobError if some batches still fail after the last attempt.
+    """
+    if checkpoint:
+        job = checkpoint.job
+        pending = ((key, batch) for key, batch in keyed_batches if not checkpoint.is_done(key))
+    else:
+        pending = keyed_batches
+
+    for attempt in range(1, max_attempts + 1):
+        failed = []
+        in_flight = {}
+
+        def collect(futures):
+            for future in futures:
+                key, batch = in_flight.pop(future)
+                try:
+                    future.result()
+                    if checkpoint and mark_done:
+                        checkpoint.mark_done(key)
+                except Exception as e:
+                    logger.error(f"Batch {key} of {job} failed (attempt {attempt}/{max_attempts}): {e}")
+                    if checkpoint:
+                        checkpoint.mark_failed(key, e)
+                    failed.append((key, batch))
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for key, batch in pending:
+                if len(in_flight) >= max_workers * 2:
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    collect(done)
+                in_flight[executor.submit(process, key, batch)] = (key, batch)
+            collect(list(in_flight))
+
+        if not failed:
+            return
+        if attempt < max_attempts:
+            logger.info(f"Retrying {len(failed)} failed batches of {job}")
+        pending = failed
+
+    raise BatchJobError(job, [key for key, _ in failed])
@@ -0,0 +1,239 @@
+import logging
+import threading
+import time
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+class AffectedEntities:
+    """Users and businesses whose ratings changed, for similarity and cache maintenance."""
+
+    def __init__(self, users=(), businesses=()):
+        self.users = set(users)
+        self.businesses = set(businesses)
+
+    def update(self, other):
+        self.users |= other.users
+        self.businesses |= other.businesses
+
+    def __bool__(self):
+        return bool(self.users or self.businesses)
+
+    def __repr__(self):
+        return f"AffectedEntities({len(self.users)} users, {len(self.businesses)} businesses)"
+
+class BufferedRatingWriter:
+    """
+    Buffered rating ingestion with group commit.
+
+    add_rating() only appends the rating to a buffer. A background thread
+    writes the buffer in transactions of up to max_batch_size ratings, as
+    soon as it holds that many or its oldest rating has waited max_delay
+    seconds; flush() writes it right away. The cost of a commit is then shared by every rating of
+    the batch, so write throughput grows with the batch size instead of
+    being bounded by the commit latency.
+
+    Within a batch, a later rating of the same (user, business) replaces the
+    earlier one, as writing them one by one would. Flushes run one at a time
+    and in order.
+
+    Each flush returns the users and businesses it changed. They are also
+    accumulated until drain_affected() hands them to the similarity and
+    cache maintenance.
+
+    add_rating(..., wait=True) blocks until the rating is committed, which
+    gives concurrent callers a group commit: they all wait on the same
+    transaction. If a flush fails, its error is raised once to the callers
+    waiting on that flush (and by flush() or close() if they ran it), and
+    its ratings are set aside until take_failed() returns them. Later
+    ratings are written as usual.
+
+    Subclasses implement _write_batch(), which writes a list of
+    (user_id, business_id, rating, timestamp) tuples (timestamps in epoch
+    milliseconds, as in the ratings files) in one transaction, and close
+    their connections in _close().
+    """
+
+    def __init__(self, name, max_batch_size=500, max_delay=0.05):
+        self.name = name
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.flushes = 0
+        self.ratings_written = 0
+
+        self._buffer = {}
+        self._oldest = None
+        self._sequence = 0        # Ratings added so far
+        self._resolved = 0        # Ratings added before the last completed or failed flush
+        self._waiters = {}        # Sequence of a waiting rating -> error of its flush (None if committed)
+        self._failed = []         # Ratings of failed flushes not yet taken
+        self._closed = False
+        self._affected = AffectedEntities()
+
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._buffer_changed = threading.Condition(self._lock)
+        self._flushed = threading.Condition(self._lock)
+        self._thread = threading.Thread(target=self._run, name=f"{name}-ingestion", daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+    def add_rating(self, user_id, business_id, rating, timestamp, wait=False):
+        """
+        Buffers a rating. With wait=True, blocks until the flush containing
+        it has committed.
+        """
+        with self._lock:
+            if self._closed:
+                raise RuntimeError(f"{self.name} ingestion is closed")
+            key = (user_id, business_id)
+            self._sequence += 1
+            sequence = self._sequence
+            self._buffer.pop(key, None)  # Keep the buffer in order of sequence
+            self._buffer[key] = ((user_id, business_id, rating, timestamp), sequence)
+            if self._oldest is None:
+                # Start the flusher's max_delay timer
+                self._oldest = time.perf_counter()
+                self._buffer_changed.notify()
+            elif len(self._buffer) >= self.max_batch_size:
+                self._buffer_changed.notify()
+
+            if wait:
+                self._waiters[sequence] = None
+                while self._resolved < sequence:
+                    self._flushed.wait()
+                error = self._waiters.pop(sequence)
+                if error:
+                    raise RuntimeError(f"{self.name} ingestion failed") from error
+
+    def flush(self):
+        """
+        Writes every buffered rating now and returns the AffectedEntities of
+        the flush. Stops at the first failed batch and raises its error; the
+        rest stays buffered.
+        """
+        affected = AffectedEntities()
+        while True:
+            try:
+                batch_affected = self._flush()
+            except Exception as e:
+                raise RuntimeError(f"{self.name} ingestion failed") from e
+            if not batch_affected:
+                return affected
+            affected.update(batch_affected)
+
+    def take_failed(self):
+        """
+        The (user_id, business_id, rating, timestamp) ratings of every failed
+        flush since the last call, e.g. to add them again.
+        """
+        with self._lock:
+            failed, self._failed = self._failed, []
+        return failed
+
+    def drain_affected(self):
+        """AffectedEntities of every flush since the last call."""
+        with self._lock:
+            affected, self._affected = self._affected, AffectedEntities()
+        return affected
+
+    def close(self):
+        """
+        Flushes the remaining ratings and stops the flusher. Raises the error
+        of the first of these flushes that failed, after attempting the rest.
+        """
+        with self._lock:
+            self._closed = True
+            self._buffer_changed.notify()
+        self._thread.join()
+        error = None
+        while True:
+            try:
+                if not self._flush():
+                    break
+            except Exception as e:
+                error = error or e
+        self._close()
+        logger.info(f"{self.name}: wrote {self.ratings_written} ratings in {self.flushes} flushes")
+        if error:
+            raise RuntimeError(f"{self.name} ingestion failed") from error
+
+    def _resolve(self, sequence, error=None):
+        """Marks the ratings up to sequence as flushed and wakes their waiters. Caller holds _lock."""
+        for waiting in self._waiters:
+            if self._resolved < waiting <= sequence:
+                self._waiters[waiting] = error
+        self._resolved = sequence
+        self._flushed.notify_all()
+
+    def _flush(self):
+        """
+        Writes the oldest batch of the buffer and returns its AffectedEntities
+        (empty if the buffer was empty). If the write fails, the batch is set
+        aside for take_failed() and the error is raised.
+        """
+        with self._flush_lock:
+            with self._lock:
+                entries = [self._buffer.pop(key) for key in list(self._buffer)[:self.max_batch_size]]
+                if not self._buffer:
+                    self._oldest = None  # Otherwise the rest is due right away
+            if not entries:
+                return AffectedEntities()
+            batch = [row for row, _ in entries]
+            sequence = entries[-1][1]
+
+            affected = AffectedEntities({row[0] for row in batch}, {row[1] for row in batch})
+            start_time = time.perf_counter()
+            try:
+                self._write_batch(batch)
+            except Exception as e:
+                logger.error(f"Error writing {len(batch)} ratings into {self.name}: {e}")
+                with self._lock:
+                    self._failed.extend(batch)
+                    self._resolve(sequence, e)
+                raise
+
+            with self._lock:
+                self.flushes += 1
+                self.ratings_written += len(batch)
+                self._affected.update(affected)
+                self._resolve(sequence)
+            logger.debug(f"Flushed {len(batch)} ratings into {self.name} in "
+                         f"{time.perf_counter() - start_time:.3f} s")
+            return affected
+
+    def _due(self):
+        """Seconds until the buffer must be flushed (0 if due now, None if empty)."""
+        if not self._buffer:
+            return None
+        if len(self._buffer) >= self.max_batch_size:
+            return 0
+        return max(0, self._oldest + self.max_delay - time.perf_counter())
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._closed:
+                    due = self._due()
+                    if due == 0:
+                        break
+                    self._buffer_changed.wait(due)
+                if self._closed:
+                    return
+            try:
+                self._flush()
+            except Exception:
+                pass  # Logged by _flush and reported to the waiters of the batch
+
+    def _write_batch(self, batch):
+        raise NotImplementedError
+
+    def _close(self):
+        pass
@@ -3,9 +3,21 @@ SET FOREIGN_KEY_CHECKS = 0;
 DROP TABLE IF EXISTS businesses;
 DROP TABLE IF EXISTS users;
 DROP TABLE IF EXISTS ratings;
+DROP TABLE IF EXISTS user_stats;
 DROP TABLE IF EXISTS business_categories;
 DROP TABLE IF EXISTS user_similarity;
 DROP TABLE IF EXISTS business_similarity;
+DROP TABLE IF EXISTS user_similarity_next;
+DROP TABLE IF EXISTS user_similarity_old;
+DROP TABLE IF EXISTS business_similarity_next;
+DROP TABLE IF EXISTS business_similarity_old;
+DROP TABLE IF EXISTS user_neighbors;
+DROP TABLE IF EXISTS business_neighbors;
+DROP TABLE IF EXISTS user_neighbors_next;
+DROP TABLE IF EXISTS user_neighbors_old;
+DROP TABLE IF EXISTS business_neighbors_next;
+DROP TABLE IF EXISTS business_neighbors_old;
+DROP TABLE IF EXISTS similarity_pending_users;
 SET FOREIGN_KEY_CHECKS = 1;
 
 -- Table to store business data
@@ -35,6 +47,17 @@ CREATE TABLE ratings (
     CONSTRAINT unique_business_user_pair UNIQUE (business_id, user_id)
 );
 
+-- Table to store per-user rating aggregates, kept up to date by the rating
+-- write path in ratings.py.
+CREATE TABLE user_stats (
+    user_id VARCHAR(25) PRIMARY KEY,
+    rating_count INT NOT NULL, -- Number of ratings (degree) of the user
+    co_rater_cost BIGINT NOT NULL, -- Sum of the rater counts of the user's businesses
+    last_rated DATETIME, -- Time of the user's latest rating
+    FOREIGN KEY (user_id) REFERENCES users (user_id),
+    INDEX idx_user_stats_rating_count (rating_count) -- Active user lookups
+);
+
 -- Table to store business-categories (no primary key!)
 CREATE TABLE business_categories (
     business_id VARCHAR (50),
@@ -67,5 +90,70 @@ CREATE TABLE business_similarity (
     INDEX idx_business_id_2 (business_id_2)  -- Index for business_id_2
 );
 
+-- Optional adjacency lists of the similarity tables: every pair is stored
+-- once per direction, clustered by source and descending score, so the
+-- neighbors of a user or business are one range scan, strongest first.
+-- Only filled by the similarity jobs when they are asked to (neighbors=True).
+CREATE TABLE user_neighbors (
+    user_id VARCHAR(50) NOT NULL, -- Source user
+    neighbor_id VARCHAR(50) NOT NULL, -- Similar user
+    similarity_score DECIMAL(5, 4) NOT NULL, -- Cosine similarity score
+    common_rated_items INT NOT NULL, -- Number of common rated items
+    last_updated BIGINT NOT NULL, -- Timestamp of the last update
+    PRIMARY KEY (user_id, similarity_score DESC, neighbor_id), -- Neighbors strongest first
+    UNIQUE INDEX idx_user_neighbor (user_id, neighbor_id) -- One row per direction of a pair
+);
+
+CREATE TABLE business_neighbors (
+    business_id VARCHAR(50) NOT NULL, -- Source business
+    neighbor_id VARCHAR(50) NOT NULL, -- Similar business
+    similarity_score DECIMAL(17, 16) NOT NULL, -- Similarity score
+    common_categories INT NOT NULL, -- Number of common categories
+    last_updated BIGINT NOT NULL, -- Timestamp for the last update
+    PRIMARY KEY (business_id, similarity_score DESC, neighbor_id), -- Neighbors strongest first
+    UNIQUE INDEX idx_business_neighbor (business_id, neighbor_id) -- One row per direction of a pair
+);
+
+-- Users updated incrementally while a user similarity rebuild was running;
+-- the rebuild recomputes them once its table is swapped in
+CREATE TABLE similarity_pending_users (
+    user_id VARCHAR(50) NOT NULL PRIMARY KEY
+);
+
 -- Indexes to optimize frequent lookups by business and user
--- CREATE INDEX idx_business_id on reviews (business_id);
\ No newline at end of file
+-- CREATE INDEX idx_business_id on reviews (business_id);
+
+-- PARTITIONED RATINGS
+-- Optional layout of ratings, range-partitioned by rating time. loader.py
+-- only runs the statements below when asked for it (partitioned_ratings=True).
+-- Queries restricted to recent ratings (timestamp >= ...) then only read the
+-- partitions of the window. MySQL requires every unique key of a partitioned
+-- table to include the partitioning column and does not support foreign keys
+-- on it, so this layout drops both: one rating per (business, user) is kept
+-- by the shared write path in ratings.py instead of a unique constraint.
+-- Add a partition for a new year with:
+--   ALTER TABLE ratings REORGANIZE PARTITION p_future INTO (
+--       PARTITION p2022 VALUES LESS THAN ('2023-01-01'),
+--       PARTITION p_future VALUES LESS THAN (MAXVALUE))
+DROP TABLE IF EXISTS ratings;
+
+CREATE TABLE ratings (
+    rating_id BIGINT AUTO_INCREMENT,
+    business_id VARCHAR(50),
+    user_id VARCHAR(25),
+    rating TINYINT,
+    timestamp DATETIME NOT NULL,
+    PRIMARY KEY (rating_id, timestamp),
+    INDEX idx_ratings_business_user (business_id, user_id), -- Replaces the unique pair constraint
+    INDEX idx_ratings_user (user_id) -- Replaces the index of the user foreign key
+)
+PARTITION BY RANGE COLUMNS (timestamp) (
+    PARTITION p2015 VALUES LESS THAN ('2016-01-01'), -- Everything up to 2015
+    PARTITION p2016 VALUES LESS THAN ('2017-01-01'),
+    PARTITION p2017 VALUES LESS THAN ('2018-01-01'),
+    PARTITION p2018 VALUES LESS THAN ('2019-01-01'),
+    PARTITION p2019 VALUES LESS THAN ('2020-01-01'),
+    PARTITION p2020 VALUES LESS THAN ('2021-01-01'),
+    PARTITION p2021 VALUES LESS THAN ('2022-01-01'),
+    PARTITION p_future VALUES LESS THAN (MAXVALUE)
+);
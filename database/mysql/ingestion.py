@@ -0,0 +1,63 @@
+import logging
+from datetime import datetime
+import mysql.connector
+from database.ingestion import BufferedRatingWriter
+from database.mysql.ratings import USER_INSERT_QUERY, ratings_partitioned, write_ratings
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+class MySQLRatingIngestor(BufferedRatingWriter):
+    """
+    Rating ingestion into MySQL: every flush inserts the missing users and
+    writes the ratings (and their user_stats) through write_ratings in one
+    transaction.
+
+    Rows are written in primary key order, so concurrent ingestors lock
+    index records in the same order. A flush that hits a deadlock or lock
+    wait timeout is rolled back and retried up to MAX_ATTEMPTS times.
+    """
+
+    RETRYABLE_ERRORS = (1213, 1205)
+    MAX_ATTEMPTS = 3
+
+    def __init__(self, conn_factory, max_batch_size=500, max_delay=0.05, update_stats=True):
+        """
+        conn_factory : callable returning a new mysql.connector connection,
+                       used by this ingestor only
+        """
+        self.conn = conn_factory()
+        cursor = self.conn.cursor()
+        self.partitioned = ratings_partitioned(cursor)
+        cursor.close()
+        self.update_stats = update_stats
+        self.retries = 0
+        super().__init__('ratings', max_batch_size, max_delay)
+
+    def _write_batch(self, batch):
+        users = [(user_id,) for user_id in sorted({row[0] for row in batch})]
+        rows = sorted(
+            (business_id, user_id, rating,
+             datetime.utcfromtimestamp(timestamp / 1000.0).strftime('%Y-%m-%d %H:%M:%S'))
+            for user_id, business_id, rating, timestamp in batch
+        )
+
+        for attempt in range(1, self.MAX_ATTEMPTS + 1):
+            cursor = self.conn.cursor()
+            try:
+                cursor.executemany(USER_INSERT_QUERY, users)
+                write_ratings(cursor, rows, self.partitioned, self.update_stats)
+                self.conn.commit()
+                return
+            except mysql.connector.Error as e:
+                self.conn.rollback()
+                if e.errno not in self.RETRYABLE_ERRORS or attempt == self.MAX_ATTEMPTS:
+                    raise
+                self.retries += 1
+                logger.warning(f"Retrying {len(rows)} ratings after error {e.errno}")
+            finally:
+                cursor.close()
+
+    def _close(self):
+        self.conn.close()
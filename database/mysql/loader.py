@@ -1,31 +1,65 @@
+import argparse
 import ast
 from datetime import datetime
 import pandas as pd
 import mysql.connector
 import time
 from mysqlconnection import MySQLConnection
+from ratings import ratings_partitioned, write_ratings, rebuild_user_stats
+
+PARTITIONED_RATINGS_SECTION = "-- PARTITIONED RATINGS"
 
 # Creates tables with hard-coded schema
-def create_tables(db: MySQLConnection):
-    """Creates tables with the schemas specified in create_tables.sql"""
+def create_tables(db: MySQLConnection, partitioned_ratings=False):
+    """
+    Creates tables with the schemas specified in create_tables.sql. The
+    PARTITIONED RATINGS section at its end, which recreates ratings
+    range-partitioned by rating time, only runs if partitioned_ratings.
+    """
 
     connection = db.connection
     cursor = db.cursor
 
     with open("database/mysql/create_tables.sql", "r") as file:
         sql_script = file.read()
+
+    sql_script, _, partitioned_script = sql_script.partition(PARTITIONED_RATINGS_SECTION)
+    if partitioned_ratings:
+        sql_script += partitioned_script
     
     # Execute queries iteratively
     for query in sql_script.split(";"):
         if query.strip():
             cursor.execute(query)
 
+# Recreates user_stats and fills it from the loaded ratings
+def rebuild_user_stats_table(db: MySQLConnection):
+    """
+    Backfill for databases loaded before user_stats existed (or with an older
+    layout of it): recreates the table as in create_tables.sql and rebuilds
+    it from ratings. Other tables are left unchanged.
+    """
+
+    connection = db.connection
+    cursor = db.cursor
+
+    with open("database/mysql/create_tables.sql", "r") as file:
+        sql_script = file.read()
+
+    create_query = next(query for query in sql_script.split(";")
+                        if "CREATE TABLE user_stats" in query)
+    cursor.execute("DROP TABLE IF EXISTS user_stats")
+    cursor.execute(create_query)
+    rebuild_user_stats(cursor)
+    connection.commit()
+
 db_map = {100:"100", 1000:"1k", 5000:"5k", 10000:"10k"}
 
 # Loads a provided dataset
-def load_dataset(db: MySQLConnection):
+def load_dataset(db: MySQLConnection, partitioned_ratings=False):
     """
     Creates new tables and loads the provided ratings and metadata datasets.
+    With partitioned_ratings, ratings is range-partitioned by rating time.
     """
 
     connection = db.connection
@@ -38,7 +72,8 @@ def load_dataset(db: MySQLConnection):
     metadata_file = f"data/samples/matched_businesses_{db_map[db.num_businesses]}.csv"
 
     # Recreate tables
-    create_tables(db)
+    create_tables(db, partitioned_ratings)
+    partitioned = ratings_partitioned(cursor)
 
     # Load business metadata first
     for chunk in pd.read_csv(metadata_file, chunksize=1000):
@@ -109,20 +144,24 @@ def load_dataset(db: MySQLConnection):
         )
         cursor.executemany(query, user_data)
 
-        # Load ratings
-        query = (
-            f"INSERT INTO ratings (business_id, user_id, rating, timestamp)"
-            f"VALUES (%s, %s, %s, %s)"
-            f"ON DUPLICATE KEY UPDATE rating = VALUES(rating), timestamp = VALUES(timestamp)"
-        )
-        cursor.executemany(query, rating_data)
+        # Load ratings (user_stats is built once all of them are loaded)
+        write_ratings(cursor, rating_data, partitioned, update_stats=False)
+
+    # Aggregate every user's ratings into user_stats
+    rebuild_user_stats(cursor)
 
     connection.commit()
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Load the samples into MySQL')
+    parser.add_argument('--rebuild-user-stats', action='store_true',
+                      help='Only rebuild user_stats of the already loaded databases')
+    args = parser.parse_args()
+
     # subsets = [100, 1000, 5000, 10000]
     subsets = [1000]
+    partitioned_ratings = False  # Range-partition ratings by rating time
 
     for num_businesses in subsets:
         try:
@@ -137,10 +176,13 @@ if __name__ == "__main__":
             print(f"Error: {e}")
             exit()
 
-        print(f"Loading databases for sample with {num_businesses} businesses")
-
         start_time = time.time()
-        load_dataset(db)
+        if args.rebuild_user_stats:
+            print(f"Rebuilding user_stats for sample with {num_businesses} businesses")
+            rebuild_user_stats_table(db)
+        else:
+            print(f"Loading databases for sample with {num_businesses} businesses")
+            load_dataset(db, partitioned_ratings)
         end_time = time.time()
 
         print(f"Database loading time: {end_time - start_time} seconds")
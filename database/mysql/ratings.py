@@ -0,0 +1,155 @@
+"""
+Shared write path and time windows for the ratings table.
+
+ratings is either the plain table of create_tables.sql, where a unique key
+keeps one rating per (business, user), or its optional range-partitioned
+layout by rating time (the PARTITIONED RATINGS section). A partitioned table
+cannot have that unique key, so write_ratings replaces a pair's earlier
+rating by deleting it before the insert instead of upserting.
+
+write_ratings also keeps user_stats (rating count, co-rater cost and latest
+rating time per user) current: in the same transaction, it recomputes the
+rows of the users it wrote ratings for, one index range per user. Bulk
+loads skip that and call rebuild_user_stats once at the end, which is also
+the backfill for databases loaded before user_stats existed.
+
+Reads can be restricted to a time window: queries mark each ratings alias
+with a {since:<alias>} placeholder, which restrict_to_window fills in with a
+timestamp condition. On the partitioned layout MySQL then only reads the
+partitions of the window.
+"""
+
+import re
+from datetime import datetime, timedelta
+
+USER_INSERT_QUERY = "INSERT IGNORE INTO users (user_id) VALUES (%s)"
+
+RATING_UPSERT_QUERY = """
+INSERT INTO ratings (business_id, user_id, rating, timestamp)
+VALUES (%s, %s, %s, %s)
+ON DUPLICATE KEY UPDATE rating = VALUES(rating), timestamp = VALUES(timestamp)
+"""
+
+RATING_INSERT_QUERY = """
+INSERT INTO ratings (business_id, user_id, rating, timestamp)
+VALUES (%s, %s, %s, %s)
+"""
+
+RATING_DELETE_QUERY = "DELETE FROM ratings WHERE business_id = %s AND user_id = %s"
+
+RATINGS_PARTITIONED_QUERY = """
+SELECT COUNT(*)
+FROM information_schema.partitions
+WHERE table_schema = DATABASE() AND table_name = 'ratings' AND partition_name IS NOT NULL
+"""
+
+# Aggregates the ratings of the users matched by {user_ids:<alias>} into
+# user_stats. The co-rater cost is the sum of the rater counts of every
+# business the user rated, i.e. the rows the user similarity pair query joins.
+USER_STATS_REFRESH_QUERY = """
+INSERT INTO user_stats (user_id, rating_count, co_rater_cost, last_rated)
+SELECT r.user_id, COUNT(*), SUM(bd.raters), MAX(r.timestamp)
+FROM ratings r
+JOIN (
+    SELECT rb.business_id, COUNT(*) AS raters
+    FROM ratings rb
+    WHERE rb.business_id IN (SELECT ru.business_id FROM ratings ru WHERE {user_ids:ru})
+    GROUP BY rb.business_id
+) bd ON r.business_id = bd.business_id
+WHERE {user_ids:r}
+GROUP BY r.user_id
+ON DUPLICATE KEY UPDATE
+    rating_count = VALUES(rating_count),
+    co_rater_cost = VALUES(co_rater_cost),
+    last_rated = VALUES(last_rated)
+"""
+
+USER_STATS_QUERY = """
+SELECT user_id, rating_count, co_rater_cost, last_rated
+FROM user_stats
+WHERE user_id = %s
+"""
+
+USER_RATING_COUNT_QUERY = "SELECT COUNT(*) FROM ratings WHERE user_id = %s"
+
+USER_IDS_PLACEHOLDER = re.compile(r"\{user_ids:(\w+)\}")
+
+WINDOW_PLACEHOLDER = re.compile(r"\{since:(\w+)\}")
+
+def ratings_partitioned(cursor):
+    """Whether the ratings table of the cursor's database is partitioned."""
+    cursor.execute(RATINGS_PARTITIONED_QUERY)
+    return cursor.fetchone()[0] > 0
+
+def write_ratings(cursor, rows, partitioned=False, update_stats=True):
+    """
+    Writes (business_id, user_id, rating, timestamp) rows, replacing any
+    earlier rating of the same (business, user), and refreshes the
+    user_stats of their users unless update_stats is False. Does not commit.
+    """
+    if not partitioned:
+        cursor.executemany(RATING_UPSERT_QUERY, rows)
+    else:
+        # Without the unique key, repeated pairs in rows would all be inserted;
+        # keep the last one, as the upsert would
+        rows = list({tuple(row[:2]): row for row in rows}.values())
+        cursor.executemany(RATING_DELETE_QUERY, [row[:2] for row in rows])
+        cursor.executemany(RATING_INSERT_QUERY, rows)
+
+    if update_stats:
+        refresh_user_stats(cursor, {row[1] for row in rows})
+
+def refresh_user_stats(cursor, user_ids):
+    """
+    Recomputes the user_stats rows of user_ids from their ratings. Does not
+    commit. The co-rater cost of other users of the same businesses is not
+    refreshed; it is an estimate for batching and only drifts slowly.
+    """
+    user_ids = sorted(user_ids)
+    if not user_ids:
+        return
+    placeholders = ", ".join(["%s"] * len(user_ids))
+    query = USER_IDS_PLACEHOLDER.sub(lambda match: f"{match.group(1)}.user_id IN ({placeholders})",
+                                     USER_STATS_REFRESH_QUERY)
+    cursor.execute(query, user_ids * 2)
+
+def rebuild_user_stats(cursor):
+    """Recomputes user_stats from every rating. Does not commit."""
+    cursor.execute("DELETE FROM user_stats")
+    cursor.execute(USER_IDS_PLACEHOLDER.sub("TRUE", USER_STATS_REFRESH_QUERY))
+
+def fetch_user_stats(cursor, user_id):
+    """The user_stats row of user_id (in USER_STATS_QUERY column order), or None."""
+    cursor.execute(USER_STATS_QUERY, (user_id,))
+    return cursor.fetchone()
+
+def fetch_user_rating_count(cursor, user_id):
+    """
+    Number of ratings of user_id from user_stats, counted in ratings if the
+    user has no user_stats row (e.g. user_stats was never rebuilt).
+    """
+    stats = fetch_user_stats(cursor, user_id)
+    if stats is not None:
+        return stats[1]
+    cursor.execute(USER_RATING_COUNT_QUERY, (user_id,))
+    return cursor.fetchone()[0]
+
+###############################################################
+# TIME WINDOWS
+###############################################################
+
+def window_start(years, now=None):
+    """The start of a window covering the last `years` years before now."""
+    return (now or datetime.now()) - timedelta(days=round(365.25 * years))
+
+def since_condition(alias, since):
+    """SQL condition keeping the ratings of alias rated at or after since (TRUE if since is None)."""
+    if since is None:
+        return "TRUE"
+    # Formatting the datetime (rather than passing a parameter) keeps the
+    # positional parameters of the queries unchanged
+    return f"{alias}.timestamp >= '{since:%Y-%m-%d %H:%M:%S}'"
+
+def restrict_to_window(query, since=None):
+    """Fills every {since:<alias>} placeholder of query with since_condition(alias, since)."""
+    return WINDOW_PLACEHOLDER.sub(lambda match: since_condition(match.group(1), since), query)
@@ -1,18 +1,89 @@
 from datetime import datetime
 import math
-from itertools import combinations
-from concurrent.futures import ThreadPoolExecutor
+from itertools import combinations, islice
 import logging
+import threading
 import time
 from mysql.connector.pooling import MySQLConnectionPool
 
 from database.mysql.mysqlconnection import MySQLConnection
+from database.mysql.similarity_writer import SimilarityWriter
+from database.mysql.ratings import restrict_to_window
+from database.checkpoint import CHECKPOINT_DIR, JobCheckpoint, run_batches
+from database.partitioning import num_batches_for, partition_by_cost
 
 # Configuration
 MAX_WORKERS = 4  # Maximum number of threads
 BATCH_SIZE = 100
 MIN_COMMON_ITEMS = 3
 MIN_SIMILARITY = 0.3
+WRITE_CHUNK_SIZE = 1000  # Rows per INSERT statement issued by the similarity writer
+MAX_PENDING_BATCHES = 16  # Batches queued for the writer before workers block
+BUILD_NEIGHBOR_TABLES = False  # Also rebuild the user_neighbors / business_neighbors adjacency lists
+
+USER_SIMILARITY_COLUMNS = ("user_id_1", "user_id_2", "similarity_score", "common_rated_items", "last_updated")
+USER_NEIGHBOR_COLUMNS = ("user_id", "neighbor_id", "similarity_score", "common_rated_items", "last_updated")
+BUSINESS_SIMILARITY_COLUMNS = ("business_id_1", "business_id_2", "similarity_score", "common_categories", "last_updated")
+
+# Queries of the similarity jobs (also profiled by benchmarks/mysql_index_advisor.py).
+# {since:<alias>} restricts the ratings of alias to a time window, see ratings.restrict_to_window
+ACTIVE_USERS_QUERY = """
+SELECT us.user_id, us.rating_count, us.co_rater_cost AS cost
+FROM user_stats us
+WHERE us.rating_count >= %s
+ORDER BY cost DESC, us.user_id;
+"""
+
+# user_stats counts all ratings, so a time window needs the aggregation over
+# ratings; user_stats only prunes users with too few ratings overall
+WINDOWED_ACTIVE_USERS_QUERY = """
+SELECT r.user_id, COUNT(r.business_id) AS rating_count, SUM(bd.raters) AS cost
+FROM user_stats us
+JOIN ratings r ON r.user_id = us.user_id AND {since:r}
+JOIN (
+    SELECT rb.business_id, COUNT(*) AS raters
+    FROM ratings rb
+    WHERE {since:rb}
+    GROUP BY rb.business_id
+) bd ON r.business_id = bd.business_id
+WHERE us.rating_count >= %s
+GROUP BY r.user_id
+HAVING COUNT(r.business_id) >= %s
+ORDER BY cost DESC, r.user_id;
+"""
+
+USER_PAIRS_QUERY = """
+SELECT r1.user_id AS user1_id, 
+    r2.user_id AS user2_id,
+    SUM(r1.rating * r2.rating) AS dot_product,
+    SUM(r1.rating * r1.rating) AS sum_squares1,
+    SUM(r2.rating * r2.rating) AS sum_squares2,
+    COUNT(DISTINCT r1.business_id) AS common_items
+FROM ratings r1
+JOIN ratings r2 
+ON r1.business_id = r2.business_id AND r1.user_id < r2.user_id
+WHERE r1.user_id = %s AND {since:r1} AND {since:r2}
+GROUP BY r1.user_id, r2.user_id
+HAVING COUNT(DISTINCT r1.business_id) >= %s;
+"""
+
+# Copies both directions of every pair of a similarity table into its
+# adjacency list; the columns are given in *_SIMILARITY_COLUMNS order
+NEIGHBORS_FROM_SIMILARITY_QUERY = """
+INSERT INTO {neighbors}
+SELECT {id_1}, {id_2}, similarity_score, {common}, last_updated FROM {similarity}
+UNION ALL
+SELECT {id_2}, {id_1}, similarity_score, {common}, last_updated FROM {similarity}
+"""
+
+BUSINESSES_WITH_CATEGORIES_QUERY = """
+SELECT b.business_id, GROUP_CONCAT(DISTINCT bc.category_name) AS categories
+FROM businesses b
+JOIN business_categories bc ON b.business_id = bc.business_id
+GROUP BY b.business_id
+HAVING categories IS NOT NULL
+ORDER BY LENGTH(categories) DESC, b.business_id;
+"""
 
 # Database details
 HOST = "localhost"
@@ -31,137 +102,312 @@ def get_db_connection(num_businesses):
                 num_businesses=num_businesses
             ).connection
 
+###############################################################
+# SHADOW TABLES
+###############################################################
+# Full recalculations are written into a shadow copy of the similarity
+# table (<table>_next). Once it is complete, a single RENAME TABLE swaps
+# it in atomically, so readers never see a partially rebuilt table. The
+# retired table (<table>_old) is emptied in small batches in the
+# background and then dropped.
+
+def shadow_table_name(table):
+    return f"{table}_next"
+
+def retired_table_name(table):
+    return f"{table}_old"
+
+# Creates an empty shadow copy of table to build the next generation into
+def prepare_shadow_table(table, num_businesses):
+    conn = get_db_connection(num_businesses)
+    cur = conn.cursor()
+
+    shadow = shadow_table_name(table)
+    cur.execute(f"DROP TABLE IF EXISTS {shadow}")
+    cur.execute(f"CREATE TABLE {shadow} LIKE {table}")
+    logger.info(f"Prepared shadow table {shadow}")
+
+    cur.close()
+    conn.close()
+    return shadow
+
+# Checks whether the shadow copy of table exists (e.g. left by an interrupted run)
+def shadow_table_exists(table, num_businesses):
+    conn = get_db_connection(num_businesses)
+    cur = conn.cursor()
+
+    cur.execute("SHOW TABLES LIKE %s", (shadow_table_name(table),))
+    exists = cur.fetchone() is not None
+
+    cur.close()
+    conn.close()
+    return exists
+
+# Opens the job's checkpoint and prepares the shadow table to build into.
+# A resumed job keeps the shadow table built so far; otherwise a fresh
+# empty one is created.
+def start_shadow_build(table, checkpoint, params, num_businesses):
+    resumed = checkpoint.start(params)
+    if resumed and shadow_table_exists(table, num_businesses):
+        return shadow_table_name(table)
+    if resumed:
+        logger.info(f"Shadow table for {table} is missing, restarting from scratch")
+        checkpoint.reset(params)
+    return prepare_shadow_table(table, num_businesses)
+
+# Atomically replaces every table in tables with its shadow copy
+def swap_shadow_tables(tables, num_businesses):
+    conn = get_db_connection(num_businesses)
+    cur = conn.cursor()
+
+    renames = []
+    for table in tables:
+        cur.execute(f"DROP TABLE IF EXISTS {retired_table_name(table)}")
+        renames.append(f"{table} TO {retired_table_name(table)}, {shadow_table_name(table)} TO {table}")
+    cur.execute("RENAME TABLE " + ", ".join(renames))
+    logger.info(f"Swapped shadow tables into {', '.join(tables)}")
+
+    cur.close()
+    conn.close()
+    return [retired_table_name(table) for table in tables]
+
+# Builds a fresh shadow copy of neighbor_table (an adjacency list, see
+# create_tables.sql) from the complete shadow copy of similarity_table, so
+# both can be swapped in together
+def build_neighbor_shadow(similarity_table, neighbor_table, columns, num_businesses):
+    shadow = prepare_shadow_table(neighbor_table, num_businesses)
+
+    conn = get_db_connection(num_businesses)
+    cur = conn.cursor()
+
+    start_time = time.time()
+    id_1, id_2, _, common, _ = columns
+    query = (NEIGHBORS_FROM_SIMILARITY_QUERY
+             .replace('{neighbors}', shadow)
+             .replace('{similarity}', shadow_table_name(similarity_table))
+             .replace('{id_1}', id_1)
+             .replace('{id_2}', id_2)
+             .replace('{common}', common))
+    cur.execute(query)
+    conn.commit()
+    logger.info(f"Wrote {cur.rowcount} rows into {shadow} in {time.time() - start_time:.2f} seconds")
+
+    cur.close()
+    conn.close()
+    return shadow
+
+# Swaps in the shadow copies of similarity_table and, if neighbors, of its
+# adjacency list built from it, then empties the retired tables in the background
+def publish_similarity_table(similarity_table, neighbor_table, columns, neighbors, checkpoint, num_businesses):
+    tables = [similarity_table]
+    if neighbors:
+        build_neighbor_shadow(similarity_table, neighbor_table, columns, num_businesses)
+        tables.append(neighbor_table)
+
+    swap_shadow_tables(tables, num_businesses)
+    checkpoint.complete()
+    for table in tables:
+        start_retired_table_cleanup(table, num_businesses)
+
+# Empties the retired table in small transactions, then drops it
+def cleanup_retired_table(table, num_businesses, batch_size=10000):
+    conn = get_db_connection(num_businesses)
+    cur = conn.cursor()
+
+    retired = retired_table_name(table)
+    total_deleted = 0
+    while True:
+        cur.execute(f"DELETE FROM {retired} LIMIT %s", (batch_size,))
+        conn.commit()
+        total_deleted += cur.rowcount
+        if cur.rowcount < batch_size:
+            break
+    cur.execute(f"DROP TABLE IF EXISTS {retired}")
+    logger.info(f"Removed {total_deleted} rows from {retired} and dropped it")
+
+    cur.close()
+    conn.close()
+
+# Runs cleanup_retired_table on a background (non-daemon) thread
+def start_retired_table_cleanup(table, num_businesses, batch_size=10000):
+    def run():
+        try:
+            cleanup_retired_table(table, num_businesses, batch_size)
+        except Exception as e:
+            logger.error(f"Cleanup of {retired_table_name(table)} failed: {e}")
+
+    thread = threading.Thread(target=run, name=f"{table}-cleanup")
+    thread.start()
+    return thread
+
+###############################################################
+# UPDATES DURING A REBUILD
+###############################################################
+# Incremental updates write into user_similarity, which a running rebuild
+# retires when it swaps its shadow table in. While the shadow table exists,
+# they first record their users in similarity_pending_users, and the
+# rebuild recomputes those users into the swapped-in table.
+
+# Records user_ids for replay if a user similarity rebuild is running.
+# Commits before the caller writes any similarity, so a rebuild that swaps
+# afterwards always sees them
+def record_pending_users(conn, user_ids):
+    cur = conn.cursor()
+
+    cur.execute("SHOW TABLES LIKE %s", (shadow_table_name("user_similarity"),))
+    if cur.fetchone() is not None:
+        cur.executemany("INSERT IGNORE INTO similarity_pending_users (user_id) VALUES (%s)",
+                        [(user_id,) for user_id in user_ids])
+    conn.commit()
+
+    cur.close()
+
+# Recomputes the users recorded during the rebuild into the swapped-in
+# user_similarity (and user_neighbors, if it was rebuilt too), then clears them
+def replay_pending_users(min_common_items, min_similarity, num_businesses, since=None, neighbors=False):
+    conn = get_db_connection(num_businesses)
+    cur = conn.cursor()
+
+    cur.execute("SELECT user_id FROM similarity_pending_users")
+    pending = [row[0] for row in cur.fetchall()]
+    if pending:
+        logger.info(f"Replaying {len(pending)} users updated during the rebuild")
+        similarities = process_user_batch([{'user_id': user_id} for user_id in pending],
+                                          min_common_items, min_similarity, num_businesses, since)
+        with open_similarity_writer("user_similarity", USER_SIMILARITY_COLUMNS, num_businesses) as writer:
+            writer.put(similarities)
+        if neighbors:
+            with open_similarity_writer("user_neighbors", USER_NEIGHBOR_COLUMNS, num_businesses) as writer:
+                writer.put(similarities + [(user2_id, user1_id, *rest) for user1_id, user2_id, *rest in similarities])
+        cur.executemany("DELETE FROM similarity_pending_users WHERE user_id = %s", [(user_id,) for user_id in pending])
+        conn.commit()
+
+    cur.close()
+    conn.close()
+
 ###############################################################
 # USER SIMILARITY CALCULATION
 ###############################################################
 
 # Fetch active users (users who have rated >= min_common_items businesses)
-def fetch_active_users(min_common_items, num_businesses):
+# along with an estimate of the cost of computing their similarities: the
+# number of co-rater rows the pair query has to join, i.e. the sum of the
+# rater counts of every business the user rated. Without a window, both are
+# looked up in user_stats.
+# With since, only ratings rated at or after since count (here and below),
+# so they are aggregated from ratings
+def fetch_active_users(min_common_items, num_businesses, since=None):
     conn = get_db_connection(num_businesses)
     cur = conn.cursor(dictionary=True)
 
-    query = """
-    SELECT u.user_id, COUNT(r.business_id) as rating_count
-    FROM users u
-    JOIN ratings r ON u.user_id = r.user_id
-    GROUP BY u.user_id
-    HAVING COUNT(r.business_id) >= %s
-    ORDER BY COUNT(r.business_id) DESC;
-    """
-    cur.execute(query, (min_common_items,))
+    if since is None:
+        cur.execute(ACTIVE_USERS_QUERY, (min_common_items,))
+    else:
+        cur.execute(restrict_to_window(WINDOWED_ACTIVE_USERS_QUERY, since), (min_common_items, min_common_items))
     active_users = cur.fetchall()
 
     cur.close()
     conn.close()
     return active_users
 
-# Fetch relevant pairs for cosine similarity
-def fetch_user_pairs(user_id, min_common_items, num_businesses):
+# Fetch relevant pairs for cosine similarity, with the dot product and both
+# sums of squares over their co-rated items
+def fetch_user_pairs(user_id, min_common_items, num_businesses, since=None):
     conn = get_db_connection(num_businesses)
     cur = conn.cursor(dictionary=True)
 
-    query = """
-    SELECT r1.user_id AS user1_id, 
-        r2.user_id AS user2_id,
-        GROUP_CONCAT(r1.rating) AS ratings1, 
-        GROUP_CONCAT(r2.rating) AS ratings2
-    FROM ratings r1
-    JOIN ratings r2 
-    ON r1.business_id = r2.business_id AND r1.user_id < r2.user_id
-    WHERE r1.user_id = %s
-    GROUP BY r1.user_id, r2.user_id
-    HAVING COUNT(DISTINCT r1.business_id) >= %s;
-    """
-    cur.execute(query, (user_id, min_common_items))
+    cur.execute(restrict_to_window(USER_PAIRS_QUERY, since), (user_id, min_common_items))
     pairs = cur.fetchall()
 
     cur.close()
     return pairs
 
-# Calculate cosine similarity
-def calculate_cosine_similarity(ratings1, ratings2):
-    dot_product = sum(r1 * r2 for r1, r2 in zip(ratings1, ratings2))
-    magnitude1 = math.sqrt(sum(r1 ** 2 for r1 in ratings1))
-    magnitude2 = math.sqrt(sum(r2 ** 2 for r2 in ratings2))
+# Calculate the cosine similarity of two users over their co-rated items
+# from the dot product and the sums of squares of both rating vectors
+def calculate_cosine_similarity(dot_product, sum_squares1, sum_squares2):
+    magnitude1 = math.sqrt(sum_squares1)
+    magnitude2 = math.sqrt(sum_squares2)
 
     if magnitude1 == 0 or magnitude2 == 0:
         return 0  # Avoid division by zero
 
     return dot_product / (magnitude1 * magnitude2)
 
-# Insert similarities into the database
-def insert_user_similarities(conn, similarities):
-    if not similarities:
-        return  # Skip if no similarities to insert
-
-    cur = conn.cursor()
-
-    query = """
-    INSERT INTO user_similarity (user_id_1, user_id_2, similarity_score, common_rated_items, last_updated)
-    VALUES (%s, %s, %s, %s, %s)
-    ON DUPLICATE KEY UPDATE 
-        similarity_score = VALUES(similarity_score),
-        common_rated_items = VALUES(common_rated_items),
-        last_updated = VALUES(last_updated);
-    """
-
-    data = [(sim['user1_id'], sim['user2_id'], sim['similarity'], sim['common_items'], sim['last_updated'])
-            for sim in similarities]
-
-    cur.executemany(query, data)
-    conn.commit()
-
-    logger.info(f"Processed batch with {len(similarities)} similarities")
-
-    cur.close()
-
-# Process a batch of users
-def process_user_batch(conn, user_batch, min_common_items, min_similarity, num_businesses):
+# Opens a writer stage that streams similarity rows into table
+def open_similarity_writer(table, columns, num_businesses):
+    return SimilarityWriter(
+        lambda: get_db_connection(num_businesses),
+        table,
+        columns,
+        chunk_size=WRITE_CHUNK_SIZE,
+        max_pending=MAX_PENDING_BATCHES
+    )
+
+# Process a batch of users, returning rows in USER_SIMILARITY_COLUMNS order
+def process_user_batch(user_batch, min_common_items, min_similarity, num_businesses, since=None):
     similarities = []
 
     for user_data in user_batch:
         user1_id = user_data['user_id']
-        pairs = fetch_user_pairs(user1_id, min_common_items, num_businesses)
+        pairs = fetch_user_pairs(user1_id, min_common_items, num_businesses, since)
 
         for pair in pairs:
             user2_id = pair['user2_id']
-            ratings1 = list(map(float, pair['ratings1'].split(',')))
-            ratings2 = list(map(float, pair['ratings2'].split(',')))
-
-            similarity = calculate_cosine_similarity(ratings1, ratings2)
+            similarity = calculate_cosine_similarity(
+                float(pair['dot_product']), float(pair['sum_squares1']), float(pair['sum_squares2'])
+            )
 
             if similarity >= min_similarity:
-                similarities.append({
-                    'user1_id': user1_id,
-                    'user2_id': user2_id,
-                    'similarity': similarity,
-                    'common_items': len(ratings1),
-                    'last_updated': int(datetime.now().timestamp() * 1000)
-                })
+                similarities.append((
+                    user1_id,
+                    user2_id,
+                    similarity,
+                    pair['common_items'],
+                    int(datetime.now().timestamp() * 1000)
+                ))
 
-    # Insert calculated similarities into the database
-    insert_user_similarities(conn, similarities)
+    return similarities
 
 # Main execution
-def run_user_similarity_calculation(min_common_items, min_similarity, batch_size, num_businesses):
+# Progress is checkpointed per batch; rerunning with the same parameters
+# after a failure resumes the build and only recomputes unfinished batches.
+# With neighbors, user_neighbors is rebuilt from the result and swapped in with it.
+# Users updated incrementally during the build are recomputed after the swap
+def run_user_similarity_calculation(min_common_items, min_similarity, batch_size, num_businesses,
+                                    checkpoint_dir=CHECKPOINT_DIR, since=None, neighbors=False):
     start_time = time.time()
-    active_users = fetch_active_users(min_common_items, num_businesses)
+    active_users = fetch_active_users(min_common_items, num_businesses, since)
     print(f"Fetched {len(active_users)} active users")
 
-    # Create user batches
-    user_batches = [active_users[i:i + batch_size] for i in range(0, len(active_users), batch_size)]
-
-    def worker(batch):
-        conn = get_db_connection(num_businesses)
-        try:
-            process_user_batch(conn, batch, min_common_items, min_similarity, num_businesses)
-        finally:
-            conn.close()
-
-    with ThreadPoolExecutor(max_workers=4) as executor:
-        futures = [executor.submit(worker, batch) for batch in user_batches]
-        for future in futures:
-            future.result()
+    # Create user batches of roughly equal estimated cost, heaviest first
+    user_batches = partition_by_cost(
+        active_users,
+        lambda user: float(user['cost']),
+        num_batches_for(len(active_users), batch_size)
+    )
+
+    # Build into a shadow table; readers keep using user_similarity until the swap
+    checkpoint = JobCheckpoint(f"mysql_user_similarity_{num_businesses}", checkpoint_dir)
+    params = {'min_common_items': min_common_items, 'min_similarity': min_similarity, 'batch_size': batch_size,
+              'since': since and str(since)}
+    shadow = start_shadow_build("user_similarity", checkpoint, params, num_businesses)
+
+    # Workers only compute; a single writer stage owns all inserts and marks
+    # a batch done once all of its rows are committed
+    with open_similarity_writer(shadow, USER_SIMILARITY_COLUMNS, num_businesses) as writer:
+        def worker(key, batch):
+            similarities = process_user_batch(batch, min_common_items, min_similarity, num_businesses, since)
+            writer.put(similarities, on_written=lambda: checkpoint.mark_done(key))
+
+        keyed_batches = [
+            (JobCheckpoint.batch_key(user['user_id'] for user in batch), batch)
+            for batch in user_batches
+        ]
+        run_batches(keyed_batches, worker, checkpoint, max_workers=MAX_WORKERS, mark_done=False)
+
+    publish_similarity_table("user_similarity", "user_neighbors", USER_SIMILARITY_COLUMNS, neighbors,
+                             checkpoint, num_businesses)
+    replay_pending_users(min_common_items, min_similarity, num_businesses, since, neighbors)
 
     print("Completed processing all user similarities.")
     end_time = time.time()  # End timing
@@ -177,16 +423,7 @@ def fetch_businesses_with_categories(num_businesses):
     conn = get_db_connection(num_businesses)
     cur = conn.cursor(dictionary=True)
 
-    query = """
-    SELECT b.business_id, GROUP_CONCAT(DISTINCT bc.category_name) AS categories
-    FROM businesses b
-    JOIN business_categories bc ON b.business_id = bc.business_id
-    GROUP BY b.business_id
-    HAVING categories IS NOT NULL
-    ORDER BY LENGTH(categories) DESC;
-    """
-
-    cur.execute(query)
+    cur.execute(BUSINESSES_WITH_CATEGORIES_QUERY)
     businesses = cur.fetchall()
 
     cur.close()
@@ -204,15 +441,16 @@ def calculate_business_pair_similarity(b1, b2, min_similarity):
     if union > 0:
         similarity = intersection / union
         if similarity >= min_similarity:
-            return {
-                'business1_id': b1['business_id'],
-                'business2_id': b2['business_id'],
-                'similarity': similarity,
-                'common_categories': intersection,
-                'last_updated': int(datetime.now().timestamp() * 1000)
-            }
+            return (
+                b1['business_id'],
+                b2['business_id'],
+                similarity,
+                intersection,
+                int(datetime.now().timestamp() * 1000)
+            )
     return None
 
+# Process a batch of business pairs, returning rows in BUSINESS_SIMILARITY_COLUMNS order
 def process_business_batch(business_batch, min_similarity, num_businesses):
     similarities = []
 
@@ -223,53 +461,45 @@ def process_business_batch(business_batch, min_similarity, num_businesses):
 
     return similarities
 
-def bulk_insert_similarities(similarities, num_businesses):
-    if not similarities:
-        return 
-
-    conn = get_db_connection(num_businesses)
-    cur = conn.cursor()
-
-    query = """
-    INSERT INTO business_similarity (business_id_1, business_id_2, similarity_score, common_categories, last_updated)
-    VALUES (%s, %s, %s, %s, %s)
-    ON DUPLICATE KEY UPDATE 
-        similarity_score = VALUES(similarity_score),
-        common_categories = VALUES(common_categories),
-        last_updated = VALUES(last_updated);
-    """
-
-    data = [(sim['business1_id'], sim['business2_id'], sim['similarity'], sim['common_categories'], sim['last_updated'])
-            for sim in similarities]
-
-    cur.executemany(query, data)
-    conn.commit()
-
-    logger.info(f"Inserted {len(similarities)} similarities into the database")
-
-    cur.close()
-    conn.close()
-
-def run_business_similarity_calculation(min_similarity, batch_size, num_businesses):
+# Lazily splits an iterable into lists of at most size items
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+# Progress is checkpointed per batch of pairs; rerunning with the same
+# parameters after a failure resumes the build.
+# With neighbors, business_neighbors is rebuilt from the result and swapped in with it
+def run_business_similarity_calculation(min_similarity, batch_size, num_businesses,
+                                        checkpoint_dir=CHECKPOINT_DIR, neighbors=False):
     businesses = fetch_businesses_with_categories(num_businesses)
     logger.info(f"Fetched {len(businesses)} businesses")
-
-    business_pairs = list(combinations(businesses, 2))
-    logger.info(f"Generated {len(business_pairs)} business pairs")
-
-    
-    pair_batches = [business_pairs[i:i + batch_size] for i in range(0, len(business_pairs), batch_size)]
-
-    def worker(batch):
-        return process_business_batch(batch, min_similarity, num_businesses)
-
-    similarities = []
-    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        futures = [executor.submit(worker, batch) for batch in pair_batches]
-        for future in futures:
-            similarities.extend(future.result())
-
-    bulk_insert_similarities(similarities, num_businesses)
+    logger.info(f"Comparing {len(businesses) * (len(businesses) - 1) // 2} business pairs")
+
+    # Build into a shadow table; readers keep using business_similarity until the swap
+    checkpoint = JobCheckpoint(f"mysql_business_similarity_{num_businesses}", checkpoint_dir)
+    params = {'min_similarity': min_similarity, 'batch_size': batch_size, 'num_businesses': len(businesses)}
+    shadow = start_shadow_build("business_similarity", checkpoint, params, num_businesses)
+
+    # Pairs are generated lazily and at most MAX_WORKERS * 2 batches are in
+    # flight, so neither the pair list nor the results are ever fully in memory.
+    # Batches are keyed by their position in the (deterministic) pair order.
+    with open_similarity_writer(shadow, BUSINESS_SIMILARITY_COLUMNS, num_businesses) as writer:
+        def worker(key, batch):
+            similarities = process_business_batch(batch, min_similarity, num_businesses)
+            writer.put(similarities, on_written=lambda: checkpoint.mark_done(key))
+
+        keyed_batches = (
+            (str(index), batch)
+            for index, batch in enumerate(chunked(combinations(businesses, 2), batch_size))
+        )
+        run_batches(keyed_batches, worker, checkpoint, max_workers=MAX_WORKERS, mark_done=False)
+
+    publish_similarity_table("business_similarity", "business_neighbors", BUSINESS_SIMILARITY_COLUMNS, neighbors,
+                             checkpoint, num_businesses)
 
 ###############################################################
 # MAIN
@@ -284,7 +514,8 @@ if __name__ == "__main__":
         print(f"Calculating business similarities for {num_businesses} businesses subset.")
 
         start_time = time.time()
-        run_business_similarity_calculation(MIN_SIMILARITY, BATCH_SIZE, num_businesses)
+        run_business_similarity_calculation(MIN_SIMILARITY, BATCH_SIZE, num_businesses,
+                                            neighbors=BUILD_NEIGHBOR_TABLES)
         end_time = time.time()
 
         print(f"Calculated user similarities for {num_businesses} businesses subset in {end_time - start_time} s.")
@@ -294,7 +525,8 @@ if __name__ == "__main__":
         print(f"Calculating user similarities for {num_businesses} businesses subset.")
 
         start_time = time.time()
-        run_user_similarity_calculation(MIN_COMMON_ITEMS, MIN_SIMILARITY, BATCH_SIZE, num_businesses)
+        run_user_similarity_calculation(MIN_COMMON_ITEMS, MIN_SIMILARITY, BATCH_SIZE, num_businesses,
+                                        neighbors=BUILD_NEIGHBOR_TABLES)
         end_time = time.time()
 
         print(f"Calculated user similarities for {num_businesses} businesses subset in {end_time - start_time} s.")
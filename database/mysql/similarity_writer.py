@@ -0,0 +1,135 @@
+import logging
+import queue
+from collections import deque
+import threading
+import time
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+class SimilarityWriter:
+    """
+    Single writer stage for similarity rows.
+
+    Worker threads hand rows to the writer with put(). The queue between them
+    is bounded, so put() blocks once max_pending batches are waiting
+    (backpressure) and memory stays flat however many pairs are produced.
+    The writer thread buffers incoming rows and, every chunk_size rows, sorts
+    them by primary key and writes them as one multi-row INSERT ... ON
+    DUPLICATE KEY UPDATE in its own transaction. Since this is the only
+    connection writing to the table, writers no longer contend for locks.
+    """
+
+    _STOP = object()
+
+    def __init__(self, conn_factory, table, columns, key_columns=2, chunk_size=1000, max_pending=16):
+        """
+        conn_factory : callable returning a new mysql.connector connection
+        table        : table to write into
+        columns      : column names, in the order of the row tuples
+        key_columns  : number of leading columns forming the primary key
+        """
+        self.conn_factory = conn_factory
+        self.table = table
+        self.columns = columns
+        self.key_columns = key_columns
+        self.chunk_size = chunk_size
+        self.rows_written = 0
+
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._error = None
+        self._callbacks = deque()
+        self._thread = threading.Thread(target=self._run, name=f"{table}-writer")
+
+        placeholders = "(" + ", ".join(["%s"] * len(columns)) + ")"
+        updates = ",\n            ".join(f"{c} = VALUES({c})" for c in columns[key_columns:])
+        self._query_prefix = f"INSERT INTO {table} ({', '.join(columns)})\n        VALUES "
+        self._query_suffix = f"\n        ON DUPLICATE KEY UPDATE\n            {updates};"
+        self._placeholders = placeholders
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+    def start(self):
+        self._thread.start()
+
+    def put(self, rows, on_written=None):
+        """
+        Queue a batch of row tuples; blocks while the writer is behind.
+
+        on_written, if given, is called from the writer thread once every
+        row of this batch has been committed.
+        """
+        if self._error:
+            raise RuntimeError(f"Similarity writer for {self.table} failed") from self._error
+        self._queue.put((list(rows), on_written))
+
+    def close(self):
+        """Flush remaining rows, stop the writer thread and surface any write error."""
+        self._queue.put(self._STOP)
+        self._thread.join()
+        if self._error:
+            raise RuntimeError(f"Similarity writer for {self.table} failed") from self._error
+        logger.info(f"Wrote {self.rows_written} rows into {self.table}")
+
+    def _write_chunk(self, conn, cur, chunk):
+        chunk.sort(key=lambda row: row[:self.key_columns])
+        query = self._query_prefix + ", ".join([self._placeholders] * len(chunk)) + self._query_suffix
+        params = [value for row in chunk for value in row]
+
+        start_time = time.time()
+        cur.execute(query, params)
+        conn.commit()
+        self.rows_written += len(chunk)
+        self._notify_written()
+        logger.debug(f"Wrote {len(chunk)} rows into {self.table} in {time.time() - start_time:.3f} s")
+
+    def _notify_written(self):
+        # Callbacks are queued in row order, so each fires once the running
+        # row count passes the position of its batch's last row
+        while self._callbacks and self._callbacks[0][0] <= self.rows_written:
+            _, callback = self._callbacks.popleft()
+            callback()
+
+    def _run(self):
+        conn = self.conn_factory()
+        cur = conn.cursor()
+        buffer = []
+        rows_received = 0
+        try:
+            while True:
+                item = self._queue.get()
+                if item is self._STOP:
+                    break
+                if self._error:
+                    continue  # Keep draining so producers never block on a dead writer
+
+                rows, on_written = item
+                try:
+                    buffer.extend(rows)
+                    rows_received += len(rows)
+                    if on_written:
+                        self._callbacks.append((rows_received, on_written))
+                    self._notify_written()
+                    while len(buffer) >= self.chunk_size:
+                        chunk, buffer = buffer[:self.chunk_size], buffer[self.chunk_size:]
+                        self._write_chunk(conn, cur, chunk)
+                except Exception as e:
+                    logger.error(f"Error writing into {self.table}: {e}")
+                    self._error = e
+                    buffer = []
+
+            if buffer and not self._error:
+                self._write_chunk(conn, cur, buffer)
+        except Exception as e:
+            logger.error(f"Error writing into {self.table}: {e}")
+            self._error = e
+        finally:
+            cur.close()
+            conn.close()
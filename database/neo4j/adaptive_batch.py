@@ -0,0 +1,105 @@
+import logging
+import threading
+import time
+from collections import deque
+import neo4j.exceptions
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Errors after which the same rows can be retried in smaller transactions:
+# the failed transaction was rolled back, and transaction memory limits
+# (MemoryPoolOutOfMemoryError) surface as transient errors
+RETRYABLE_ERRORS = (
+    neo4j.exceptions.TransientError,
+    neo4j.exceptions.SessionExpired,
+    neo4j.exceptions.ServiceUnavailable
+)
+
+class AdaptiveBatchSizer:
+    """
+    AIMD controller for the number of rows per UNWIND transaction.
+
+    Every batch that commits within target_latency grows the batch size by
+    a fixed step (additive increase). A slower batch, or a failed one,
+    multiplies the size by decrease (multiplicative decrease). The size is
+    always kept within [min_size, max_size]. This settles into a sawtooth
+    just below the largest batch the server commits within the target. That
+    size depends on the heap, the data and the load, so no single hard-coded
+    value fits every case.
+
+    Safe to share between threads.
+    """
+
+    def __init__(self, name, initial=1000, min_size=100, max_size=50000, target_latency=1.0,
+                 step=None, decrease=0.5, window=20):
+        self.name = name
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target_latency = target_latency
+        self.step = step or max(1, initial // 10)
+        self.decrease = decrease
+        self._size = max(min_size, min(initial, max_size))
+        self._recent = deque(maxlen=window)
+        self._batches = 0
+        self._failures = 0
+        self._lock = threading.Lock()
+
+    @property
+    def size(self):
+        return self._size
+
+    def _clamp(self, size):
+        return max(self.min_size, min(int(size), self.max_size))
+
+    def record_success(self, rows, latency):
+        with self._lock:
+            self._batches += 1
+            self._recent.append(rows)
+            if latency > self.target_latency:
+                self._size = self._clamp(self._size * self.decrease)
+            elif rows >= self._size:
+                # Only full batches say anything about whether a larger one fits
+                self._size = self._clamp(self._size + self.step)
+
+    def record_failure(self, rows, error):
+        with self._lock:
+            self._failures += 1
+            self._size = self._clamp(min(self._size, rows) * self.decrease)
+        logger.warning(f"{self.name}: batch of {rows} rows failed ({error}); batch size now {self._size}")
+
+    def run(self, rows, write, max_retries=5):
+        """
+        Writes rows with write(batch), in batches of the current size.
+
+        A batch that fails with a retryable error is retried at the reduced
+        size, up to max_retries times in a row. Other errors propagate.
+        write must commit each batch in a single transaction (or be
+        idempotent), since a failed batch is written again.
+        """
+        position = 0
+        retries = 0
+        while position < len(rows):
+            batch = rows[position:position + self._size]
+            start_time = time.time()
+            try:
+                write(batch)
+            except RETRYABLE_ERRORS as e:
+                retries += 1
+                if retries > max_retries or len(batch) <= self.min_size:
+                    raise
+                self.record_failure(len(batch), e)
+                continue
+
+            self.record_success(len(batch), time.time() - start_time)
+            position += len(batch)
+            retries = 0
+
+    def log(self):
+        with self._lock:
+            recent = list(self._recent)
+        average = sum(recent) / len(recent) if recent else self._size
+        logger.info(f"{self.name}: batch size converged to {self._size} "
+                    f"(last {len(recent)} batches averaged {average:.0f} rows; "
+                    f"{self._batches} batches, {self._failures} failures)")
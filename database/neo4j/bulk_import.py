@@ -0,0 +1,301 @@
+"""
+Offline bulk import for fresh Neo4j databases.
+
+Converts the ratings CSV and business metadata (JSON lines or CSV) into
+node and relationship CSV files for `neo4j-admin database import full`,
+which builds the store directly instead of running three index lookups per
+rating through Cypher. The resulting graph matches what load_data.py's online
+loaders produce: Category nodes are deduplicated, a (user, business) rated
+more than once anywhere in the file keeps its last rating (like the online
+MERGE), every rating whose business is unknown is dropped (the online MATCH
+skips them too),
+normalized_rating is precomputed, and businesses carry the same categories
+list and Cat_<name> labels (see category_labels.py) and rating aggregates
+(see rating_aggregates.py).
+
+The import replaces the whole database, so the Neo4j server must be stopped
+while it runs. Afterwards, start the server and create the schema with
+`python load_data.py --schema`. Use the online loader to append later data.
+"""
+
+import argparse
+import ast
+import json
+import logging
+import os
+import shutil
+import subprocess
+import time
+import numpy as np
+import pandas as pd
+from category_labels import CATEGORY_LABEL_PREFIX
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+BUSINESS_COLUMNS = {
+    'gmap_id': 'gmap_id:ID(Business)',
+    'name': 'name',
+    'avg_rating': 'avg_rating:double',
+    'num_of_reviews': 'num_of_reviews:long',
+    'price': 'price',
+    'latitude': 'latitude:double',
+    'longitude': 'longitude:double',
+    'rating_sum': 'rating_sum:double',
+    'rating_count': 'rating_count:long',
+    'rating_avg': 'rating_avg:double',
+    'category_names': 'categories:string[]',
+    'labels': ':LABEL'
+}
+
+# Separates array values and labels in a cell; category names may contain
+# neo4j-admin's default ';'
+ARRAY_DELIMITER = '\x1f'
+
+RATING_COLUMNS = {
+    'user': ':START_ID(User)',
+    'business': ':END_ID(Business)',
+    'rating': 'rating:double',
+    'timestamp': 'timestamp:long',
+    'last_updated': 'last_updated:long',
+    'normalized_rating': 'normalized_rating:int'
+}
+
+def normalized_ratings(ratings):
+    """Vectorized version of the normalized_rating CASE in load_ratings."""
+    return np.select(
+        [ratings >= 4.5, ratings >= 3.5, ratings >= 2.5, ratings >= 1.5],
+        [5, 4, 3, 2],
+        default=1
+    )
+
+def _parse_categories(value):
+    if isinstance(value, list):
+        return value
+    if isinstance(value, str):
+        try:
+            return ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            return []
+    return []
+
+def distinct_categories(categories):
+    """Non-empty category names of a business, without duplicates, in order."""
+    return list(dict.fromkeys(c for c in categories if c))
+
+def read_businesses(metadata_file, max_entries=-1):
+    """
+    Reads business metadata as a DataFrame with one row per business and
+    its list of categories. Duplicate gmap_ids keep their last entry, like
+    the MERGE in the online loaders.
+    """
+    if metadata_file.endswith('.json'):
+        with open(metadata_file) as file:
+            records = [json.loads(line) for line in file if line.strip()]
+        businesses = pd.DataFrame.from_records(records)
+        # The JSON loader stores one full-weight BELONGS_TO per category
+        split_weight = False
+    elif metadata_file.endswith('.csv'):
+        businesses = pd.read_csv(metadata_file)
+        # The CSV loader splits the weight across a business's categories
+        split_weight = True
+    else:
+        raise ValueError(f"Unsupported file format for business data: {metadata_file}")
+
+    if max_entries != -1:
+        businesses = businesses.head(max_entries)
+
+    businesses = businesses.drop_duplicates('gmap_id', keep='last')
+    businesses['categories'] = businesses['category'].map(_parse_categories)
+    businesses['category_names'] = businesses['categories'].map(distinct_categories)
+    businesses['avg_rating'] = businesses.get('avg_rating', pd.Series(0.0, index=businesses.index)).fillna(0.0)
+    businesses['num_of_reviews'] = businesses.get('num_of_reviews', pd.Series(0, index=businesses.index)).fillna(0).astype('int64')
+    for column in BUSINESS_COLUMNS:
+        if column not in businesses:
+            businesses[column] = None
+    return businesses, split_weight
+
+def write_business_files(businesses, split_weight, output_dir, last_updated):
+    """Writes businesses.csv, categories.csv and belongs_to.csv."""
+    # Business is added by --nodes=Business=..., :LABEL only adds the category labels
+    nodes = businesses.assign(
+        labels=businesses['category_names'].map(
+            lambda names: ARRAY_DELIMITER.join(CATEGORY_LABEL_PREFIX + name for name in names)),
+        category_names=businesses['category_names'].map(ARRAY_DELIMITER.join)
+    )
+    nodes[list(BUSINESS_COLUMNS)].rename(columns=BUSINESS_COLUMNS).to_csv(
+        os.path.join(output_dir, "businesses.csv"), index=False)
+
+    belongs_to = businesses[['gmap_id', 'categories']].assign(num_categories=businesses['categories'].map(len))
+    belongs_to = belongs_to.explode('categories').rename(columns={'categories': 'category'})
+    belongs_to = belongs_to[belongs_to['category'].notna() & (belongs_to['category'] != '')]
+    belongs_to = belongs_to.drop_duplicates(['gmap_id', 'category'])
+    belongs_to['weight'] = 1.0 / belongs_to.pop('num_categories') if split_weight else 1.0
+    belongs_to['last_updated'] = last_updated
+
+    categories = pd.DataFrame({'name:ID(Category)': belongs_to['category'].drop_duplicates()})
+    categories.to_csv(os.path.join(output_dir, "categories.csv"), index=False)
+
+    belongs_to.rename(columns={
+        'gmap_id': ':START_ID(Business)',
+        'category': ':END_ID(Category)',
+        'weight': 'weight:double',
+        'last_updated': 'last_updated:long'
+    }).to_csv(os.path.join(output_dir, "belongs_to.csv"), index=False)
+
+    logger.info(f"Wrote {len(businesses)} businesses, {len(categories)} categories "
+                f"and {len(belongs_to)} BELONGS_TO relationships")
+
+def _read_ratings(ratings_file, chunk_size, max_entries):
+    """Chunks of the ratings CSV, stopping after max_entries rows (-1 for all)."""
+    rows_read = 0
+    for chunk in pd.read_csv(ratings_file, chunksize=chunk_size):
+        if max_entries != -1:
+            chunk = chunk.head(max_entries - rows_read)
+            if chunk.empty:
+                return
+        rows_read += len(chunk)
+        yield chunk
+
+def rating_pair_hashes(chunk):
+    """64-bit hash of the (user, business) of every row of a ratings chunk."""
+    return pd.util.hash_pandas_object(chunk[['user', 'business']].astype(str), index=False).to_numpy()
+
+def last_occurrences(hashes):
+    """
+    Boolean array that is True for the last row of every pair, given the
+    rating_pair_hashes of all chunks of a file in order.
+    """
+    if not hashes:
+        return np.zeros(0, dtype=bool)
+    return ~pd.Series(np.concatenate(hashes)).duplicated(keep='last').to_numpy()
+
+def last_rating_mask(ratings_file, chunk_size=1000000, max_entries=-1):
+    """
+    Boolean array over the rows of the ratings CSV that is True for the last
+    rating of every (user, business) across the whole file.
+
+    A first pass over the file keeps a 64-bit hash per row (8 bytes per
+    rating) rather than the pairs themselves.
+    """
+    return last_occurrences([
+        rating_pair_hashes(chunk) for chunk in _read_ratings(ratings_file, chunk_size, max_entries)
+    ])
+
+def write_rating_files(ratings_file, business_ids, output_dir, last_updated, chunk_size=1000000, max_entries=-1):
+    """
+    Streams the ratings CSV into users.csv and rated.csv chunk by chunk, so
+    memory holds one chunk plus the set of user ids and the mask of
+    last_rating_mask, which drops repeated (user, business) ratings.
+
+    Returns:
+        DataFrame of rating_sum and rating_count indexed by business
+    """
+    rated_path = os.path.join(output_dir, "rated.csv")
+    last_ratings = last_rating_mask(ratings_file, chunk_size, max_entries)
+    users = set()
+    aggregates = pd.DataFrame({'rating_sum': pd.Series(dtype='float64'),
+                               'rating_count': pd.Series(dtype='int64')})
+    rows_read = 0
+    total_ratings = 0
+    skipped = 0
+    header = True
+
+    for chunk in _read_ratings(ratings_file, chunk_size, max_entries):
+        last = last_ratings[rows_read:rows_read + len(chunk)]
+        rows_read += len(chunk)
+
+        known = chunk['business'].isin(business_ids).to_numpy()
+        skipped += int((~known).sum())
+        chunk = chunk[known & last]
+
+        chunk = chunk.assign(
+            last_updated=last_updated,
+            normalized_rating=normalized_ratings(chunk['rating'].to_numpy())
+        )
+        chunk[list(RATING_COLUMNS)].rename(columns=RATING_COLUMNS).to_csv(
+            rated_path, mode='w' if header else 'a', header=header, index=False)
+        header = False
+
+        users.update(chunk['user'].unique())
+        chunk_aggregates = chunk.groupby('business')['rating'].agg(rating_sum='sum', rating_count='count')
+        aggregates = aggregates.add(chunk_aggregates, fill_value=0)
+        total_ratings += len(chunk)
+        logger.info(f"Converted {total_ratings} ratings")
+
+    pd.DataFrame({'user_id:ID(User)': sorted(users)}).to_csv(os.path.join(output_dir, "users.csv"), index=False)
+    logger.info(f"Wrote {len(users)} users and {total_ratings} RATED relationships "
+                f"({skipped} ratings of unknown businesses skipped)")
+    return aggregates
+
+def write_import_files(ratings_file, metadata_file, output_dir, max_entries=-1):
+    """Writes every CSV file needed by neo4j-admin into output_dir."""
+    start_time = time.time()
+    os.makedirs(output_dir, exist_ok=True)
+    last_updated = int(time.time() * 1000)
+
+    businesses, split_weight = read_businesses(metadata_file, max_entries)
+    aggregates = write_rating_files(ratings_file, set(businesses['gmap_id']), output_dir, last_updated,
+                                    max_entries=max_entries)
+
+    # Business nodes are written last, with the aggregates of their ratings
+    aggregates = aggregates.reindex(businesses['gmap_id'])
+    businesses['rating_sum'] = aggregates['rating_sum'].fillna(0.0).to_numpy()
+    businesses['rating_count'] = aggregates['rating_count'].fillna(0).astype('int64').to_numpy()
+    businesses['rating_avg'] = (businesses['rating_sum'] / businesses['rating_count']).where(
+        businesses['rating_count'] > 0)
+    write_business_files(businesses, split_weight, output_dir, last_updated)
+
+    logger.info(f"Import files written to {output_dir} in {time.time() - start_time:.2f} seconds")
+
+def import_command(output_dir, database="neo4j", neo4j_admin="neo4j-admin"):
+    """The neo4j-admin invocation that imports the files in output_dir."""
+    path = lambda name: os.path.abspath(os.path.join(output_dir, name))
+    return [
+        neo4j_admin, "database", "import", "full", database,
+        f"--nodes=Business={path('businesses.csv')}",
+        f"--nodes=Category={path('categories.csv')}",
+        f"--nodes=User={path('users.csv')}",
+        f"--relationships=BELONGS_TO={path('belongs_to.csv')}",
+        f"--relationships=RATED={path('rated.csv')}",
+        "--array-delimiter=U+001F",
+        "--overwrite-destination"
+    ]
+
+def run_import(output_dir, database="neo4j", neo4j_admin="neo4j-admin"):
+    """Runs neo4j-admin on the import files. The server must be stopped."""
+    if shutil.which(neo4j_admin) is None:
+        raise FileNotFoundError(f"{neo4j_admin} not found; run the import on the database host")
+
+    command = import_command(output_dir, database, neo4j_admin)
+    logger.info(f"Running {' '.join(command)}")
+    start_time = time.time()
+    subprocess.run(command, check=True)
+    logger.info(f"neo4j-admin import took {time.time() - start_time:.2f} seconds")
+
+def main(ratings_file, metadata_file, output_dir="import", database="neo4j", run=False):
+    write_import_files(ratings_file, metadata_file, output_dir)
+
+    if run:
+        run_import(output_dir, database)
+    else:
+        print("Stop Neo4j and run:")
+        print(" ".join(import_command(output_dir, database)))
+    print("Then start Neo4j and run: python load_data.py --schema")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Write neo4j-admin import files for a fresh database')
+    parser.add_argument('--ratings', type=str, default='data/rating-Georgia.csv',
+                      help='Path to ratings CSV file')
+    parser.add_argument('--metadata', type=str, default='data/meta-Georgia.json',
+                      help='Path to metadata JSON or CSV file')
+    parser.add_argument('--import-dir', type=str, default='import',
+                      help='Directory to write the import CSV files to')
+    parser.add_argument('--database', type=str, default='neo4j',
+                      help='Database to import into')
+    parser.add_argument('--run-import', action='store_true',
+                      help='Run neo4j-admin after writing the files (Neo4j must be stopped)')
+
+    args = parser.parse_args()
+    main(args.ratings, args.metadata, args.import_dir, args.database, args.run_import)
@@ -0,0 +1,26 @@
+"""
+Denormalized category membership on Business nodes.
+
+Besides its BELONGS_TO relationships, every Business carries its category
+names in a `categories` list property and one `Cat_<name>` label per
+category. A query can then filter candidates with `(b:`Cat_Restaurant`)`, a
+label check on the node it already holds, instead of hopping to the
+Category node, which for large categories is a supernode.
+
+Labels are written with dynamic labels (`SET b:$(labels)`, Neo4j 5.26+) from
+the raw `Cat_<name>` strings; queries that name a category label statically
+must escape it with category_label().
+"""
+
+CATEGORY_LABEL_PREFIX = "Cat_"
+
+# Cypher expression turning a list of category names into label strings
+CATEGORY_LABELS_EXPRESSION = "[name IN {names} | '" + CATEGORY_LABEL_PREFIX + "' + name]"
+
+def category_label(name):
+    """Backtick-escaped label of a category, for use inside query text."""
+    return "`" + (CATEGORY_LABEL_PREFIX + name).replace("`", "``") + "`"
+
+def category_labels_expression(names):
+    """CATEGORY_LABELS_EXPRESSION for the Cypher list expression `names`."""
+    return CATEGORY_LABELS_EXPRESSION.replace('{names}', names)
@@ -0,0 +1,53 @@
+import logging
+from database.ingestion import BufferedRatingWriter
+from database.neo4j.rating_aggregates import RATING_AGGREGATES_UPDATE
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Writes a batch of ratings, creating missing users; ratings of unknown
+# businesses are skipped
+RATINGS_WRITE_QUERY = """
+UNWIND $ratings AS row
+MERGE (u:User {user_id: row.user_id})
+WITH u, row
+MATCH (b:Business {gmap_id: row.business_id})
+MERGE (u)-[r:RATED]->(b)
+WITH b, r, row, r.rating AS previous
+SET r.rating = row.rating,
+    r.timestamp = row.timestamp,
+    r.last_updated = timestamp(),
+    r.normalized_rating = CASE
+        WHEN row.rating >= 4.5 THEN 5
+        WHEN row.rating >= 3.5 THEN 4
+        WHEN row.rating >= 2.5 THEN 3
+        WHEN row.rating >= 1.5 THEN 2
+        ELSE 1
+    END
+WITH b, row.rating - coalesce(previous, 0) AS delta,
+     CASE WHEN previous IS NULL THEN 1 ELSE 0 END AS added
+""" + RATING_AGGREGATES_UPDATE
+
+class Neo4jRatingIngestor(BufferedRatingWriter):
+    """
+    Rating ingestion into Neo4j: every flush writes its ratings with one
+    UNWIND statement in a managed transaction, which the driver retries on
+    transient failures (see Neo4jConnection.execute_write). The business
+    rating aggregates are updated in the same transaction.
+
+    Rows are sorted by business, so concurrent ingestors lock Business
+    nodes in the same order.
+    """
+
+    def __init__(self, conn, max_batch_size=500, max_delay=0.05):
+        """conn : Neo4jConnection, owned by the caller"""
+        self.conn = conn
+        super().__init__('RATED', max_batch_size, max_delay)
+
+    def _write_batch(self, batch):
+        ratings = [
+            {'user_id': user_id, 'business_id': business_id, 'rating': rating, 'timestamp': timestamp}
+            for user_id, business_id, rating, timestamp in sorted(batch, key=lambda row: (row[1], row[0]))
+        ]
+        self.conn.execute_write(RATINGS_WRITE_QUERY, {'ratings': ratings})
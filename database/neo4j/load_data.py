@@ -4,6 +4,13 @@ import json
 import argparse
 import ast
 from neo4j_connection import Neo4jConnection
+from bulk_import import write_import_files, import_command
+from parallel_loader import ParallelLoader
+from adaptive_batch import AdaptiveBatchSizer
+from node_cache import NodeCache
+from maintenance import delete_relationships, delete_nodes, run_in_transactions
+from category_labels import category_labels_expression
+from rating_aggregates import RATING_AGGREGATES_UPDATE, RATING_AGGREGATES_RECOMPUTE
 
 def create_constraints(conn):
     constraints = [
@@ -30,12 +37,18 @@ def create_constraints(conn):
            
         """CREATE INDEX business_avg_rating_idx IF NOT EXISTS 
            FOR (b:Business) ON (b.avg_rating)""",
+        """CREATE INDEX business_rating_avg_idx IF NOT EXISTS 
+           FOR (b:Business) ON (b.rating_avg)""",
         """CREATE INDEX business_category_idx IF NOT EXISTS 
            FOR ()-[r:BELONGS_TO]-() ON (r.category)""",
-        """CREATE INDEX similarity_score_idx IF NOT EXISTS 
-           FOR ()-[s:SIMILAR_TO]-() ON (s.score)""",
-        """CREATE INDEX similarity_timestamp_idx IF NOT EXISTS 
-           FOR ()-[s:SIMILAR_TO]-() ON (s.last_updated)"""
+        """CREATE INDEX user_similar_score_idx IF NOT EXISTS 
+           FOR ()-[s:USER_SIMILAR]-() ON (s.score)""",
+        """CREATE INDEX user_similar_timestamp_idx IF NOT EXISTS 
+           FOR ()-[s:USER_SIMILAR]-() ON (s.last_updated)""",
+        """CREATE INDEX business_similar_score_idx IF NOT EXISTS 
+           FOR ()-[s:BUSINESS_SIMILAR]-() ON (s.score)""",
+        """CREATE INDEX business_similar_timestamp_idx IF NOT EXISTS 
+           FOR ()-[s:BUSINESS_SIMILAR]-() ON (s.last_updated)"""
     ]
     
     for constraint in constraints:
@@ -55,14 +68,20 @@ def create_schema_for_recommendations(conn):
         """CREATE INDEX user_rating_composite_idx IF NOT EXISTS 
            FOR ()-[r:RATED]-() ON (r.rating, r.timestamp)""",
         """CREATE INDEX similar_business_composite_idx IF NOT EXISTS 
-           FOR ()-[s:SIMILAR_TO]-() ON (s.score, s.last_updated)"""
+           FOR ()-[s:BUSINESS_SIMILAR]-() ON (s.score, s.last_updated)""",
+        """CREATE INDEX similar_user_composite_idx IF NOT EXISTS 
+           FOR ()-[s:USER_SIMILAR]-() ON (s.score, s.last_updated)"""
     ]
     
     relationship_constraints = [
-        """CREATE CONSTRAINT similar_to_score_exists IF NOT EXISTS 
-           FOR ()-[s:SIMILAR_TO]-() REQUIRE s.score IS NOT NULL""",
-        """CREATE CONSTRAINT similar_to_timestamp_exists IF NOT EXISTS 
-           FOR ()-[s:SIMILAR_TO]-() REQUIRE s.last_updated IS NOT NULL"""
+        """CREATE CONSTRAINT user_similar_score_exists IF NOT EXISTS 
+           FOR ()-[s:USER_SIMILAR]-() REQUIRE s.score IS NOT NULL""",
+        """CREATE CONSTRAINT user_similar_timestamp_exists IF NOT EXISTS 
+           FOR ()-[s:USER_SIMILAR]-() REQUIRE s.last_updated IS NOT NULL""",
+        """CREATE CONSTRAINT business_similar_score_exists IF NOT EXISTS 
+           FOR ()-[s:BUSINESS_SIMILAR]-() REQUIRE s.score IS NOT NULL""",
+        """CREATE CONSTRAINT business_similar_timestamp_exists IF NOT EXISTS 
+           FOR ()-[s:BUSINESS_SIMILAR]-() REQUIRE s.last_updated IS NOT NULL"""
     ]
     
     for index in composite_indexes:
@@ -77,33 +96,85 @@ def create_schema_for_recommendations(conn):
         except Exception as e:
             print(f"Warning: Could not create relationship constraint: {str(e)}")
 
+BUSINESSES_JSON_QUERY = """
+UNWIND $batch AS business
+MERGE (b:Business {gmap_id: business.gmap_id})
+SET b += {
+    name: business.name,
+    avg_rating: COALESCE(business.avg_rating, 0.0),
+    num_of_reviews: COALESCE(business.num_of_reviews, 0),
+    price: business.price,
+    latitude: business.latitude,
+    longitude: business.longitude
+}
+WITH b, business, [name IN COALESCE(business.category, []) WHERE name <> ''] AS categories
+SET b.categories = categories, b:$({labels})
+WITH b, business
+UNWIND business.category AS category
+MERGE (c:Category {name: category})
+MERGE (b)-[:BELONGS_TO {
+    weight: 1.0,
+    last_updated: timestamp()
+}]->(c)
+""".replace('{labels}', category_labels_expression('categories'))
+
+# The CSV loader splits the BELONGS_TO weight across a business's categories
+BUSINESSES_CSV_QUERY = """
+UNWIND $batch AS business
+MERGE (b:Business {gmap_id: business.gmap_id})
+SET b += {
+    name: business.name,
+    avg_rating: COALESCE(business.avg_rating, 0.0),
+    num_of_reviews: COALESCE(business.num_of_reviews, 0),
+    price: business.price,
+    latitude: business.latitude,
+    longitude: business.longitude
+}
+WITH b, business, [name IN COALESCE(business.categories, []) WHERE name <> ''] AS categories
+SET b.categories = categories, b:$({labels})
+WITH b, business
+UNWIND business.categories AS category
+WITH b, category, business.categories AS categories
+WHERE category IS NOT NULL AND category <> ''
+MERGE (c:Category {name: category})
+MERGE (b)-[:BELONGS_TO {
+    weight: 1.0 / size(categories),
+    last_updated: timestamp()
+}]->(c)
+""".replace('{labels}', category_labels_expression('categories'))
+
+# Businesses are matched by the element ids resolved through a NodeCache
+RATINGS_QUERY = """
+UNWIND $batch AS rating
+MERGE (u:User {user_id: rating.user})
+WITH u, rating
+MATCH (b) WHERE elementId(b) = rating.business_ref
+MERGE (u)-[r:RATED]->(b)
+WITH b, r, rating, r.rating AS previous
+SET r.rating = rating.rating,
+    r.timestamp = rating.timestamp,
+    r.last_updated = timestamp(),
+    r.normalized_rating = CASE 
+        WHEN rating.rating >= 4.5 THEN 5
+        WHEN rating.rating >= 3.5 THEN 4
+        WHEN rating.rating >= 2.5 THEN 3
+        WHEN rating.rating >= 1.5 THEN 2
+        ELSE 1
+    END
+WITH b, rating.rating - coalesce(previous, 0) AS delta,
+     CASE WHEN previous IS NULL THEN 1 ELSE 0 END AS added
+""" + RATING_AGGREGATES_UPDATE
+
 def load_businesses_json(conn, metadata_file, batch_size=1000, max_entries=1000):
     print("Loading business data from JSON file...")
     def process_batch(batch):
-        query = """
-        UNWIND $batch AS business
-        MERGE (b:Business {gmap_id: business.gmap_id})
-        SET b += {
-            name: business.name,
-            avg_rating: COALESCE(business.avg_rating, 0.0),
-            num_of_reviews: COALESCE(business.num_of_reviews, 0),
-            price: business.price,
-            latitude: business.latitude,
-            longitude: business.longitude
-        }
-        WITH b, business
-        UNWIND business.category AS category
-        MERGE (c:Category {name: category})
-        MERGE (b)-[:BELONGS_TO {
-            weight: 1.0,
-            last_updated: timestamp()
-        }]->(c)
-        """
-        conn.query(query, {'batch': batch})
+        conn.query(BUSINESSES_JSON_QUERY, {'batch': batch})
     
     if(max_entries == -1):
         max_entries = float('inf')
     
+    # Rows per transaction start at batch_size and adapt to the observed latency
+    sizer = AdaptiveBatchSizer("business load", initial=batch_size)
     current_batch = []
     total_entries = 0
     
@@ -121,43 +192,25 @@ def load_businesses_json(conn, metadata_file, batch_size=1000, max_entries=1000)
             })
             total_entries += 1
             
-            if len(current_batch) >= batch_size:
-                process_batch(current_batch)
+            if len(current_batch) >= sizer.size:
+                sizer.run(current_batch, process_batch)
                 current_batch = []
     
     # Process remaining batch
     if current_batch:
-        process_batch(current_batch)
+        sizer.run(current_batch, process_batch)
+    sizer.log()
         
 def load_businesses_csv(conn, metadata_file, batch_size=1000, max_entries=1000):
     print("Loading businesses from CSV file...")
     def process_batch(batch):
-        query = """
-        UNWIND $batch AS business
-        MERGE (b:Business {gmap_id: business.gmap_id})
-        SET b += {
-            name: business.name,
-            avg_rating: COALESCE(business.avg_rating, 0.0),
-            num_of_reviews: COALESCE(business.num_of_reviews, 0),
-            price: business.price,
-            latitude: business.latitude,
-            longitude: business.longitude
-        }
-        WITH b, business
-        UNWIND business.categories AS category
-        WITH b, category, business.categories AS categories
-        WHERE category IS NOT NULL AND category <> ''
-        MERGE (c:Category {name: category})
-        MERGE (b)-[:BELONGS_TO {
-            weight: 1.0 / size(categories),
-            last_updated: timestamp()
-        }]->(c)
-        """
-        conn.query(query, {'batch': batch})
+        conn.query(BUSINESSES_CSV_QUERY, {'batch': batch})
     
     if(max_entries == -1):
         max_entries = float('inf')
 
+    # Rows per transaction start at batch_size and adapt to the observed latency
+    sizer = AdaptiveBatchSizer("business load", initial=batch_size)
     current_batch = []
     total_entries = 0
 
@@ -184,8 +237,8 @@ def load_businesses_csv(conn, metadata_file, batch_size=1000, max_entries=1000):
             current_batch.append(business)
             total_entries += 1
 
-            if len(current_batch) >= batch_size:
-                process_batch(current_batch)
+            if len(current_batch) >= sizer.size:
+                sizer.run(current_batch, process_batch)
                 current_batch = []
 
         if total_entries >= max_entries:
@@ -193,33 +246,27 @@ def load_businesses_csv(conn, metadata_file, batch_size=1000, max_entries=1000):
 
     # Process remaining batch
     if current_batch:
-        process_batch(current_batch)
+        sizer.run(current_batch, process_batch)
+    sizer.log()
 
 def load_ratings(conn, ratings_file, batch_size=10000, max_entries=1000):
     print("Loading ratings data from CSV file...")
+    # Businesses already exist, so each one is resolved to its element id once
+    business_refs = NodeCache(conn, 'Business', 'gmap_id')
+
     def process_batch(batch):
-        query = """
-        UNWIND $batch AS rating
-        MERGE (u:User {user_id: rating.user})
-        WITH u, rating
-        MATCH (b:Business {gmap_id: rating.business})
-        MERGE (u)-[r:RATED]->(b)
-        SET r.rating = rating.rating,
-            r.timestamp = rating.timestamp,
-            r.last_updated = timestamp(),
-            r.normalized_rating = CASE 
-                WHEN rating.rating >= 4.5 THEN 5
-                WHEN rating.rating >= 3.5 THEN 4
-                WHEN rating.rating >= 2.5 THEN 3
-                WHEN rating.rating >= 1.5 THEN 2
-                ELSE 1
-            END
-        """
-        conn.query(query, {'batch': batch})
+        # A pair repeated within one UNWIND would read no previous rating for
+        # either row and be counted twice in the aggregates; keep the last one
+        batch = list({(rating['user'], rating['business']): rating for rating in batch}.values())
+        refs = business_refs.resolve([rating['business'] for rating in batch])
+        batch = [dict(rating, business_ref=refs.get(rating['business'])) for rating in batch]
+        conn.query(RATINGS_QUERY, {'batch': batch})
 
     if(max_entries == -1):
         max_entries = float('inf')
 
+    # Rows per transaction start at batch_size and adapt to the observed latency
+    sizer = AdaptiveBatchSizer("ratings load", initial=batch_size)
     current_batch = []
     total_entries = 0
     
@@ -230,8 +277,8 @@ def load_ratings(conn, ratings_file, batch_size=10000, max_entries=1000):
             current_batch.append(record)
             total_entries += 1
             
-            if len(current_batch) >= batch_size:
-                process_batch(current_batch)
+            if len(current_batch) >= sizer.size:
+                sizer.run(current_batch, process_batch)
                 current_batch = []
         
         if total_entries >= max_entries:
@@ -239,7 +286,9 @@ def load_ratings(conn, ratings_file, batch_size=10000, max_entries=1000):
     
     # Process remaining batch
     if current_batch:
-        process_batch(current_batch)
+        sizer.run(current_batch, process_batch)
+    sizer.log()
+    business_refs.log()
 
 def clear_database(conn):
     """
@@ -253,23 +302,7 @@ def clear_database(conn):
         
         # Drop all indexes
         "SHOW INDEXES",
-        "DROP INDEX",
-
-        # Delete all relationships
-        "CALL apoc.periodic.iterate("
-        "  'MATCH ()-[r]->() RETURN r',"
-        "  'DELETE r',"
-        "  {batchSize: 1000, iterateList: true}"
-        ") YIELD batches, total"
-        " RETURN batches, total",
-        
-        # Delete all nodes
-        "CALL apoc.periodic.iterate("
-        "  'MATCH (n) RETURN n',"
-        "  'DETACH DELETE n',"
-        "  {batchSize: 10000, parallel: false}"
-        ") YIELD batches, total"
-        " RETURN batches, total"
+        "DROP INDEX"
     ]
     
     constraints = conn.query(queries[0])
@@ -286,14 +319,43 @@ def clear_database(conn):
         else:
             conn.query(f"{queries[3]} {index['indexName']}")
     
-    conn.query(queries[4])
-
-    conn.query(queries[5])
+    # Delete all relationships, then all nodes, in batched server-side
+    # transactions (no APOC needed)
+    delete_relationships(conn, "()-[r]->()", batch_size=10000, count_first=True)
+    delete_nodes(conn, "(n)", batch_size=10000, count_first=True)
     
     print("Database cleared successfully")
 
+def backfill_category_labels(conn, batch_size=10000):
+    """
+    Sets the categories list and Cat_<name> labels (see category_labels.py)
+    on Business nodes loaded before the loaders maintained them, from their
+    BELONGS_TO relationships
+    """
+    action = """
+    OPTIONAL MATCH (b)-[:BELONGS_TO]->(c:Category)
+    WITH b, [name IN COLLECT(c.name) WHERE name IS NOT NULL] AS categories
+    SET b.categories = categories, b:$({labels})
+    """.replace('{labels}', category_labels_expression('categories'))
+    processed = run_in_transactions(conn, "(b:Business)", "b", action, where="b.categories IS NULL",
+                                    batch_size=batch_size, description="businesses", count_first=True)
+    print(f"Backfilled category labels on {processed} businesses")
+
+def backfill_rating_aggregates(conn, batch_size=10000):
+    """
+    Computes rating_sum, rating_count and rating_avg (see
+    rating_aggregates.py) for Business nodes that do not have them yet. Run
+    it before resuming rating writes, which would otherwise start the
+    aggregates of such businesses from zero
+    """
+    processed = run_in_transactions(conn, "(b:Business)", "b", RATING_AGGREGATES_RECOMPUTE,
+                                    where="b.rating_count IS NULL", batch_size=batch_size,
+                                    description="businesses", count_first=True)
+    print(f"Backfilled rating aggregates on {processed} businesses")
+
 def main(clear_existing=False, setup_schema=False, load_data=False, 
-         ratings_file='data/rating-Georgia.csv', metadata_file='data/meta-Georgia.json'):
+         ratings_file='data/rating-Georgia.csv', metadata_file='data/meta-Georgia.json',
+         mode='online', import_dir='import', category_labels=False, rating_aggregates=False):
     """
     Main function to set up Neo4j database
     
@@ -303,7 +365,26 @@ def main(clear_existing=False, setup_schema=False, load_data=False,
     load_data (bool): If True, loads the business and ratings data
     ratings_file (str): Path to the ratings CSV file
     metadata_file (str): Path to the metadata JSON file
+    mode (str): 'online' loads through Cypher and can append to an existing
+                database; 'parallel' does the same in parallel phases (see
+                parallel_loader.py); 'bulk' writes neo4j-admin import files
+                for a fresh one
+    import_dir (str): Directory for the neo4j-admin import files in bulk mode
+    category_labels (bool): If True, backfills the denormalized category
+                            labels on businesses loaded without them
+    rating_aggregates (bool): If True, backfills the live rating aggregates
+                              on businesses loaded without them
     """
+    if load_data and mode == 'bulk':
+        # The offline import needs the server stopped, so nothing else can run
+        # in the same invocation; see bulk_import.py
+        print("Writing neo4j-admin import files...")
+        write_import_files(ratings_file, metadata_file, import_dir)
+        print("Stop Neo4j and run:")
+        print(" ".join(import_command(import_dir)))
+        print("Then start Neo4j and run: python load_data.py --schema")
+        return
+
     # Connect to Neo4j
     conn = Neo4jConnection(
         uri="neo4j://localhost:7687",
@@ -329,6 +410,13 @@ def main(clear_existing=False, setup_schema=False, load_data=False,
         # Load data if requested
         if load_data:
             print("Loading data...")
+            if mode == 'parallel':
+                loader = ParallelLoader(conn)
+                new_businesses = loader.load_businesses(metadata_file)
+                loader.load_ratings(ratings_file, new_businesses)
+                print("Data loading completed successfully")
+                return
+
             try:
                 # Check file extension and call the appropriate function
                 if metadata_file.endswith('.json'):
@@ -350,8 +438,16 @@ def main(clear_existing=False, setup_schema=False, load_data=False,
                 raise
 
             print("Data loading completed successfully")
+
+        if category_labels:
+            print("Backfilling category labels...")
+            backfill_category_labels(conn)
+
+        if rating_aggregates:
+            print("Backfilling rating aggregates...")
+            backfill_rating_aggregates(conn)
         
-        if not any([clear_existing, setup_schema, load_data]):
+        if not any([clear_existing, setup_schema, load_data, category_labels, rating_aggregates]):
             print("No operations requested. Use --help to see available options.")
             
     except Exception as e:
@@ -372,6 +468,15 @@ if __name__ == "__main__":
                       help='Path to ratings CSV file')
     parser.add_argument('--metadata', type=str, default='data/meta-Georgia.json',
                       help='Path to metadata JSON file')
+    parser.add_argument('--mode', choices=['online', 'parallel', 'bulk'], default='online',
+                      help='online: load through Cypher (appends); parallel: same in parallel phases; '
+                           'bulk: write neo4j-admin import files for a fresh database')
+    parser.add_argument('--import-dir', type=str, default='import',
+                      help='Directory for the neo4j-admin import files in bulk mode')
+    parser.add_argument('--category-labels', action='store_true',
+                      help='Backfill the categories property and Cat_<name> labels on existing businesses')
+    parser.add_argument('--rating-aggregates', action='store_true',
+                      help='Backfill rating_sum, rating_count and rating_avg on existing businesses')
     
     args = parser.parse_args()
     
@@ -380,7 +485,11 @@ if __name__ == "__main__":
              setup_schema=args.schema,
              load_data=args.load,
              ratings_file=args.ratings,
-             metadata_file=args.metadata)
+             metadata_file=args.metadata,
+             mode=args.mode,
+             import_dir=args.import_dir,
+             category_labels=args.category_labels,
+             rating_aggregates=args.rating_aggregates)
     except Exception as e:
         print(f"Script failed: {str(e)}")
         exit(1)
\ No newline at end of file
@@ -0,0 +1,93 @@
+import logging
+import time
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Plain Cypher replacement for apoc.periodic.iterate. The outer query takes a
+# chunk of matches, and CALL { ... } IN TRANSACTIONS commits them
+# batch_size rows at a time, so no transaction grows with the size of the
+# graph. The chunk loop in Python reports progress between chunks.
+# The scoped CALL ({variable}) subquery needs Neo4j 5.23+, like the other
+# subqueries of the repo.
+IN_TRANSACTIONS_QUERY = """
+MATCH {pattern}
+{where}
+WITH {variable} LIMIT $chunk_size
+CALL ({variable}) {
+    {action}
+} IN {concurrency}TRANSACTIONS OF $batch_size ROWS
+RETURN COUNT(*) AS processed
+"""
+
+def run_in_transactions(conn, pattern, variable, action, where=None, parameters=None, batch_size=10000,
+                        chunk_size=None, concurrency=1, description="rows", count_first=False):
+    """
+    Applies action to every match of pattern in transactions of batch_size
+    rows, until a chunk comes back short.
+
+    The action must remove the matched element or make it stop matching
+    (e.g. DELETE, or SET a property the where clause excludes); otherwise
+    the loop never ends.
+
+    Requires Neo4j 5.23+ (scoped CALL subqueries).
+
+    Arguments
+        conn        : Neo4jConnection (queries run as auto-commit transactions,
+                      which CALL ... IN TRANSACTIONS requires)
+        pattern     : MATCH pattern, e.g. "()-[r:RATED]->()"
+        variable    : the variable of pattern that action operates on
+        action      : Cypher run per row, e.g. "DELETE r"
+        where       : optional WHERE condition (without the keyword)
+        batch_size  : rows per inner transaction
+        chunk_size  : rows per outer query; progress is logged after each
+        concurrency : number of inner transactions run concurrently;
+                      1 runs them one after the other
+        count_first : count the matches first so progress shows a percentage
+
+    Returns:
+        total number of processed rows
+    """
+    chunk_size = chunk_size or batch_size * 10
+    query = (IN_TRANSACTIONS_QUERY
+             .replace('{pattern}', pattern)
+             .replace('{where}', f"WHERE {where}" if where else "")
+             .replace('{variable}', variable)
+             .replace('{action}', action)
+             .replace('{concurrency}', f"{concurrency} CONCURRENT " if concurrency > 1 else ""))
+    parameters = dict(parameters or {}, batch_size=batch_size, chunk_size=chunk_size)
+
+    total = None
+    if count_first:
+        count_query = f"MATCH {pattern} {f'WHERE {where}' if where else ''} RETURN COUNT(*) AS total"
+        total = conn.query(count_query, parameters)[0]['total']
+
+    start_time = time.time()
+    processed = 0
+    while True:
+        chunk = conn.query(query, parameters)[0]['processed']
+        processed += chunk
+        elapsed = time.time() - start_time
+        rate = processed / elapsed if elapsed > 0 else 0
+        progress = f"{processed}/{total} ({processed / total:.0%})" if total else f"{processed}"
+        logger.info(f"Processed {progress} {description} ({rate:.0f} rows/s)")
+        if chunk < chunk_size:
+            break
+    return processed
+
+def delete_relationships(conn, pattern, variable="r", where=None, parameters=None, batch_size=10000,
+                         chunk_size=None, concurrency=1, description="relationships", count_first=False):
+    """Deletes every relationship bound to variable in pattern, in batches."""
+    return run_in_transactions(conn, pattern, variable, f"DELETE {variable}", where, parameters, batch_size,
+                               chunk_size, concurrency, description, count_first)
+
+def delete_nodes(conn, pattern="(n)", variable="n", where=None, parameters=None, batch_size=10000,
+                 chunk_size=None, concurrency=1, description="nodes", count_first=False):
+    """
+    Detach-deletes every node bound to variable in pattern, in batches.
+    Delete the relationships first on large graphs, so no single inner
+    transaction has to remove a dense node's whole relationship chain.
+    """
+    return run_in_transactions(conn, pattern, variable, f"DETACH DELETE {variable}", where, parameters,
+                               batch_size, chunk_size, concurrency, description, count_first)
@@ -0,0 +1,94 @@
+import argparse
+import logging
+import time
+from neo4j_connection import Neo4jConnection
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Rewrites up to $batch_size SIMILAR_TO edges between two {label} nodes as
+# {type} edges directed from the lower id to the higher one. Edges stored in
+# both directions collapse into a single edge per generation.
+MIGRATE_QUERY = """
+MATCH (a:{label})-[s:SIMILAR_TO]->(b:{label})
+WITH a, b, s LIMIT $batch_size
+WITH s,
+     CASE WHEN a.{id} <= b.{id} THEN a ELSE b END AS low,
+     CASE WHEN a.{id} <= b.{id} THEN b ELSE a END AS high
+MERGE (low)-[n:{type} {generation: coalesce(s.generation, 0)}]->(high)
+SET n += properties(s),
+    n.generation = coalesce(s.generation, 0)
+DELETE s
+RETURN COUNT(*) AS migrated
+"""
+
+SIMILARITY_KINDS = {
+    'user': {'label': 'User', 'id': 'user_id', 'type': 'USER_SIMILAR'},
+    'business': {'label': 'Business', 'id': 'gmap_id', 'type': 'BUSINESS_SIMILAR'}
+}
+
+# Schema created for SIMILAR_TO by earlier versions of load_data.py and the
+# similarity calculator
+OBSOLETE_SCHEMA = [
+    "DROP CONSTRAINT similar_to_score_exists IF EXISTS",
+    "DROP CONSTRAINT similar_to_timestamp_exists IF EXISTS",
+    "DROP INDEX similarity_score_idx IF EXISTS",
+    "DROP INDEX similarity_timestamp_idx IF EXISTS",
+    "DROP INDEX similar_business_composite_idx IF EXISTS",
+    "DROP INDEX similarity_score IF EXISTS",
+    "DROP INDEX similarity_last_updated IF EXISTS",
+    "DROP INDEX similarity_generation IF EXISTS"
+]
+
+def migrate_kind(conn, kind, batch_size=10000):
+    """
+    Migrate all SIMILAR_TO edges of one kind, one transaction per batch.
+    Safe to rerun: every batch deletes the edges it has rewritten.
+    """
+    names = SIMILARITY_KINDS[kind]
+    query = MIGRATE_QUERY
+    for name, value in names.items():
+        query = query.replace('{' + name + '}', value)
+
+    start_time = time.time()
+    total_migrated = 0
+    while True:
+        migrated = conn.query(query, {'batch_size': batch_size})[0]['migrated']
+        total_migrated += migrated
+        if migrated < batch_size:
+            break
+        logger.info(f"Migrated {total_migrated} {kind} similarities so far")
+
+    logger.info(f"Migrated {total_migrated} {kind} similarities to {names['type']} "
+                f"in {time.time() - start_time:.2f} seconds")
+
+def drop_obsolete_schema(conn):
+    for query in OBSOLETE_SCHEMA:
+        try:
+            conn.query(query)
+        except Exception as e:
+            logger.warning(f"Could not run {query}: {e}")
+
+def main(batch_size=10000):
+    conn = Neo4jConnection(
+        uri="neo4j://localhost:7687",
+        user="neo4j",
+        password="qwertyuiop"
+    )
+
+    try:
+        for kind in SIMILARITY_KINDS:
+            migrate_kind(conn, kind, batch_size)
+        drop_obsolete_schema(conn)
+        logger.info("Similarity migration completed; run load_data.py --schema to create the new indexes")
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Migrate SIMILAR_TO edges to USER_SIMILAR / BUSINESS_SIMILAR')
+    parser.add_argument('--batch-size', type=int, default=10000,
+                      help='Number of relationships migrated per transaction')
+
+    args = parser.parse_args()
+    main(batch_size=args.batch_size)
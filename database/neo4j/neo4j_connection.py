@@ -2,6 +2,7 @@ from neo4j import GraphDatabase
 import numpy as np
 from datetime import datetime, timedelta
 import logging
+import threading
 from pathlib import Path
 
 logging.basicConfig(level=logging.INFO, 
@@ -9,9 +10,32 @@ logging.basicConfig(level=logging.INFO,
 logger = logging.getLogger(__name__)
 
 class Neo4jConnection:
-    def __init__(self, uri, user, password):
-        self.driver = GraphDatabase.driver(uri, auth=(user, password))
+    def __init__(self, uri, user, password, max_transaction_retry_time=30.0):
+        """
+        max_transaction_retry_time bounds how long execute_read and
+        execute_write keep retrying transient failures (deadlocks, leader
+        switches, lost connections). retries counts the extra attempts they
+        needed so far.
+        """
+        self.driver = GraphDatabase.driver(
+            uri,
+            auth=(user, password),
+            max_transaction_retry_time=max_transaction_retry_time
+        )
+        self.retries = 0
+        self._retries_lock = threading.Lock()
         
+    def _count_attempts(self, work):
+        """Wraps a transaction function so that every call after the first counts as a retry."""
+        attempts = [0]
+        def counted(tx):
+            attempts[0] += 1
+            if attempts[0] > 1:
+                with self._retries_lock:
+                    self.retries += 1
+            return work(tx)
+        return counted
+
     def close(self):
         self.driver.close()
         
@@ -25,4 +49,51 @@ class Neo4jConnection:
         
         with self.driver.session() as session:
             result = session.run(query, parameters or {})
-            return [record.data() for record in result]
\ No newline at end of file
+            return [record.data() for record in result]
+
+    def stream(self, query, parameters=None, fetch_size=1000, values=False):
+        """
+        Iterate over the results of a query without materializing them.
+
+        Records are pulled from the server fetch_size at a time, so memory
+        stays flat however many records the query returns. With values=True
+        each record is yielded as a tuple of its values instead of a dict,
+        which skips building a dict per record.
+
+        The session stays open until the iterator is exhausted or closed.
+        """
+        with self.driver.session(fetch_size=fetch_size) as session:
+            result = session.run(query, parameters or {})
+            if values:
+                for record in result:
+                    yield tuple(record.values())
+            else:
+                for record in result:
+                    yield record.data()
+
+    def execute_read(self, query, parameters=None, values=False):
+        """
+        Run a read query in a managed transaction and return its records.
+
+        The driver retries the whole transaction on transient failures and
+        routes it to a reader in a cluster.
+        """
+        def work(tx):
+            result = tx.run(query, parameters or {})
+            if values:
+                return [tuple(record.values()) for record in result]
+            return [record.data() for record in result]
+
+        with self.driver.session() as session:
+            return session.execute_read(self._count_attempts(work))
+
+    def execute_write(self, query, parameters=None):
+        """
+        Run a write query in a managed transaction, retried on transient
+        failures such as deadlocks, and return its counters.
+        """
+        def work(tx):
+            return tx.run(query, parameters or {}).consume().counters
+
+        with self.driver.session() as session:
+            return session.execute_write(self._count_attempts(work))
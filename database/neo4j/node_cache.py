@@ -0,0 +1,78 @@
+import logging
+import threading
+from collections import OrderedDict
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+RESOLVE_QUERY = """
+UNWIND $ids AS id
+MATCH (n:{label} {{key}: id})
+RETURN id, elementId(n) AS ref
+"""
+
+class NodeCache:
+    """
+    LRU cache mapping the external ids of one node label (user_id, gmap_id,
+    category name) to internal element ids.
+
+    Bulk writes resolve every id they touch once, in a single UNWIND query
+    per batch of misses, and then match their endpoints with
+    `WHERE elementId(n) = ...`, which is a direct lookup instead of an index
+    seek per row. Ids that do not exist are not cached and are left out of
+    the result.
+
+    Element ids are only stable while the node exists, so a cache must not
+    outlive the job that filled it if nodes may be deleted in between.
+    Safe to share between threads.
+    """
+
+    def __init__(self, conn, label, key, max_size=1000000):
+        self.conn = conn
+        self.label = label
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._query = RESOLVE_QUERY.replace('{label}', label).replace('{key}', key)
+        self._refs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def put(self, node_id, ref):
+        with self._lock:
+            self._refs[node_id] = ref
+            self._refs.move_to_end(node_id)
+            if len(self._refs) > self.max_size:
+                self._refs.popitem(last=False)
+
+    def resolve(self, ids):
+        """Returns {id: element id} for every id in ids that exists."""
+        refs = {}
+        missing = []
+        with self._lock:
+            for node_id in set(ids):
+                ref = self._refs.get(node_id)
+                if ref is None:
+                    missing.append(node_id)
+                else:
+                    self._refs.move_to_end(node_id)
+                    refs[node_id] = ref
+            self.hits += len(refs)
+            self.misses += len(missing)
+
+        if missing:
+            for record in self.conn.query(self._query, {'ids': missing}):
+                refs[record['id']] = record['ref']
+                self.put(record['id'], record['ref'])
+        return refs
+
+    def warm(self, ids, batch_size=10000):
+        """Resolves ids in batches ahead of the writes that need them."""
+        ids = list(ids)
+        for i in range(0, len(ids), batch_size):
+            self.resolve(ids[i:i + batch_size])
+        logger.info(f"Warmed {self.label} reference cache with {len(ids)} ids")
+
+    def log(self):
+        logger.info(f"{self.label} reference cache: {self.hits} hits, {self.misses} misses, "
+                    f"{len(self._refs)} cached")
@@ -0,0 +1,304 @@
+"""
+Two-phase parallel loader for databases that already hold data.
+
+The loaders in load_data.py MERGE categories and users inside the same
+per-row statements as the relationships, on a single session. This loader
+splits the work into phases instead:
+
+1. Node phases create every distinct Business, Category and User node in
+   parallel batches. Each key appears in exactly one batch, so no two
+   workers touch the same node. The same statements tell the loader which
+   businesses and users did not exist before.
+2. Edge phases write BELONGS_TO and RATED through a PartitionedEdgeWriter,
+   matching both endpoints by the element ids the node phases returned
+   (kept in NodeCaches) rather than by index seeks.
+   Edges are partitioned by the hashes of both endpoints, and concurrent
+   batches never share a node. An edge whose business or user is new cannot
+   exist yet, so it is written with CREATE. All other edges are MERGEd.
+
+Every phase reports its rows per second. The ratings file is streamed twice,
+once per phase, so memory holds a chunk plus the sets of user ids and a
+hash per rating. A (user, business) rated more than once anywhere in the
+file keeps only its last rating, like the MERGE of the online loader, so a
+CREATE never writes the same pair twice.
+"""
+
+import argparse
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+from neo4j_connection import Neo4jConnection
+from partitioned_writer import PartitionedEdgeWriter, WriteStats
+from bulk_import import (read_businesses, normalized_ratings, distinct_categories, rating_pair_hashes,
+                         last_occurrences)
+from category_labels import category_labels_expression
+from rating_aggregates import RATING_AGGREGATES_UPDATE
+from adaptive_batch import AdaptiveBatchSizer
+from node_cache import NodeCache
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+BUSINESS_NODES_QUERY = """
+UNWIND $batch AS business
+OPTIONAL MATCH (existing:Business {gmap_id: business.gmap_id})
+WITH business, existing IS NULL AS is_new
+MERGE (b:Business {gmap_id: business.gmap_id})
+SET b += {
+    name: business.name,
+    avg_rating: COALESCE(business.avg_rating, 0.0),
+    num_of_reviews: COALESCE(business.num_of_reviews, 0),
+    price: business.price,
+    latitude: business.latitude,
+    longitude: business.longitude
+}
+SET b.categories = business.categories, b:$({labels})
+RETURN business.gmap_id AS id, elementId(b) AS ref, is_new
+""".replace('{labels}', category_labels_expression('business.categories'))
+
+CATEGORY_NODES_QUERY = """
+UNWIND $batch AS name
+MERGE (c:Category {name: name})
+RETURN name AS id, elementId(c) AS ref, false AS is_new
+"""
+
+USER_NODES_QUERY = """
+UNWIND $batch AS user_id
+OPTIONAL MATCH (existing:User {user_id: user_id})
+WITH user_id, existing IS NULL AS is_new
+MERGE (u:User {user_id: user_id})
+RETURN user_id AS id, elementId(u) AS ref, is_new
+"""
+
+BELONGS_TO_CREATE_QUERY = """
+UNWIND $batch AS edge
+MATCH (b) WHERE elementId(b) = edge.start_ref
+MATCH (c) WHERE elementId(c) = edge.end_ref
+CREATE (b)-[:BELONGS_TO {weight: edge.weight, last_updated: timestamp()}]->(c)
+"""
+
+BELONGS_TO_MERGE_QUERY = """
+UNWIND $batch AS edge
+MATCH (b) WHERE elementId(b) = edge.start_ref
+MATCH (c) WHERE elementId(c) = edge.end_ref
+MERGE (b)-[r:BELONGS_TO]->(c)
+SET r.weight = edge.weight,
+    r.last_updated = timestamp()
+"""
+
+RATED_CREATE_QUERY = """
+UNWIND $batch AS rating
+MATCH (u) WHERE elementId(u) = rating.start_ref
+MATCH (b) WHERE elementId(b) = rating.end_ref
+CREATE (u)-[:RATED {
+    rating: rating.rating,
+    timestamp: rating.timestamp,
+    last_updated: timestamp(),
+    normalized_rating: rating.normalized_rating
+}]->(b)
+WITH b, rating.rating AS delta, 1 AS added
+""" + RATING_AGGREGATES_UPDATE
+
+RATED_MERGE_QUERY = """
+UNWIND $batch AS rating
+MATCH (u) WHERE elementId(u) = rating.start_ref
+MATCH (b) WHERE elementId(b) = rating.end_ref
+MERGE (u)-[r:RATED]->(b)
+WITH b, r, rating, r.rating AS previous
+SET r.rating = rating.rating,
+    r.timestamp = rating.timestamp,
+    r.last_updated = timestamp(),
+    r.normalized_rating = rating.normalized_rating
+WITH b, rating.rating - coalesce(previous, 0) AS delta,
+     CASE WHEN previous IS NULL THEN 1 ELSE 0 END AS added
+""" + RATING_AGGREGATES_UPDATE
+
+class ParallelLoader:
+    def __init__(self, conn, batch_size=5000, max_workers=4, num_partitions=8, chunk_size=100000):
+        self.conn = conn
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+        self.num_partitions = num_partitions
+        self.chunk_size = chunk_size
+        self.business_refs = NodeCache(conn, 'Business', 'gmap_id')
+        self.category_refs = NodeCache(conn, 'Category', 'name')
+        self.user_refs = NodeCache(conn, 'User', 'user_id')
+
+    def _log_phase(self, phase, rows, start_time):
+        elapsed = time.time() - start_time
+        rate = rows / elapsed if elapsed > 0 else 0
+        logger.info(f"Phase '{phase}': {rows} rows in {elapsed:.2f} seconds ({rate:.0f} rows/s)")
+
+    def _run_node_batches(self, query, keys, refs):
+        """
+        Runs query over keys in parallel batches, caches the element id of
+        every node in refs and returns the ids the query reports as newly
+        created.
+        """
+        def run(batch):
+            return self.conn.query(query, {'batch': batch})
+
+        created = set()
+        batches = (keys[i:i + self.batch_size] for i in range(0, len(keys), self.batch_size))
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for records in executor.map(run, batches):
+                for record in records:
+                    refs.put(record['id'], record['ref'])
+                    if record['is_new']:
+                        created.add(record['id'])
+        return created
+
+    def _edge_writer(self, create_query, merge_query, start_key, end_key, start_refs, end_refs, stats):
+        def write_batch(session, rows):
+            start_time = time.time()
+            starts = start_refs.resolve([row[start_key] for row in rows])
+            ends = end_refs.resolve([row[end_key] for row in rows])
+            rows = [
+                dict(row, start_ref=starts[row[start_key]], end_ref=ends[row[end_key]])
+                for row in rows
+                if row[start_key] in starts and row[end_key] in ends
+            ]
+            create = [row for row in rows if row['create']]
+            merge = [row for row in rows if not row['create']]
+
+            # Both statements form one transaction, so a retried batch never
+            # replays CREATEs that already committed
+            def work(tx):
+                if create:
+                    tx.run(create_query, {'batch': create}).consume()
+                if merge:
+                    tx.run(merge_query, {'batch': merge}).consume()
+
+            session.execute_write(work)
+            stats.record_batch(len(rows), time.time() - start_time)
+
+        return PartitionedEdgeWriter(
+            self.conn,
+            write_batch,
+            start_key=lambda row: row[start_key],
+            end_key=lambda row: row[end_key],
+            num_partitions=self.num_partitions,
+            batch_size=self.batch_size,
+            max_workers=self.max_workers,
+            batch_sizer=AdaptiveBatchSizer(stats.name, initial=self.batch_size)
+        )
+
+    def load_businesses(self, metadata_file, max_entries=-1):
+        """Loads Business and Category nodes, then BELONGS_TO edges."""
+        businesses, split_weight = read_businesses(metadata_file, max_entries)
+
+        start_time = time.time()
+        records = businesses[['gmap_id', 'name', 'avg_rating', 'num_of_reviews',
+                              'price', 'latitude', 'longitude']].astype(object)
+        records = records.where(records.notna(), None)
+        records['categories'] = businesses['category_names']
+        new_businesses = self._run_node_batches(BUSINESS_NODES_QUERY, records.to_dict('records'), self.business_refs)
+        self._log_phase("business nodes", len(records), start_time)
+
+        edges = []
+        for gmap_id, categories in zip(businesses['gmap_id'], businesses['categories']):
+            distinct = distinct_categories(categories)
+            weight = 1.0 / len(categories) if split_weight else 1.0
+            edges.extend({
+                'business': gmap_id,
+                'category': category,
+                'weight': weight,
+                'create': gmap_id in new_businesses
+            } for category in distinct)
+
+        start_time = time.time()
+        category_names = sorted({edge['category'] for edge in edges})
+        self._run_node_batches(CATEGORY_NODES_QUERY, category_names, self.category_refs)
+        self._log_phase("category nodes", len(category_names), start_time)
+
+        start_time = time.time()
+        stats = WriteStats("BELONGS_TO")
+        writer = self._edge_writer(BELONGS_TO_CREATE_QUERY, BELONGS_TO_MERGE_QUERY, 'business', 'category',
+                                   self.business_refs, self.category_refs, stats)
+        writer.add(edges)
+        writer.flush()
+        self._log_phase("BELONGS_TO edges", len(edges), start_time)
+        stats.log()
+        writer.batch_sizer.log()
+
+        return new_businesses
+
+    def _rating_chunks(self, ratings_file, max_entries=-1):
+        rows_read = 0
+        for chunk in pd.read_csv(ratings_file, chunksize=self.chunk_size):
+            if max_entries != -1:
+                chunk = chunk.head(max_entries - rows_read)
+                if chunk.empty:
+                    return
+            rows_read += len(chunk)
+            yield chunk
+
+    def load_ratings(self, ratings_file, new_businesses=frozenset(), max_entries=-1):
+        """
+        Loads User nodes, then RATED edges. new_businesses are the businesses
+        created by load_businesses in this run; their ratings need no MERGE.
+        """
+        start_time = time.time()
+        user_ids = set()
+        hashes = []
+        for chunk in self._rating_chunks(ratings_file, max_entries):
+            user_ids.update(chunk['user'].unique())
+            hashes.append(rating_pair_hashes(chunk))
+        last_ratings = last_occurrences(hashes)
+        del hashes
+        new_users = self._run_node_batches(USER_NODES_QUERY, sorted(user_ids), self.user_refs)
+        self._log_phase("user nodes", len(user_ids), start_time)
+
+        start_time = time.time()
+        total_ratings = 0
+        stats = WriteStats("RATED")
+        writer = self._edge_writer(RATED_CREATE_QUERY, RATED_MERGE_QUERY, 'user', 'business',
+                                   self.user_refs, self.business_refs, stats)
+        rows_read = 0
+        for chunk in self._rating_chunks(ratings_file, max_entries):
+            # Only the last rating of a pair across the whole file is written
+            last = last_ratings[rows_read:rows_read + len(chunk)]
+            rows_read += len(chunk)
+            chunk = chunk[last]
+            chunk = chunk.assign(
+                normalized_rating=normalized_ratings(chunk['rating'].to_numpy()),
+                create=chunk['user'].isin(new_users) | chunk['business'].isin(new_businesses)
+            )
+            writer.add(chunk[['user', 'business', 'rating', 'timestamp', 'normalized_rating', 'create']].to_dict('records'))
+            total_ratings += len(chunk)
+        writer.flush()
+        self._log_phase("RATED edges", total_ratings, start_time)
+        stats.log()
+        writer.batch_sizer.log()
+        self.user_refs.log()
+        self.business_refs.log()
+
+def main(ratings_file, metadata_file, batch_size=5000, max_workers=4):
+    conn = Neo4jConnection(
+        uri="neo4j://localhost:7687",
+        user="neo4j",
+        password="qwertyuiop"
+    )
+
+    loader = ParallelLoader(conn, batch_size=batch_size, max_workers=max_workers)
+    try:
+        new_businesses = loader.load_businesses(metadata_file)
+        loader.load_ratings(ratings_file, new_businesses)
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Load data into a non-empty Neo4j database in parallel phases')
+    parser.add_argument('--ratings', type=str, default='data/rating-Georgia.csv',
+                      help='Path to ratings CSV file')
+    parser.add_argument('--metadata', type=str, default='data/meta-Georgia.json',
+                      help='Path to metadata JSON or CSV file')
+    parser.add_argument('--batch-size', type=int, default=5000,
+                      help='Rows per transaction')
+    parser.add_argument('--workers', type=int, default=4,
+                      help='Number of concurrent writers')
+
+    args = parser.parse_args()
+    main(args.ratings, args.metadata, args.batch_size, args.workers)
@@ -0,0 +1,183 @@
+import logging
+import threading
+import time
+import zlib
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+class WriteStats:
+    """Thread-safe per-batch write latency and retry counters."""
+
+    def __init__(self, name):
+        self.name = name
+        self.batches = 0
+        self.rows = 0
+        self.retries = 0
+        self.latencies = []
+        self._lock = threading.Lock()
+
+    def record_batch(self, rows, latency, retries=0):
+        with self._lock:
+            self.batches += 1
+            self.rows += rows
+            self.retries += retries
+            self.latencies.append(latency)
+
+    def summary(self):
+        with self._lock:
+            latencies = sorted(self.latencies)
+            summary = {
+                'batches': self.batches,
+                'rows': self.rows,
+                'retries': self.retries
+            }
+        if latencies:
+            summary.update({
+                'mean_latency': sum(latencies) / len(latencies),
+                'p50_latency': latencies[len(latencies) // 2],
+                'p95_latency': latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+                'max_latency': latencies[-1]
+            })
+        return summary
+
+    def log(self):
+        summary = self.summary()
+        message = f"{self.name} writes: {summary['batches']} batches, {summary['rows']} rows, {summary['retries']} retries"
+        if 'mean_latency' in summary:
+            message += (f", latency mean {summary['mean_latency']:.3f} s, p50 {summary['p50_latency']:.3f} s,"
+                        f" p95 {summary['p95_latency']:.3f} s, max {summary['max_latency']:.3f} s")
+        logger.info(message)
+
+def partition_rounds(num_partitions):
+    """
+    Schedules every block (i, j), i <= j, of a num_partitions x
+    num_partitions partitioning into rounds in which no two blocks share a
+    partition.
+
+    Off-diagonal blocks are paired with the round-robin (circle) method,
+    which needs num_partitions - 1 rounds for an even number of partitions;
+    the diagonal blocks (i, i) are disjoint from each other and form one
+    final round.
+    """
+    slots = list(range(num_partitions)) + ([None] if num_partitions % 2 else [])
+    n = len(slots)
+    rounds = []
+    for _ in range(n - 1):
+        blocks = []
+        for k in range(n // 2):
+            a, b = slots[k], slots[n - 1 - k]
+            if a is not None and b is not None:
+                blocks.append((min(a, b), max(a, b)))
+        rounds.append(blocks)
+        slots = [slots[0], slots[-1]] + slots[1:-1]
+    rounds.append([(i, i) for i in range(num_partitions)])
+    return rounds
+
+class PartitionedEdgeWriter:
+    """
+    Writes relationships so that concurrent transactions never lock the same
+    node, which rules out deadlocks by construction.
+
+    Nodes are assigned to num_partitions partitions by a hash of their id,
+    and every edge is buffered in the block of its two endpoint partitions.
+    On flush, blocks are written round by round following partition_rounds:
+    the blocks of a round share no partition and therefore no node, so they
+    can be written in parallel. Within a block, rows are sorted by
+    (start, end) and written in chunks of batch_size, one transaction each.
+
+    Rows are buffered until flush() or until max_buffered_rows are pending,
+    at which point add() flushes and blocks its caller (backpressure).
+    """
+
+    def __init__(self, conn, write_batch, start_key, end_key, num_partitions=8, batch_size=500,
+                 max_workers=4, max_buffered_rows=200000, batch_sizer=None):
+        """
+        write_batch : function(session, rows) writing one chunk of rows
+        start_key   : function returning the start node id of a row
+        end_key     : function returning the end node id of a row
+        batch_sizer : optional AdaptiveBatchSizer choosing the chunk size
+                      instead of the fixed batch_size
+        """
+        self.conn = conn
+        self.write_batch = write_batch
+        self.start_key = start_key
+        self.end_key = end_key
+        self.num_partitions = num_partitions
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+        self.max_buffered_rows = max_buffered_rows
+        self.batch_sizer = batch_sizer
+        self.rounds = partition_rounds(num_partitions)
+
+        self._blocks = defaultdict(list)
+        self._buffered = 0
+        self._callbacks = []
+        self._error = None
+        self._lock = threading.Lock()
+
+    def _partition(self, node_id):
+        return zlib.crc32(str(node_id).encode()) % self.num_partitions
+
+    def add(self, rows, on_written=None):
+        """
+        Buffers rows for writing. on_written, if given, is called once the
+        flush that writes these rows has completed.
+        """
+        with self._lock:
+            if self._error:
+                raise RuntimeError("Partitioned edge writer failed") from self._error
+
+            for row in rows:
+                start = self._partition(self.start_key(row))
+                end = self._partition(self.end_key(row))
+                self._blocks[(min(start, end), max(start, end))].append(row)
+            self._buffered += len(rows)
+            if on_written:
+                self._callbacks.append(on_written)
+
+            if self._buffered >= self.max_buffered_rows:
+                self._flush()
+
+    def flush(self):
+        """Writes every buffered row."""
+        with self._lock:
+            if self._error:
+                raise RuntimeError("Partitioned edge writer failed") from self._error
+            self._flush()
+
+    def _flush(self):
+        start_time = time.time()
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                for blocks in self.rounds:
+                    # Wait for the whole round before starting the next one
+                    futures = [
+                        executor.submit(self._write_block, self._blocks[block])
+                        for block in blocks if self._blocks.get(block)
+                    ]
+                    for future in futures:
+                        future.result()
+        except Exception as e:
+            logger.error(f"Partitioned write failed: {e}")
+            self._error = e
+            raise
+
+        logger.info(f"Flushed {self._buffered} rows in {time.time() - start_time:.2f} seconds")
+        for callback in self._callbacks:
+            callback()
+        self._blocks = defaultdict(list)
+        self._buffered = 0
+        self._callbacks = []
+
+    def _write_block(self, rows):
+        rows.sort(key=lambda row: (self.start_key(row), self.end_key(row)))
+        with self.conn.driver.session() as session:
+            if self.batch_sizer:
+                self.batch_sizer.run(rows, lambda batch: self.write_batch(session, batch))
+                return
+            for i in range(0, len(rows), self.batch_size):
+                self.write_batch(session, rows[i:i + self.batch_size])
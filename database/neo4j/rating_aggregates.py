@@ -0,0 +1,39 @@
+"""
+Live rating aggregates on Business nodes.
+
+Every Business carries `rating_sum`, `rating_count` and
+`rating_avg` = rating_sum / rating_count over its incoming RATED edges.
+Queries can then rank businesses by their ratings from the node alone,
+backed by an index on rating_avg, instead of expanding and averaging every
+RATED edge per call. (`avg_rating` and `num_of_reviews` come from the
+business metadata and are not updated by rating writes.)
+
+Every statement that writes RATED edges ends with RATING_AGGREGATES_UPDATE
+in the same transaction, so the aggregates change atomically with the
+edges. The fragment expects one row per written rating, binding:
+    b        the rated Business
+    delta    the rating minus the previous rating of the same edge (or the
+             rating itself for a new edge)
+    added    1 for a new edge, 0 for an updated one
+
+It aggregates the rows per business first. That way each business is
+written once per statement, and the SET reads and writes its properties in
+one expression, which Neo4j evaluates under the node's write lock, so
+concurrent writers do not lose updates.
+"""
+
+RATING_AGGREGATES_UPDATE = """
+WITH b, SUM(delta) AS delta, SUM(added) AS added
+SET b.rating_sum = coalesce(b.rating_sum, 0.0) + delta,
+    b.rating_count = coalesce(b.rating_count, 0) + added
+SET b.rating_avg = CASE WHEN b.rating_count > 0 THEN b.rating_sum / b.rating_count END
+"""
+
+# Recomputes the aggregates of b from its RATED edges (backfills, repairs)
+RATING_AGGREGATES_RECOMPUTE = """
+OPTIONAL MATCH (b)<-[r:RATED]-()
+WITH b, COUNT(r) AS count, toFloat(coalesce(SUM(r.rating), 0)) AS total
+SET b.rating_sum = total,
+    b.rating_count = count,
+    b.rating_avg = CASE WHEN count > 0 THEN total / count END
+"""
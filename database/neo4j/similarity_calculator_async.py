@@ -0,0 +1,269 @@
+import asyncio
+import time
+import neo4j.exceptions
+import numpy as np
+from datetime import datetime
+import logging
+import traceback
+import random
+from neo4j import AsyncGraphDatabase
+from similarity_calculator_no_cache import (
+    ACTIVE_USERS_QUERY,
+    USER_PAIRS_QUERY,
+    BEGIN_GENERATION_QUERY,
+    ACTIVATE_GENERATION_QUERY,
+    PENDING_USERS_QUERY,
+    CLEAR_PENDING_USERS_QUERY,
+    CLEANUP_GENERATION_QUERY,
+    SIMILARITY_TYPES
+)
+from partitioned_writer import WriteStats
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# The async writer matches endpoints by user_id; a single writer coroutine
+# gains little from resolving element ids first
+USER_SIMILARITY_UPSERT_QUERY = """
+UNWIND $similarities AS sim
+MATCH (u1:User {user_id: sim.user1_id})
+MATCH (u2:User {user_id: sim.user2_id})
+MERGE (u1)-[s:USER_SIMILAR {generation: $generation}]->(u2)
+SET s.score = sim.similarity,
+    s.common_items = sim.common_items,
+    s.last_updated = sim.last_updated
+"""
+
+def cosine_similarity(vector1, vector2):
+    """Calculate cosine similarity between two vectors."""
+    v1 = np.array(vector1)
+    v2 = np.array(vector2)
+    norm1 = np.linalg.norm(v1)
+    norm2 = np.linalg.norm(v2)
+
+    if norm1 == 0 or norm2 == 0:
+        return 0
+
+    return np.dot(v1, v2) / (norm1 * norm2)
+
+class AsyncSimilarityCalculator:
+    """
+    asyncio variant of SimilarityCalculatorNoCache.calculate_user_similarity
+    built on AsyncGraphDatabase.
+
+    `concurrency` reader coroutines pull users from a queue and keep that many
+    per-user pair queries in flight. Their results flow through a bounded
+    queue to `write_concurrency` writer coroutines, which group them into
+    UNWIND upserts of write_batch_size rows. Users are queued in descending
+    cost order, so the heaviest pair queries start first. Results are written
+    into a new similarity generation that is activated once every user has
+    been processed, exactly like the threaded calculator; users updated
+    incrementally during the build are then recomputed into it.
+    """
+
+    def __init__(self, uri, user, password, concurrency=32, write_batch_size=500, write_concurrency=1):
+        self.concurrency = concurrency
+        self.write_batch_size = write_batch_size
+        self.write_concurrency = write_concurrency
+        self.write_stats = WriteStats("async user similarity")
+        self.driver = AsyncGraphDatabase.driver(
+            uri,
+            auth=(user, password),
+            max_connection_pool_size=concurrency + write_concurrency + 2
+        )
+
+    async def close(self):
+        await self.driver.close()
+
+    async def _single(self, query, parameters):
+        async with self.driver.session() as session:
+            result = await session.run(query, parameters)
+            return await result.single()
+
+    async def query_retry(self, query, parameters, max_retries=5):
+        start_time = time.time()
+        for attempt in range(max_retries):
+            try:
+                async with self.driver.session() as session:
+                    result = await session.run(query, parameters)
+                    summary = await result.consume()
+                self.write_stats.record_batch(len(parameters.get('similarities', [])), time.time() - start_time, attempt)
+                return summary
+            except neo4j.exceptions.TransientError as e:
+                if "DeadlockDetected" not in str(e):
+                    raise
+
+                # Exponential backoff with jitter
+                wait_time = min(2 ** attempt + random.random(), 30)
+                logger.warning(f"Deadlock detected. Retry {attempt + 1}/{max_retries}. Waiting {wait_time:.2f} seconds")
+                await asyncio.sleep(wait_time)
+
+        raise Exception("Max retries reached due to persistent deadlocks")
+
+    async def _user_similarities(self, session, user1_id, min_common_items, min_similarity):
+        result = await session.run(USER_PAIRS_QUERY, {
+            'user1_id': user1_id,
+            'min_common_items': min_common_items
+        })
+
+        similarities = []
+        async for record in result:
+            ratings = record['ratings']
+            vector1 = [r['rating1'] for r in ratings]
+            vector2 = [r['rating2'] for r in ratings]
+
+            similarity = cosine_similarity(vector1, vector2)
+
+            if similarity >= min_similarity:
+                similarities.append({
+                    'user1_id': user1_id,
+                    'user2_id': record['user2_id'],
+                    'similarity': float(similarity),
+                    'common_items': record['common_items'],
+                    'last_updated': int(datetime.now().timestamp() * 1000)
+                })
+        return similarities
+
+    async def _reader(self, users, results, min_common_items, min_similarity):
+        """Runs pair queries for queued users until the user queue is empty."""
+        async with self.driver.session() as session:
+            while True:
+                try:
+                    user1_id = users.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                similarities = await self._user_similarities(session, user1_id, min_common_items, min_similarity)
+                if similarities:
+                    await results.put(similarities)
+
+    async def _writer(self, results, generation):
+        """Groups reader results into UNWIND upserts until it receives None."""
+        batch = []
+        while True:
+            similarities = await results.get()
+            if similarities is None:
+                break
+            batch.extend(similarities)
+            if len(batch) >= self.write_batch_size:
+                await self._write_batch(batch, generation)
+                batch = []
+        if batch:
+            await self._write_batch(batch, generation)
+
+    async def _write_batch(self, batch, generation):
+        # Lock nodes in a fixed order across writers
+        batch.sort(key=lambda row: (row['user1_id'], row['user2_id']))
+        await self.query_retry(USER_SIMILARITY_UPSERT_QUERY, {
+            'similarities': batch,
+            'generation': generation
+        })
+        logger.info(f"Processed batch with {len(batch)} similarities")
+
+    async def cleanup_generations(self, kind, keep_generation, batch_size=10000):
+        """Delete similarity edges of `kind` older than keep_generation in batches."""
+        query = CLEANUP_GENERATION_QUERY.replace('{type}', SIMILARITY_TYPES[kind])
+        total_deleted = 0
+        while True:
+            record = await self._single(query, {'keep_generation': keep_generation, 'batch_size': batch_size})
+            total_deleted += record['deleted']
+            if record['deleted'] < batch_size:
+                break
+        logger.info(f"Removed {total_deleted} superseded {SIMILARITY_TYPES[kind]} relationships")
+
+    async def calculate_user_similarity(self, min_common_items=3, min_similarity=0.3):
+        logger.info("Starting async user similarity calculation...")
+        start_time = time.time()
+
+        # Build into a new generation; readers stay on the active one until the switch
+        generation = (await self._single(BEGIN_GENERATION_QUERY, {'kind': 'user'}))['building']
+        logger.info(f"Building user similarity generation {generation}")
+
+        user_ids = []
+        async with self.driver.session() as session:
+            result = await session.run(ACTIVE_USERS_QUERY, {'min_common_items': min_common_items})
+            async for record in result:
+                user_ids.append(record['user_id'])
+        logger.info(f"Found {len(user_ids)} active users")
+
+        # Leave the generation unactivated on failure; the active one stays in use
+        await self._process_users(user_ids, generation, min_common_items, min_similarity)
+
+        async with self.driver.session() as session:
+            result = await session.run(ACTIVATE_GENERATION_QUERY, {'kind': 'user', 'generation': generation})
+            await result.consume()
+        logger.info(f"Activated user similarity generation {generation}")
+
+        # Users updated incrementally during the build were written into the
+        # previous generation
+        pending = []
+        async with self.driver.session() as session:
+            result = await session.run(PENDING_USERS_QUERY)
+            async for record in result:
+                pending.append(record['user_id'])
+        if pending:
+            logger.info(f"Replaying {len(pending)} users updated during the rebuild")
+            await self._process_users(pending, generation, min_common_items, min_similarity)
+            async with self.driver.session() as session:
+                result = await session.run(CLEAR_PENDING_USERS_QUERY, {'user_ids': pending})
+                await result.consume()
+        self.write_stats.log()
+
+        end_time = time.time()
+        logger.info(f"Async user similarity calculation took {end_time - start_time:.2f} seconds")
+
+        await self.cleanup_generations('user', generation)
+        logger.info("Async user similarity calculation completed")
+
+    async def _process_users(self, user_ids, generation, min_common_items, min_similarity):
+        """Computes and writes the similarities of user_ids into generation."""
+        users = asyncio.Queue()
+        for user_id in user_ids:
+            users.put_nowait(user_id)
+
+        # Bounded, so readers wait whenever the writers fall behind
+        results = asyncio.Queue(maxsize=self.concurrency * 2)
+        writers = [asyncio.create_task(self._writer(results, generation)) for _ in range(self.write_concurrency)]
+        readers = [
+            asyncio.create_task(self._reader(users, results, min_common_items, min_similarity))
+            for _ in range(self.concurrency)
+        ]
+
+        readers_done = asyncio.gather(*readers)
+
+        try:
+            # Writers only finish early by failing, so stop waiting for the
+            # readers (which may be blocked on the full queue) if one does
+            await asyncio.wait([readers_done, *writers], return_when=asyncio.FIRST_COMPLETED)
+            for task in writers:
+                if task.done():
+                    task.result()
+            await readers_done
+            for _ in writers:
+                await results.put(None)
+            await asyncio.gather(*writers)
+        except BaseException:
+            for task in readers + writers:
+                task.cancel()
+            readers_done.cancel()
+            raise
+
+
+async def run():
+    simCalc = AsyncSimilarityCalculator(
+        uri="neo4j://localhost:7687",
+        user="neo4j",
+        password="qwertyuiop",
+        concurrency=32
+    )
+
+    try:
+        await simCalc.calculate_user_similarity()
+    except Exception as e:
+        logger.error(f"Similarity generation process failed: {e}")
+        traceback.print_exc()
+    finally:
+        await simCalc.close()
+
+if __name__ == "__main__":
+    asyncio.run(run())
@@ -0,0 +1,314 @@
+import time
+import logging
+import math
+import threading
+import traceback
+from collections import OrderedDict, defaultdict
+from datetime import datetime
+from neo4j_connection import Neo4jConnection
+from node_cache import NodeCache
+from partitioned_writer import WriteStats
+from similarity_calculator_no_cache import SimilarityCalculatorNoCache, USER_SIMILARITY_UPSERT_QUERY
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+USER_RATINGS_QUERY = """
+UNWIND $ids AS id
+MATCH (u:User {user_id: id})-[r:RATED]->(b:Business)
+RETURN id, COLLECT([b.gmap_id, r.rating]) AS ratings
+"""
+
+BUSINESS_RATERS_QUERY = """
+UNWIND $ids AS id
+MATCH (b:Business {gmap_id: id})<-[r:RATED]-(u:User)
+RETURN id, COLLECT([u.user_id, r.rating]) AS ratings
+"""
+
+USER_NEIGHBORS_QUERY = """
+UNWIND $ids AS id
+MATCH (u:User {user_id: id})-[s:USER_SIMILAR]-(other:User)
+WHERE coalesce(s.generation, 0) = $generation
+RETURN id, COLLECT([other.user_id, s.score, s.common_items]) AS neighbors
+"""
+
+USER_SIMILARITY_DELETE_QUERY = """
+UNWIND $similarities AS sim
+MATCH (u1) WHERE elementId(u1) = sim.start_ref
+MATCH (u1)-[s:USER_SIMILAR {generation: $generation}]->(u2)
+WHERE elementId(u2) = sim.end_ref
+DELETE s
+"""
+
+class LRUCache:
+    """Size-bounded mapping that evicts the least recently used entry."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        value = self._entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return value
+
+    def peek(self, key):
+        """Returns the entry without counting a lookup or refreshing it."""
+        return self._entries.get(key)
+
+    def put(self, key, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def pop(self, key):
+        return self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+class SimilarityCalculatorCached(SimilarityCalculatorNoCache):
+    """
+    SimilarityCalculatorNoCache with in-memory rating caches for incremental
+    updates.
+
+    It keeps three LRU caches:
+    - per-user rating vectors ({business_id: rating});
+    - per-business rater lists ({user_id: rating});
+    - the similarity neighbors last written for each user.
+
+    update_user_similarity computes the co-rater pairs of the affected users
+    locally from these caches, instead of re-traversing
+    (u1)-[:RATED]->(b)<-[:RATED]-(u2) in Neo4j for every user. Only cache
+    misses are fetched, in one UNWIND query per kind. Neo4j then receives
+    only the edges whose score or common item count changed, plus deletes
+    for pairs that fell below the thresholds.
+
+    Rating writes must be reported with record_rating (or the entries
+    invalidated) so the caches stay in sync with the graph. It therefore
+    assumes a single writer: ratings written by other clients or processes
+    are not seen, and its upserts and deletes would be computed from stale
+    vectors. Full rebuilds are inherited unchanged.
+    """
+
+    def __init__(self, conn, max_users=100000, max_businesses=20000, max_neighbors=100000):
+        super().__init__(conn)
+        self.user_ratings = LRUCache(max_users)
+        self.business_raters = LRUCache(max_businesses)
+        self.user_neighbors = LRUCache(max_neighbors)
+        self._neighbors_generation = None
+        self._lock = threading.Lock()
+
+    ###############################################################
+    # CACHE MAINTENANCE
+    ###############################################################
+
+    def record_rating(self, user_id, business_id, rating):
+        """Applies a rating written to the graph to every cached entry it touches."""
+        with self._lock:
+            ratings = self.user_ratings.peek(user_id)
+            if ratings is not None:
+                ratings[business_id] = rating
+            raters = self.business_raters.peek(business_id)
+            if raters is not None:
+                raters[user_id] = rating
+
+    def invalidate_user(self, user_id):
+        with self._lock:
+            self.user_ratings.pop(user_id)
+            self.user_neighbors.pop(user_id)
+
+    def invalidate_business(self, business_id):
+        with self._lock:
+            self.business_raters.pop(business_id)
+
+    def clear_cache(self):
+        with self._lock:
+            self.user_ratings.clear()
+            self.business_raters.clear()
+            self.user_neighbors.clear()
+
+    def _load(self, cache, query, ids, parameters=None):
+        """Returns {id: entry} for ids, fetching the misses in one query."""
+        entries = {}
+        missing = []
+        for key in set(ids):
+            entry = cache.get(key)
+            if entry is None:
+                missing.append(key)
+            else:
+                entries[key] = entry
+
+        if missing:
+            for record in self.conn.stream(query, dict(parameters or {}, ids=missing), values=True):
+                key, values = record
+                entry = {value[0]: tuple(value[1:]) if len(value) > 2 else value[1] for value in values}
+                entries[key] = entry
+                cache.put(key, entry)
+            for key in missing:
+                # Ids without ratings or neighbors are cached as empty too
+                if key not in entries:
+                    entries[key] = {}
+                    cache.put(key, entries[key])
+        return entries
+
+    def log_cache(self):
+        for name, cache in [('user ratings', self.user_ratings),
+                            ('business raters', self.business_raters),
+                            ('user neighbors', self.user_neighbors)]:
+            logger.info(f"{name} cache: {cache.hits} hits, {cache.misses} misses, {len(cache)} entries")
+
+    ###############################################################
+    # INCREMENTAL UPDATES
+    ###############################################################
+
+    def _pair_similarities(self, user1_id, ratings1, business_raters, min_common_items, min_similarity):
+        """
+        Cosine similarities between user1_id and every co-rater, over the
+        businesses they have both rated, as in the Cypher pairs query.
+        """
+        dot = defaultdict(float)
+        norm1 = defaultdict(float)
+        norm2 = defaultdict(float)
+        common = defaultdict(int)
+        for business_id, rating1 in ratings1.items():
+            for user2_id, rating2 in business_raters[business_id].items():
+                if user2_id == user1_id:
+                    continue
+                dot[user2_id] += rating1 * rating2
+                norm1[user2_id] += rating1 * rating1
+                norm2[user2_id] += rating2 * rating2
+                common[user2_id] += 1
+
+        similarities = {}
+        for user2_id, common_items in common.items():
+            if common_items < min_common_items:
+                continue
+            if norm1[user2_id] == 0 or norm2[user2_id] == 0:
+                continue
+            similarity = dot[user2_id] / (math.sqrt(norm1[user2_id]) * math.sqrt(norm2[user2_id]))
+            if similarity >= min_similarity:
+                similarities[user2_id] = (float(similarity), common_items)
+        return similarities
+
+    def update_user_similarity(self, affected_users, min_common_items=3, min_similarity=0.3, batch_size=500):
+        """
+        Incrementally update user similarity based on affected users, using
+        the caches and writing only changed edges.
+        """
+        logger.info("Starting cached incremental user similarity update...")
+        start_time = time.time()
+
+        generation = self._incremental_generation(affected_users)
+        with self._lock:
+            if self._neighbors_generation != generation:
+                # Neighbors of another generation say nothing about this one
+                self.user_neighbors.clear()
+                self._neighbors_generation = generation
+
+            affected = list(dict.fromkeys(affected_users))
+            user_ratings = self._load(self.user_ratings, USER_RATINGS_QUERY, affected)
+            business_ids = {business_id for ratings in user_ratings.values() for business_id in ratings}
+            business_raters = self._load(self.business_raters, BUSINESS_RATERS_QUERY, business_ids)
+
+            computed = {
+                user_id: self._pair_similarities(user_id, user_ratings[user_id], business_raters,
+                                                 min_common_items, min_similarity)
+                for user_id in affected
+            }
+
+            # What the graph currently holds for the affected users and all
+            # their new and previous neighbors
+            neighbors = self._load(self.user_neighbors, USER_NEIGHBORS_QUERY, affected,
+                                   {'generation': generation})
+
+            upserts = {}
+            deletes = {}
+            now = int(datetime.now().timestamp() * 1000)
+            for user_id in affected:
+                previous = neighbors[user_id]
+                current = computed[user_id]
+                for other_id, (score, common_items) in current.items():
+                    if other_id in previous:
+                        previous_score, previous_common = previous[other_id]
+                        # Scores are summed in a different order than in Cypher
+                        if previous_common == common_items and abs(previous_score - score) < 1e-9:
+                            continue
+                    pair = (min(user_id, other_id), max(user_id, other_id))
+                    upserts[pair] = {
+                        'user1_id': pair[0],
+                        'user2_id': pair[1],
+                        'similarity': score,
+                        'common_items': common_items,
+                        'last_updated': now
+                    }
+                for other_id in previous.keys() - current.keys():
+                    pair = (min(user_id, other_id), max(user_id, other_id))
+                    deletes[pair] = {'user1_id': pair[0], 'user2_id': pair[1]}
+
+            # Keep the cached neighbor lists in line with what is written
+            for (user1_id, user2_id), row in upserts.items():
+                for user_id, other_id in [(user1_id, user2_id), (user2_id, user1_id)]:
+                    entry = self.user_neighbors.peek(user_id)
+                    if entry is not None:
+                        entry[other_id] = (row['similarity'], row['common_items'])
+            for user1_id, user2_id in deletes:
+                for user_id, other_id in [(user1_id, user2_id), (user2_id, user1_id)]:
+                    entry = self.user_neighbors.peek(user_id)
+                    if entry is not None:
+                        entry.pop(other_id, None)
+
+        refs = NodeCache(self.conn, 'User', 'user_id')
+        for query, rows, name in [(USER_SIMILARITY_UPSERT_QUERY, upserts, "cached user similarity upserts"),
+                                  (USER_SIMILARITY_DELETE_QUERY, deletes, "cached user similarity deletes")]:
+            if not rows:
+                continue
+            stats = WriteStats(name)
+            writer = self._edge_writer(query, generation, 'user1_id', 'user2_id', refs, stats, batch_size)
+            writer.add(list(rows.values()))
+            writer.flush()
+            stats.log()
+
+        logger.info(f"Wrote {len(upserts)} changed and deleted {len(deletes)} stale similarities "
+                    f"for {len(affected)} users")
+        self.log_cache()
+
+        end_time = time.time()
+        logger.info(f"Cached incremental user similarity update took {end_time - start_time:.2f} seconds")
+
+
+def main():
+    conn = Neo4jConnection(
+        uri="neo4j://localhost:7687",
+        user="neo4j",
+        password="qwertyuiop"
+    )
+
+    simCalc = SimilarityCalculatorCached(conn)
+
+    try:
+        simCalc.calculate_user_similarity()
+        simCalc.calculate_business_similarity()
+    except Exception as e:
+        logger.error(f"Similarity generation process failed: {e}")
+        traceback.print_exc()
+    finally:
+        simCalc.wait_for_cleanup()
+        conn.close()
+
+if __name__ == "__main__":
+    main()
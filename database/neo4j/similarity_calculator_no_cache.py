@@ -2,20 +2,185 @@ import time
 import neo4j.exceptions
 import numpy as np
 from datetime import datetime, timedelta
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import as_completed
 import logging
 from pathlib import Path
 import traceback
 import random
+import threading
 from neo4j_connection import Neo4jConnection
+from database.partitioning import num_batches_for, partition_by_cost
+from database.checkpoint import CHECKPOINT_DIR, JobCheckpoint, run_batches
+from partitioned_writer import PartitionedEdgeWriter, WriteStats
+from adaptive_batch import AdaptiveBatchSizer
+from node_cache import NodeCache
+from maintenance import delete_relationships
 
 logging.basicConfig(level=logging.INFO, 
                     format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Queries shared with the asyncio calculator (similarity_calculator_async.py)
+#
+# User-user and business-business similarities are separate relationship
+# types, so each expansion only walks its own relationship chain. Every pair
+# is stored once, directed from the lower id to the higher one.
+#
+# The write queries match their endpoints by element id (sim.start_ref and
+# sim.end_ref, resolved through a NodeCache) instead of an index seek on the
+# external id per row.
+
+# Active users with sufficient ratings, with the cost of each user's pair
+# query estimated as the number of co-rater paths it expands
+ACTIVE_USERS_QUERY = """
+MATCH (u:User)-[r:RATED]->(b:Business)
+WITH u, COUNT(r) as rating_count, SUM(COUNT { (b)<-[:RATED]-() }) as cost
+WHERE rating_count >= $min_common_items
+RETURN u.user_id as user_id, rating_count, cost
+ORDER BY cost DESC, user_id
+"""
+
+USER_PAIRS_QUERY = """
+MATCH (u1:User {user_id: $user1_id})-[r1:RATED]->(b:Business)<-[r2:RATED]-(u2:User)
+WHERE u2.user_id > $user1_id
+WITH u1, u2, 
+     COUNT(b) as common_items,
+     COLLECT({rating1: r1.rating, rating2: r2.rating}) as ratings
+WHERE common_items >= $min_common_items AND u1.user_id < u2.user_id
+RETURN u2.user_id as user2_id, ratings, common_items
+"""
+
+# Pairs of an affected user in incremental updates
+AFFECTED_USER_PAIRS_QUERY = """
+MATCH (u1:User {user_id: $user1_id})-[r1:RATED]->(b:Business)<-[r2:RATED]-(u2:User)
+WITH u1, u2,
+    COUNT(b) as common_items,
+    COLLECT({rating1: r1.rating, rating2: r2.rating}) as ratings
+WHERE common_items >= $min_common_items AND u1.user_id < u2.user_id
+RETURN u2.user_id as user2_id, ratings, common_items
+"""
+
+# Businesses with their categories
+BUSINESS_CATEGORIES_QUERY = """
+MATCH (b:Business)-[:BELONGS_TO]->(c:Category)
+WITH b, COLLECT(DISTINCT c.name) as categories
+WHERE SIZE(categories) > 0
+RETURN b.gmap_id as business_id, categories
+ORDER BY SIZE(categories) DESC, business_id
+"""
+
+USER_SIMILARITY_UPSERT_QUERY = """
+UNWIND $similarities AS sim
+MATCH (u1) WHERE elementId(u1) = sim.start_ref
+MATCH (u2) WHERE elementId(u2) = sim.end_ref
+MERGE (u1)-[s:USER_SIMILAR {generation: $generation}]->(u2)
+SET s.score = sim.similarity,
+    s.common_items = sim.common_items,
+    s.last_updated = sim.last_updated
+"""
+
+# A fresh generation has no edges yet and every pair is produced exactly
+# once, so full builds can CREATE instead of MERGE and skip the existence
+# check (and its locks) entirely
+USER_SIMILARITY_CREATE_QUERY = """
+UNWIND $similarities AS sim
+MATCH (u1) WHERE elementId(u1) = sim.start_ref
+MATCH (u2) WHERE elementId(u2) = sim.end_ref
+CREATE (u1)-[:USER_SIMILAR {
+    generation: $generation,
+    score: sim.similarity,
+    common_items: sim.common_items,
+    last_updated: sim.last_updated
+}]->(u2)
+"""
+
+BUSINESS_SIMILARITY_UPSERT_QUERY = """
+UNWIND $similarities AS sim
+MATCH (b1) WHERE elementId(b1) = sim.start_ref
+MATCH (b2) WHERE elementId(b2) = sim.end_ref
+MERGE (b1)-[s:BUSINESS_SIMILAR {generation: $generation}]->(b2)
+SET s.score = sim.similarity,
+    s.common_categories = sim.common_categories,
+    s.last_updated = sim.last_updated
+"""
+
+BUSINESS_SIMILARITY_CREATE_QUERY = """
+UNWIND $similarities AS sim
+MATCH (b1) WHERE elementId(b1) = sim.start_ref
+MATCH (b2) WHERE elementId(b2) = sim.end_ref
+CREATE (b1)-[:BUSINESS_SIMILAR {
+    generation: $generation,
+    score: sim.similarity,
+    common_categories: sim.common_categories,
+    last_updated: sim.last_updated
+}]->(b2)
+"""
+
+ACTIVE_GENERATION_QUERY = """
+MATCH (g:SimilarityGeneration {kind: $kind})
+RETURN g.active AS active, g.building AS building
+"""
+
+# Never reuses the number of an abandoned build: its leftover edges would
+# collide with the CREATEs of the new one
+BEGIN_GENERATION_QUERY = """
+MERGE (g:SimilarityGeneration {kind: $kind})
+SET g.building = coalesce(g.building, g.active, 0) + 1,
+    g.build_started = timestamp()
+RETURN g.building AS building
+"""
+
+ACTIVATE_GENERATION_QUERY = """
+MATCH (g:SimilarityGeneration {kind: $kind})
+SET g.active = $generation,
+    g.building = null,
+    g.activated_at = timestamp()
+"""
+
+# Active user generation for an incremental update of $user_ids. While a
+# rebuild is running, the users are also labelled SimilarityPending, so the
+# rebuild recomputes them once its generation is active. Writing g first
+# serializes this with ACTIVATE_GENERATION_QUERY.
+INCREMENTAL_GENERATION_QUERY = """
+OPTIONAL MATCH (g:SimilarityGeneration {kind: 'user'})
+SET g.last_incremental_update = timestamp()
+WITH coalesce(g.active, 0) AS active, g.building IS NOT NULL AS building
+CALL (building) {
+    UNWIND CASE WHEN building THEN $user_ids ELSE [] END AS user_id
+    MATCH (u:User {user_id: user_id})
+    SET u:SimilarityPending
+    RETURN COUNT(u) AS pending
+}
+RETURN active, pending
+"""
+
+PENDING_USERS_QUERY = """
+MATCH (u:User:SimilarityPending)
+RETURN u.user_id AS user_id
+"""
+
+CLEAR_PENDING_USERS_QUERY = """
+UNWIND $user_ids AS user_id
+MATCH (u:User:SimilarityPending {user_id: user_id})
+REMOVE u:SimilarityPending
+"""
+
+# Deletes up to $batch_size edges of generations older than $keep_generation
+# (the threaded calculator uses maintenance.delete_relationships instead)
+CLEANUP_GENERATION_QUERY = """
+MATCH ()-[s:{type}]->()
+WHERE coalesce(s.generation, 0) < $keep_generation
+WITH s LIMIT $batch_size
+DELETE s
+RETURN COUNT(*) AS deleted
+"""
+
+SIMILARITY_TYPES = {'user': 'USER_SIMILAR', 'business': 'BUSINESS_SIMILAR'}
+
 class SimilarityCalculatorNoCache:
     def __init__(self, conn):
         self.conn = conn
+        self._cleanup_threads = []
         self.setup_indexes()
     
     def setup_indexes(self):
@@ -24,8 +189,13 @@ class SimilarityCalculatorNoCache:
             "CREATE INDEX business_gmap_id IF NOT EXISTS FOR (b:Business) ON (b.gmap_id)",
             "CREATE INDEX category_name IF NOT EXISTS FOR (c:Category) ON (c.name)",
             "CREATE INDEX rating_index IF NOT EXISTS FOR ()-[r:RATED]-() ON (r.rating)",
-            "CREATE INDEX similarity_score IF NOT EXISTS FOR ()-[s:SIMILAR_TO]-() ON (s.score)",
-            "CREATE INDEX similarity_last_updated IF NOT EXISTS FOR ()-[s:SIMILAR_TO]-() ON (s.last_updated)"
+            "CREATE INDEX user_similar_score IF NOT EXISTS FOR ()-[s:USER_SIMILAR]-() ON (s.score)",
+            "CREATE INDEX user_similar_last_updated IF NOT EXISTS FOR ()-[s:USER_SIMILAR]-() ON (s.last_updated)",
+            "CREATE INDEX user_similar_generation IF NOT EXISTS FOR ()-[s:USER_SIMILAR]-() ON (s.generation)",
+            "CREATE INDEX business_similar_score IF NOT EXISTS FOR ()-[s:BUSINESS_SIMILAR]-() ON (s.score)",
+            "CREATE INDEX business_similar_last_updated IF NOT EXISTS FOR ()-[s:BUSINESS_SIMILAR]-() ON (s.last_updated)",
+            "CREATE INDEX business_similar_generation IF NOT EXISTS FOR ()-[s:BUSINESS_SIMILAR]-() ON (s.generation)",
+            "CREATE CONSTRAINT similarity_generation_kind IF NOT EXISTS FOR (g:SimilarityGeneration) REQUIRE g.kind IS UNIQUE"
         ]
         
         with self.conn.driver.session() as session:
@@ -52,10 +222,20 @@ class SimilarityCalculatorNoCache:
             logger.error(f"Similarity calculation error: {e}")
             return 0
 
-    def query_retry(self, session, query, parameters, max_retries=5):
+    def query_retry(self, session, query, parameters, max_retries=5, stats=None):
+        """
+        Runs a write query, retrying it on deadlocks. If stats is given, the
+        latency and retry count of the call are recorded in it.
+        """
+        start_time = time.time()
         for attempt in range(max_retries):
             try:
-                return session.run(query, parameters)
+                # Consume inside the retry so errors raised while the query
+                # executes (not just when it is sent) are retried too
+                summary = session.run(query, parameters).consume()
+                if stats:
+                    stats.record_batch(len(parameters.get('similarities', [])), time.time() - start_time, attempt)
+                return summary
             except neo4j.exceptions.TransientError as e:
                 if "DeadlockDetected" not in str(e):
                     raise
@@ -67,54 +247,188 @@ class SimilarityCalculatorNoCache:
         
         raise Exception("Max retries reached due to persistent deadlocks")
 
-    def calculate_user_similarity(self, min_common_items=3, min_similarity=0.3, batch_size=500):
-        logger.info("Starting user similarity calculation...")
+    ###############################################################
+    # SIMILARITY GENERATIONS
+    ###############################################################
+    # Full rebuilds write similarity edges tagged with a new generation
+    # number while readers keep following the active one. A single
+    # (:SimilarityGeneration {kind}) node holds the active pointer, so the
+    # switchover is one property write; superseded edges are removed in
+    # small batches by a background thread afterwards. Incremental updates
+    # made during a user rebuild go into the old generation, so the rebuild
+    # replays their users after the switchover.
+
+    def _active_generation(self, kind):
+        with self.conn.driver.session() as session:
+            record = session.run(ACTIVE_GENERATION_QUERY, {'kind': kind}).single()
+        if record is None or record['active'] is None:
+            return 0
+        return record['active']
 
-        # Delete existing SIMILAR_TO relationships for users
-        delete_query = "MATCH (:User)-[s:SIMILAR_TO]->(:User) DELETE s"
+    def _begin_generation(self, kind):
         with self.conn.driver.session() as session:
+            generation = session.run(BEGIN_GENERATION_QUERY, {'kind': kind}).single()['building']
+        logger.info(f"Building {kind} similarity generation {generation}")
+        return generation
+
+    def _activate_generation(self, kind, generation):
+        # Retried on transient failures, so a finished build is not lost to one
+        self.conn.execute_write(ACTIVATE_GENERATION_QUERY, {'kind': kind, 'generation': generation})
+        logger.info(f"Activated {kind} similarity generation {generation}")
+
+    def cleanup_generations(self, kind, keep_generation, batch_size=10000, concurrency=1):
+        """
+        Delete similarity edges of `kind` older than keep_generation, in
+        server-side transactions of batch_size rows.
+        """
+        total_deleted = delete_relationships(
+            self.conn,
+            f"()-[s:{SIMILARITY_TYPES[kind]}]->()",
+            variable="s",
+            where="coalesce(s.generation, 0) < $keep_generation",
+            parameters={'keep_generation': keep_generation},
+            batch_size=batch_size,
+            concurrency=concurrency,
+            description=f"superseded {SIMILARITY_TYPES[kind]} relationships"
+        )
+        logger.info(f"Removed {total_deleted} superseded {SIMILARITY_TYPES[kind]} relationships")
+
+    def _start_cleanup(self, kind, keep_generation):
+        def run():
             try:
-                session.run(delete_query)
-                logger.info("Deleted existing SIMILAR_TO relationships for users")
+                self.cleanup_generations(kind, keep_generation)
             except Exception as e:
-                logger.error(f"Error deleting SIMILAR_TO relationships: {e}")
+                logger.error(f"Cleanup of old {kind} similarity generations failed: {e}")
 
-        start_time = time.time()
+        thread = threading.Thread(target=run, name=f"{kind}-similarity-cleanup")
+        thread.start()
+        self._cleanup_threads.append(thread)
 
-        # Get active users with sufficient ratings
-        active_users_query = """
-        MATCH (u:User)-[r:RATED]->(b:Business)
-        WITH u, COUNT(r) as rating_count
-        WHERE rating_count >= $min_common_items
-        RETURN u.user_id as user_id, rating_count
-        ORDER BY rating_count DESC
+    def _incremental_generation(self, user_ids):
         """
-        
+        The user generation incremental updates of user_ids write into,
+        marking the users for replay if a rebuild is running.
+        """
+        with self.conn.driver.session() as session:
+            record = session.run(INCREMENTAL_GENERATION_QUERY, {'user_ids': list(user_ids)}).single()
+        if record['pending']:
+            logger.info(f"Marked {record['pending']} users for replay after the running rebuild")
+        return record['active']
+
+    def _replay_pending_users(self, min_common_items, min_similarity, batch_size):
+        """Recomputes the users updated while the last user rebuild was running."""
+        pending = [record['user_id'] for record in self.conn.query(PENDING_USERS_QUERY)]
+        if not pending:
+            return
+        logger.info(f"Replaying {len(pending)} users updated during the rebuild")
+        self.update_user_similarity(pending, min_common_items, min_similarity, batch_size)
+        self.conn.execute_write(CLEAR_PENDING_USERS_QUERY, {'user_ids': pending})
+
+    def _building_generation(self, kind):
         with self.conn.driver.session() as session:
-            active_users = session.run(active_users_query, {'min_common_items': min_common_items})
-            active_users = [record.data() for record in active_users]
+            record = session.run(ACTIVE_GENERATION_QUERY, {'kind': kind}).single()
+        return record['building'] if record else None
+
+    def _start_generation_build(self, kind, checkpoint, params):
+        """
+        Opens the checkpoint of a full rebuild and returns the generation to
+        build into, and whether it is a resumed one. A resumed job continues
+        its unfinished generation if that generation is still the one being
+        built.
+        """
+        resumed = checkpoint.start(params)
+        generation = checkpoint.meta.get('generation')
+        if resumed and generation is not None and generation == self._building_generation(kind):
+            logger.info(f"Resuming {kind} similarity generation {generation}")
+            return generation, True
+        if resumed:
+            checkpoint.reset(params)
+
+        generation = self._begin_generation(kind)
+        checkpoint.set_meta('generation', generation)
+        return generation, False
+
+    def _edge_writer(self, query, generation, start_key, end_key, refs, stats, batch_size=500):
+        """
+        Partitioned writer for similarity rows of one generation; see
+        PartitionedEdgeWriter for why concurrent batches cannot deadlock.
+        Endpoints are resolved to element ids through the refs NodeCache,
+        and rows per transaction start at batch_size and adapt to the
+        observed write latency.
+        """
+        def write_batch(session, rows):
+            resolved = refs.resolve([row[start_key] for row in rows] + [row[end_key] for row in rows])
+            # Rows whose endpoints no longer exist would match nothing anyway
+            similarities = [
+                dict(row, start_ref=resolved[row[start_key]], end_ref=resolved[row[end_key]])
+                for row in rows
+                if row[start_key] in resolved and row[end_key] in resolved
+            ]
+            self.query_retry(session, query, {
+                'similarities': similarities,
+                'generation': generation
+            }, stats=stats)
+
+        return PartitionedEdgeWriter(
+            self.conn,
+            write_batch,
+            start_key=lambda row: row[start_key],
+            end_key=lambda row: row[end_key],
+            batch_size=batch_size,
+            max_workers=4,
+            batch_sizer=AdaptiveBatchSizer(stats.name, initial=batch_size, min_size=50, max_size=20000)
+        )
+
+    def wait_for_cleanup(self):
+        """Block until all background generation cleanups have finished."""
+        for thread in self._cleanup_threads:
+            thread.join()
+        self._cleanup_threads = []
+
+    def calculate_user_similarity(self, min_common_items=3, min_similarity=0.3, batch_size=500,
+                                  checkpoint_dir=CHECKPOINT_DIR):
+        """
+        Rebuilds all user similarities into a new generation. Completed
+        batches are checkpointed, so rerunning with the same parameters after
+        a failure resumes the build instead of starting over.
+        """
+        logger.info("Starting user similarity calculation...")
+
+        # Build into a new generation; readers stay on the active one until the switch
+        checkpoint = JobCheckpoint("neo4j_user_similarity", checkpoint_dir)
+        params = {'min_common_items': min_common_items, 'min_similarity': min_similarity, 'batch_size': batch_size}
+        generation, resumed = self._start_generation_build('user', checkpoint, params)
+
+        # A resumed build may already hold part of the rows of a batch whose
+        # flush was interrupted, so only a fresh one can use CREATE
+        stats = WriteStats("user similarity")
+        refs = NodeCache(self.conn, 'User', 'user_id')
+        writer = self._edge_writer(
+            USER_SIMILARITY_UPSERT_QUERY if resumed else USER_SIMILARITY_CREATE_QUERY,
+            generation, 'user1_id', 'user2_id', refs, stats, batch_size
+        )
+
+        start_time = time.time()
+
+        # Get active users with sufficient ratings and their estimated cost
+        # Streamed as value tuples, kept as (user_id, cost) pairs
+        active_users = [
+            (user_id, cost) for user_id, _, cost
+            in self.conn.stream(ACTIVE_USERS_QUERY, {'min_common_items': min_common_items}, values=True)
+        ]
         
         logger.info(f"Found {len(active_users)} active users")
 
-        def process_user_batch(batch):
-            """Process a batch of users and calculate their similarities"""
+        # Every similarity endpoint is an active user, so resolve them all once
+        refs.warm(user_id for user_id, _ in active_users)
+
+        def process_user_batch(key, batch):
+            """Process a batch of users and hand their similarities to the writer"""
             batch_similarities = []
             
             with self.conn.driver.session() as session:
-                for user_data in batch:
-                    user1_id = user_data['user_id']
-                    
-                    pairs_query = """
-                    MATCH (u1:User {user_id: $user1_id})-[r1:RATED]->(b:Business)<-[r2:RATED]-(u2:User)
-                    WHERE u2.user_id > $user1_id
-                    WITH u1, u2, 
-                         COUNT(b) as common_items,
-                         COLLECT({rating1: r1.rating, rating2: r2.rating}) as ratings
-                    WHERE common_items >= $min_common_items AND u1.user_id < u2.user_id
-                    RETURN u2.user_id as user2_id, ratings, common_items
-                    """
-                    
-                    pairs = session.run(pairs_query, {
+                for user1_id, _ in batch:
+                    pairs = session.run(USER_PAIRS_QUERY, {
                         'user1_id': user1_id,
                         'min_common_items': min_common_items
                     })
@@ -137,110 +451,118 @@ class SimilarityCalculatorNoCache:
                                 'common_items': common_items,
                                 'last_updated': int(datetime.now().timestamp() * 1000)
                             })
-                
-                if batch_similarities:
-                    bulk_upsert_query = """
-                    UNWIND $similarities AS sim
-                    MATCH (u1:User {user_id: sim.user1_id})
-                    MATCH (u2:User {user_id: sim.user2_id})
-                    MERGE (u1)-[s:SIMILAR_TO]-(u2)
-                    SET s.score = sim.similarity,
-                        s.common_items = sim.common_items,
-                        s.last_updated = sim.last_updated
-                    """
-                    
-                    try:
-                        self.query_retry(session, bulk_upsert_query, {'similarities': batch_similarities})
-                        logger.info(f"Processed batch with {len(batch_similarities)} similarities")
-                    except Exception as e:
-                        logger.error(f"Batch processing error: {e}")
+
+            # The batch only counts as done once the flush holding its rows succeeds
+            writer.add(batch_similarities, on_written=lambda: checkpoint.mark_done(key))
+            logger.info(f"Processed batch with {len(batch_similarities)} similarities")
         
-        with ThreadPoolExecutor(max_workers=4) as executor:
-            for i in range(0, len(active_users), batch_size):
-                batch = active_users[i:i + batch_size]
-                executor.submit(process_user_batch, batch)
+        # Batches of roughly equal estimated cost, submitted heaviest first
+        user_batches = partition_by_cost(
+            active_users,
+            lambda user: user[1],
+            num_batches_for(len(active_users), batch_size)
+        )
+        keyed_batches = [
+            (JobCheckpoint.batch_key(user_id for user_id, _ in batch), batch)
+            for batch in user_batches
+        ]
+
+        # Failed batches are retried; anything still failing aborts the job
+        # before the switchover, leaving the checkpoint to resume from
+        run_batches(keyed_batches, process_user_batch, checkpoint, max_workers=4, mark_done=False)
+        writer.flush()
+        stats.log()
+        writer.batch_sizer.log()
+        refs.log()
+
+        self._activate_generation('user', generation)
+        checkpoint.complete()
+        self._replay_pending_users(min_common_items, min_similarity, batch_size)
+        self._start_cleanup('user', generation)
         
         end_time = time.time()
         logger.info(f"User similarity calculation took {end_time - start_time:.2f} seconds")
         logger.info("User similarity calculation completed")
 
-    def calculate_business_similarity(self, min_similarity=0.3, batch_size=500):
+    def calculate_business_similarity(self, min_similarity=0.3, batch_size=500,
+                                      checkpoint_dir=CHECKPOINT_DIR):
+        """
+        Rebuilds all business similarities into a new generation, with the
+        same checkpointing as calculate_user_similarity.
+        """
         logger.info("Starting business similarity calculation...")
 
-        # Delete existing SIMILAR_TO relationships for businesses
-        delete_query = "MATCH (:Business)-[s:SIMILAR_TO]-(:Business) DELETE s"
-        with self.conn.driver.session() as session:
-            try:
-                session.run(delete_query)
-                logger.info("Deleted existing SIMILAR_TO relationships for businesses")
-            except Exception as e:
-                logger.error(f"Error deleting SIMILAR_TO relationships: {e}")
+        # Build into a new generation; readers stay on the active one until the switch
+        checkpoint = JobCheckpoint("neo4j_business_similarity", checkpoint_dir)
+        params = {'min_similarity': min_similarity, 'batch_size': batch_size}
+        generation, resumed = self._start_generation_build('business', checkpoint, params)
+
+        stats = WriteStats("business similarity")
+        refs = NodeCache(self.conn, 'Business', 'gmap_id')
+        writer = self._edge_writer(
+            BUSINESS_SIMILARITY_UPSERT_QUERY if resumed else BUSINESS_SIMILARITY_CREATE_QUERY,
+            generation, 'business1_id', 'business2_id', refs, stats, batch_size
+        )
         
         start_time = time.time()
 
-        # Get businesses with their categories
-        get_businesses_query = """
-        MATCH (b:Business)-[:BELONGS_TO]->(c:Category)
-        WITH b, COLLECT(DISTINCT c.name) as categories
-        WHERE SIZE(categories) > 0
-        RETURN b.gmap_id as business_id, categories
-        ORDER BY SIZE(categories) DESC
-        """
-        
-        with self.conn.driver.session() as session:
-            businesses = session.run(get_businesses_query)
-            businesses = [record.data() for record in businesses]
+        # (business_id, category set) pairs; the sets are built once here
+        # instead of twice per compared pair
+        businesses = [
+            (business_id, frozenset(categories))
+            for business_id, categories in self.conn.stream(BUSINESS_CATEGORIES_QUERY, values=True)
+        ]
         
         logger.info(f"Found {len(businesses)} businesses")
+        refs.warm(business_id for business_id, _ in businesses)
         
-        def process_business_batch(batch, start_index):
-            """Process a batch of businesses and calculate their similarities"""
+        def process_business_batch(key, batch, start_index):
+            """Process a batch of businesses and hand their similarities to the writer"""
             batch_similarities = []
             
-            with self.conn.driver.session() as session:
-                for i, b1 in enumerate(batch):
-                    for b2 in businesses[start_index+i+1:]:
-                        if(b1['business_id'] == b2['business_id']):
-                            continue
-                        # Jaccard similarity for categories
-                        intersection = len(set(b1['categories']) & set(b2['categories']))
-                        union = len(set(b1['categories']) | set(b2['categories']))
-                        
-                        if union == 0:
-                            continue
-                        
-                        similarity = intersection / union
-                        
-                        if similarity >= min_similarity:
-                            batch_similarities.append({
-                                'business1_id': b1['business_id'],
-                                'business2_id': b2['business_id'],
-                                'similarity': similarity,
-                                'common_categories': intersection,
-                                'last_updated': int(datetime.now().timestamp() * 1000)
-                            })
-                
-                if batch_similarities:
-                    bulk_upsert_query = """
-                    UNWIND $similarities AS sim
-                    MATCH (b1:Business {gmap_id: sim.business1_id})
-                    MATCH (b2:Business {gmap_id: sim.business2_id})
-                    MERGE (b1)-[s:SIMILAR_TO]-(b2)
-                    SET s.score = sim.similarity,
-                        s.common_categories = sim.common_categories,
-                        s.last_updated = sim.last_updated
-                    """
+            for i, b1 in enumerate(batch):
+                for b2 in businesses[start_index+i+1:]:
+                    if(b1[0] == b2[0]):
+                        continue
+                    # Jaccard similarity for categories
+                    intersection = len(b1[1] & b2[1])
+                    union = len(b1[1] | b2[1])
+                    
+                    if union == 0:
+                        continue
                     
-                    try:
-                        self.query_retry(session, bulk_upsert_query, {'similarities': batch_similarities})
-                        logger.info(f"Processed batch with {len(batch_similarities)} business similarities")
-                    except Exception as e:
-                        logger.error(f"Batch processing error: {e}")
+                    similarity = intersection / union
+                    
+                    if similarity >= min_similarity:
+                        # Businesses are ordered by category count, not id,
+                        # so put each pair in canonical (lower id first) order
+                        business1_id, business2_id = sorted((b1[0], b2[0]))
+                        batch_similarities.append({
+                            'business1_id': business1_id,
+                            'business2_id': business2_id,
+                            'similarity': similarity,
+                            'common_categories': intersection,
+                            'last_updated': int(datetime.now().timestamp() * 1000)
+                        })
+
+            writer.add(batch_similarities, on_written=lambda: checkpoint.mark_done(key))
+            logger.info(f"Processed batch with {len(batch_similarities)} business similarities")
         
-        with ThreadPoolExecutor(max_workers=4) as executor:
-            for i in range(0, len(businesses), batch_size):
-                batch = businesses[i:i + batch_size]
-                executor.submit(process_business_batch, batch, i)
+        # Batches are keyed by their start index in the (deterministic) business order
+        keyed_batches = [
+            (str(i), (businesses[i:i + batch_size], i))
+            for i in range(0, len(businesses), batch_size)
+        ]
+        run_batches(keyed_batches, lambda key, item: process_business_batch(key, *item), checkpoint,
+                    max_workers=4, mark_done=False)
+        writer.flush()
+        stats.log()
+        writer.batch_sizer.log()
+        refs.log()
+
+        self._activate_generation('business', generation)
+        checkpoint.complete()
+        self._start_cleanup('business', generation)
 
         end_time = time.time()
         logger.info(f"Business similarity calculation took {end_time - start_time:.2f} seconds")
@@ -252,6 +574,17 @@ class SimilarityCalculatorNoCache:
         """
         logger.info("Starting incremental user similarity update...")
 
+        # Incremental updates go straight into the generation readers are
+        # using (and are replayed by a running rebuild)
+        generation = self._incremental_generation(affected_users)
+
+        # The active generation already holds most of these edges, so
+        # incremental updates always MERGE
+        stats = WriteStats("incremental user similarity")
+        refs = NodeCache(self.conn, 'User', 'user_id')
+        writer = self._edge_writer(USER_SIMILARITY_UPSERT_QUERY, generation, 'user1_id', 'user2_id', refs, stats,
+                                   batch_size)
+
         start_time = time.time()
 
         def process_user_batch(batch):
@@ -261,15 +594,7 @@ class SimilarityCalculatorNoCache:
             with self.conn.driver.session() as session:
                 for user1_id in batch:
                     # Find potential similarity pairs for the affected user
-                    pairs_query = """
-                    MATCH (u1:User {user_id: $user1_id})-[r1:RATED]->(b:Business)<-[r2:RATED]-(u2:User)
-                    WITH u1, u2,
-                        COUNT(b) as common_items,
-                        COLLECT({rating1: r1.rating, rating2: r2.rating}) as ratings
-                    WHERE common_items >= $min_common_items AND u1.user_id < u2.user_id
-                    RETURN u2.user_id as user2_id, ratings, common_items
-                    """
-                    pairs = session.run(pairs_query, {
+                    pairs = session.run(AFFECTED_USER_PAIRS_QUERY, {
                         'user1_id': user1_id,
                         'min_common_items': min_common_items
                     })
@@ -293,26 +618,19 @@ class SimilarityCalculatorNoCache:
                                 'last_updated': int(datetime.now().timestamp() * 1000)
                             })
 
-                if batch_similarities:
-                    bulk_upsert_query = """
-                    UNWIND $similarities AS sim
-                    MATCH (u1:User {user_id: sim.user1_id})
-                    MATCH (u2:User {user_id: sim.user2_id})
-                    MERGE (u1)-[s:SIMILAR_TO]-(u2)
-                    SET s.score = sim.similarity,
-                        s.common_items = sim.common_items,
-                        s.last_updated = sim.last_updated
-                    """
-                    try:
-                        self.query_retry(session, bulk_upsert_query, {'similarities': batch_similarities})
-                        logger.info(f"Processed batch with {len(batch_similarities)} similarities")
-                    except Exception as e:
-                        logger.error(f"Batch processing error: {e}")
-
-        with ThreadPoolExecutor(max_workers=4) as executor:
-            for i in range(0, len(affected_users), batch_size):
-                batch = affected_users[i:i + batch_size]
-                executor.submit(process_user_batch, batch)
+            writer.add(batch_similarities)
+            logger.info(f"Processed batch with {len(batch_similarities)} similarities")
+
+        keyed_batches = [
+            (str(i), affected_users[i:i + batch_size])
+            for i in range(0, len(affected_users), batch_size)
+        ]
+        run_batches(keyed_batches, lambda key, batch: process_user_batch(batch),
+                    job="incremental user similarity update", max_workers=4)
+        writer.flush()
+        stats.log()
+        writer.batch_sizer.log()
+        refs.log()
 
         end_time = time.time()
         logger.info(f"Incremental user similarity update took {end_time - start_time:.2f} seconds")
@@ -336,6 +654,7 @@ def main():
         logger.error(f"Similarity generation process failed: {e}")
         traceback.print_exc()
     finally:
+        simCalc.wait_for_cleanup()
         conn.close()
 
 if __name__ == "__main__":
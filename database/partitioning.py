@@ -0,0 +1,41 @@
+import heapq
+import math
+
+def partition_by_cost(items, cost, num_batches):
+    """
+    Splits items into num_batches batches of roughly equal total cost.
+
+    Items are assigned heaviest-first to the currently lightest batch
+    (longest-processing-time first), and the batches are returned heaviest
+    first. Submitting them in that order to a worker pool means the
+    expensive work starts early and the cheap batches fill in the gaps at
+    the end, so no single worker is left running long after the others.
+
+    Arguments
+        items       : list of work items
+        cost        : function returning the estimated cost of an item
+        num_batches : number of batches to create (capped at len(items))
+
+    Returns:
+        list of non-empty batches (lists of items)
+    """
+    num_batches = max(1, min(num_batches, len(items)))
+
+    # sorted() is stable, so items of equal cost keep their input order and
+    # the same input always produces the same batches
+    ordered = sorted(items, key=cost, reverse=True)
+
+    batches = [[] for _ in range(num_batches)]
+    loads = [(0, index) for index in range(num_batches)]
+    for item in ordered:
+        load, index = heapq.heappop(loads)
+        batches[index].append(item)
+        heapq.heappush(loads, (load + cost(item), index))
+
+    batch_costs = {index: load for load, index in loads}
+    order = sorted(range(num_batches), key=lambda index: (-batch_costs[index], index))
+    return [batches[index] for index in order if batches[index]]
+
+def num_batches_for(num_items, batch_size):
+    """Number of batches needed to give batches of batch_size items on average."""
+    return max(1, math.ceil(num_items / batch_size))